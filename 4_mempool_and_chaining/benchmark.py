@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+"""
+Micro benchmarks for the hot paths of the chain
+
+usage: python benchmark.py [name ...]
+"""
+
+import sys
+import time
+
+from utils import sha256d_hexdigest, internal_order
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def sample_block(txns=()):
+    from blockchain import Block, BLOCK_NBITS
+
+    return Block(
+        version=0,
+        previous_block_hash=None,
+        merkle_tree_hash=b'\x18\xff\x02\xdd\xbe\x1c5\xef\xc7M\xc4J\xa8G\xcf\r&\t\xf1\xde/\x05\xfd\xed\xeb\xc4\xcf\xb7k\x1e\xbd\xb6',
+        timestamp=1507593600,
+        nbits=BLOCK_NBITS,
+        nonce=0,
+        txns=list(txns)
+    )
+
+
+def bench_mining(nonces=200000):
+    """
+    hash rate of the mining hot loop, the original hex-to-int loop vs every available hasher backend
+    """
+    from hashers import hasher_registry
+
+    template = sample_block()._base_hash
+
+    # nothing is below a target of 0, so both loops visit every nonce
+    target = 0
+
+    def hexdigest_loop():
+        for nonce in range(nonces):
+            if int(sha256d_hexdigest(template+internal_order(nonce)), 16) < target:
+                return nonce
+
+    legacy, _ = timed(hexdigest_loop)
+    print(f'hexdigest loop: {nonces / legacy / 1000:.0f} KH/s')
+
+    for name, cls in hasher_registry.items():
+        if not cls.available():
+            continue
+        duration, _ = timed(cls().scan, template, target, 0, nonces)
+        print(f'{name} hasher: {nonces / duration / 1000:.0f} KH/s ({legacy / duration:.2f}x)')
+
+
+def sample_transactions(count):
+    from transaction import Transaction, TxIn, TxOut, OutPoint, SignatureScript
+
+    return [
+        Transaction(
+            txins=[TxIn(
+                outpoint=OutPoint(txid=i.to_bytes(32, byteorder='big'), txout_idx=0),
+                signature=SignatureScript(unlock_sig=bytes(71), unlock_pk=bytes(64)),
+                sequence=0
+            )],
+            txouts=[TxOut(value=i, pubkey='1MfsCiTUcbQiCR2UGFxL9GgzSmwQBZJWqV')]
+        )
+        for i in range(count)
+    ]
+
+
+def bench_chain_scan(blocks=2000, lookups=50):
+    """
+    linear scans over a chain by id, recomputing the ids every access vs the memoized ids
+    """
+    from utils import sha256d
+
+    chain = [sample_block()._replace(timestamp=i) for i in range(blocks)]
+    txns = sample_transactions(blocks)
+    block_hash, txid = chain[-1].id, txns[-1].id
+
+    def scan_recomputed():
+        for _ in range(lookups):
+            [b for b in chain if sha256d(b.header_hash) == block_hash]
+            [t for t in txns if sha256d(t.serialize()) == txid]
+
+    def scan_memoized():
+        for _ in range(lookups):
+            [b for b in chain if b.id == block_hash]
+            [t for t in txns if t.id == txid]
+
+    recomputed, _ = timed(scan_recomputed)
+    memoized, _ = timed(scan_memoized)
+
+    print(f'recomputed ids: {recomputed * 1000 / lookups:.2f} ms per scan of {blocks} blocks + txns')
+    print(f'memoized ids:   {memoized * 1000 / lookups:.2f} ms per scan ({recomputed / memoized:.0f}x)')
+
+
+def bench_utxo_memory(count=1000000, outputs_per_txn=2, addresses=10000):
+    """
+    traced memory of the utxo set as a node holds it, through UTXOManager along with its address index:
+    a dict of NamedTuples vs the compact column store
+    """
+    import tracemalloc
+    from transaction import UnspentTxOut, UTXOManager
+    from utxostore import CompactUTXOSet
+
+    utxo_manager = UTXOManager()
+
+    def fill(utxo_set):
+        utxo_manager.use_store(utxo_set)
+        for i in range(count):
+            txid = (i // outputs_per_txn).to_bytes(32, byteorder='big')
+            utxo_manager.add_utxo(UnspentTxOut(
+                value=50000 + i, pubkey=f'address-{i % addresses}', txid=txid,
+                txout_idx=i % outputs_per_txn, is_coinbase=False, height=i // 1000
+            ))
+
+    results = {}
+    for name, factory in (('dict', dict), ('compact', CompactUTXOSet)):
+        tracemalloc.start()
+        duration, _ = timed(fill, factory())
+        results[name] = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print(f'{name}: {results[name] / 2 ** 20:.0f} MiB, {results[name] / count:.0f} B per utxo, '
+              f'filled in {duration:.1f} s')
+        utxo_manager.use_store({})
+
+    print(f'compact store uses {results["compact"] / results["dict"]:.0%} of the dict')
+
+
+def bench_serialization(txns=2000, rounds=5):
+    """
+    size and encode/decode speed of a large block, json vs the binary codec
+    """
+    from blockchain import Block
+
+    block = sample_block(sample_transactions(txns))
+    codecs = (
+        ('json', block.serialize, Block.deserialize),
+        ('binary', block.serialize_binary, Block.deserialize_binary),
+    )
+
+    for name, encode, decode in codecs:
+        encode_time, data = timed(lambda: [encode() for _ in range(rounds)][-1])
+        decode_time, _ = timed(lambda: [decode(data) for _ in range(rounds)])
+        print(f'{name}: {len(data)} bytes, encode {encode_time * 1000 / rounds:.1f} ms, '
+              f'decode {decode_time * 1000 / rounds:.1f} ms')
+
+
+def reflective_deserialize(json_str):
+    """
+    the json decoder as it was before the decode plans, it reflects on the type hints of every object
+    """
+    import json
+    import binascii
+    from typing import Mapping, get_type_hints
+    from serialization import namedtuple_cls_registry
+
+    def str_to_objs(obj):
+        if isinstance(obj, list):
+            return [str_to_objs(elem) for elem in obj]
+        elif not isinstance(obj, Mapping):
+            return obj
+
+        _type = namedtuple_cls_registry[obj.pop('_type', None)]
+        bytes_key = {
+            key for key, value in get_type_hints(_type).items() if value == bytes
+        }
+
+        for key, value in obj.items():
+            obj[key] = str_to_objs(value)
+
+            if key in bytes_key:
+                obj[key] = binascii.unhexlify(obj[key]) if obj[key] else obj[key]
+
+        return _type(**obj)
+
+    return str_to_objs(json.loads(json_str))
+
+
+def bench_json_decode(txns=5000, rounds=3):
+    """
+    json decoding of a large block, reflecting on type hints per object vs the precompiled decode plans
+    """
+    from blockchain import Block
+
+    json_str = sample_block(sample_transactions(txns)).serialize()
+    reflective, expected = timed(lambda: [reflective_deserialize(json_str) for _ in range(rounds)][-1])
+    planned, block = timed(lambda: [Block.deserialize(json_str) for _ in range(rounds)][-1])
+
+    assert block == expected
+    print(f'reflective: {reflective * 1000 / rounds:.1f} ms per block of {txns} txns')
+    print(f'planned:    {planned * 1000 / rounds:.1f} ms ({reflective / planned:.1f}x)')
+
+
+def bench_txid(txns=20000):
+    """
+    txid cost, hashing the json serialization vs the canonical encoding
+    """
+    from transaction import Transaction
+
+    fresh = lambda: [Transaction(*txn) for txn in sample_transactions(txns)]
+
+    legacy, _ = timed(lambda: [txn.legacy_id for txn in fresh()])
+    canonical, _ = timed(lambda: [txn.id for txn in fresh()])
+
+    print(f'json txids:      {legacy * 1e6 / txns:.1f} us per txn')
+    print(f'canonical txids: {canonical * 1e6 / txns:.1f} us per txn ({legacy / canonical:.1f}x)')
+
+
+def bench_merkle(txns=4000, refreshes=50):
+    """
+    template refresh cost, rebuilding the merkle tree vs replacing the coinbase in the accumulator
+    """
+    from transaction import Transaction, MerkleNode, MerkleAccumulator
+
+    block_txns = sample_transactions(txns)
+    coinbases = [Transaction.create_coinbase('1MfsCiTUcbQiCR2UGFxL9GgzSmwQBZJWqV', i) for i in range(refreshes)]
+    accumulator = MerkleAccumulator(block_txns)
+
+    rebuild, _ = timed(lambda: [
+        MerkleNode.generate_root_from_transaction([coinbase, *block_txns[1:]]).value for coinbase in coinbases
+    ])
+    incremental, _ = timed(lambda: [accumulator.replace(0, coinbase) or accumulator.root for coinbase in coinbases])
+
+    print(f'rebuild:     {rebuild * 1000 / refreshes:.2f} ms per refresh of {txns} txns')
+    print(f'incremental: {incremental * 1000 / refreshes:.3f} ms per refresh ({rebuild / incremental:.0f}x)')
+
+
+def bench_mempool(txns=20000, chain_length=4):
+    """
+    mempool admission and block template building, txns spend each other in chains of chain_length
+    """
+    from transaction import Transaction, TxIn, TxOut, OutPoint, SignatureScript, UnspentTxOut, UTXOManager
+    from mempool import Mempool
+
+    utxo_mgr, mempool = UTXOManager(), Mempool()
+    utxo_mgr.clear()
+
+    def spend(txid, value, fee):
+        return Transaction(
+            txins=[TxIn(outpoint=OutPoint(txid, 0), signature=SignatureScript(bytes(71), bytes(64)), sequence=0)],
+            txouts=[TxOut(value=value - fee, pubkey='1MfsCiTUcbQiCR2UGFxL9GgzSmwQBZJWqV')]
+        )
+
+    pool = []
+    for i in range(txns // chain_length):
+        txid = i.to_bytes(32, byteorder='big')
+        utxo_mgr.add_utxo(UnspentTxOut(1000000, '1MfsCiTUcbQiCR2UGFxL9GgzSmwQBZJWqV', txid, 0, False, 0))
+        value = 1000000
+        for depth in range(chain_length):
+            txn = spend(txid, value, fee=(i * 7919 + depth * 104729) % 5000)
+            pool.append(txn)
+            txid, value = txn.id, txn.txouts[0].value
+
+    admission, _ = timed(lambda: [mempool.add_txn_to_mempool(txn) for txn in pool])
+    selection, block = timed(mempool.select_from_mempool, sample_block())
+
+    print(f'admission: {admission * 1e6 / txns:.1f} us per txn')
+    print(f'template:  {selection * 1000:.1f} ms for {len(block.txns)} of {len(mempool.mempool_dict)} txns')
+
+    utxo_mgr.clear()
+
+
+def bench_signatures(txns=400, processes=None):
+    """
+    signature checks of a batch of single input txns, in process vs the pool vs the signature cache
+    """
+    import ecdsa
+    from transaction import Transaction, TxOut, OutPoint, UnspentTxOut
+    from validation import SignatureVerifier, SignatureCache, address_of
+    from wallet import make_txin
+
+    key = ecdsa.SigningKey.generate(curve=ecdsa.SECP256k1)
+    address = address_of(key.verifying_key.to_string())
+    utxos, batch = {}, []
+    for i in range(txns):
+        outpoint = OutPoint(i.to_bytes(32, byteorder='big'), 0)
+        utxos[outpoint] = UnspentTxOut(50000, address, outpoint.txid, 0, False, 0)
+        txout = TxOut(value=49000, pubkey=address)
+        batch.append(Transaction(txins=[make_txin(key, outpoint, txout)], txouts=[txout]))
+
+    find_utxo = lambda txin: utxos.get(txin.outpoint)
+
+    serial, _ = timed(SignatureVerifier(processes=1, cache=SignatureCache()).verify, batch, find_utxo)
+    verifier = SignatureVerifier(processes=processes, cache=SignatureCache())
+    try:
+        timed(verifier.verify, batch[:verifier.processes * 4], find_utxo)
+        parallel, _ = timed(verifier.verify, batch[verifier.processes * 4:], find_utxo)
+        parallel *= txns / (txns - verifier.processes * 4)
+        cached, _ = timed(verifier.verify, batch, find_utxo)
+    finally:
+        verifier.close()
+
+    print(f'serial:  {serial * 1000 / txns:.2f} ms per signature')
+    print(f'pool:    {parallel * 1000 / txns:.2f} ms per signature over {verifier.processes} processes '
+          f'({serial / parallel:.1f}x)')
+    print(f'cached:  {cached * 1000 / txns:.2f} ms per signature ({serial / cached:.0f}x)')
+
+
+BENCHMARKS = {
+    'mining': bench_mining,
+    'chain_scan': bench_chain_scan,
+    'utxo_memory': bench_utxo_memory,
+    'serialization': bench_serialization,
+    'json_decode': bench_json_decode,
+    'txid': bench_txid,
+    'merkle': bench_merkle,
+    'mempool': bench_mempool,
+    'signatures': bench_signatures,
+}
+
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or BENCHMARKS:
+        print(f'--- {name}')
+        BENCHMARKS[name]()
@@ -8,28 +8,68 @@ Will include data structures to allow for the addition or creation of blocks in
 import time
 import logging
 import binascii
+import multiprocessing
 
-from typing import NamedTuple, Iterable
-from utils import (
-    sha256d, sha256d_hexdigest, internal_order, uint256_from_compact,
-    compact_from_uint256
-)
-from transaction import Transaction, MerkleNode, UTXOManager
-from serialization import register_namedtuple
+from functools import cached_property
+from typing import NamedTuple, Iterable, List
+from utils import sha256d, internal_order, uint256_from_compact
+from transaction import Transaction, MerkleAccumulator, MerkleProof, UTXOManager
+from hashers import select_hasher, fastest_hasher
+from serialization import register_namedtuple, iter_deserialize_binary, deserialize_binary_head
 
 logging.basicConfig(
     level=getattr(logging, 'INFO'),
     format='[%(asctime)s][%(module)s:%(lineno)d] %(levelname)s %(message)s')
 logger = logging.getLogger(__name__)
 
+# the nonce is a uint32, once the whole space is exhausted the timestamp gets rolled
+NONCE_SPACE = 2 ** 32
 
-@register_namedtuple
-class Block(NamedTuple):
+# how many nonces a mining worker tries between checks of the stop event
+NONCE_CHECK_INTERVAL = 2 ** 14
+
+# how long (seconds) the parent waits on the workers before checking mine_interrupt
+MINE_POLL_INTERVAL = 0.1
+
+# what a coinbase may pay on top of the fees of its block
+BLOCK_SUBSIDY = 500000
+
+# the difficulty every block is mined at, there's no retargeting. REGTEST_NBITS is the easiest target
+# there is, for tests that need pretty much every nonce to be a solution
+BLOCK_NBITS = 504382016
+REGTEST_NBITS = 0x207fffff
+
+# set in every mining worker process by _init_mine_worker
+_stop_event = None
+
+
+def _init_mine_worker(stop_event):
+    global _stop_event
+    _stop_event = stop_event
+
+
+def _mine_nonce_range(task):
     """
-    https://bitcoin.org/en/developer-reference#block-headers
-    https://bitcoin.org/en/glossary/block
-    https://docs.python.org/3.6/library/collections.html#collections.namedtuple
+    Worker side of the parallel miner, searches the nonces in [start, end) and returns a tuple of
+    (nonce or None, hashes computed). The first worker to find a solution sets the shared stop event
+    so that every other worker bails out.
     """
+    hasher_name, template, target, start, end = task
+    hasher = select_hasher(hasher_name)
+
+    for batch_start in range(start, end, NONCE_CHECK_INTERVAL):
+        if _stop_event.is_set():
+            return None, batch_start - start
+
+        nonce = hasher.scan(template, target, batch_start, min(batch_start + NONCE_CHECK_INTERVAL, end))
+        if nonce is not None:
+            _stop_event.set()
+            return nonce, nonce - start + 1
+
+    return None, end - start
+
+
+class BlockFields(NamedTuple):
     version: int
     previous_block_hash: bytes
     merkle_tree_hash: bytes
@@ -38,6 +78,21 @@ class Block(NamedTuple):
     nonce: int
     txns: Iterable[Transaction]
 
+
+@register_namedtuple
+class Block(BlockFields):
+    """
+    https://bitcoin.org/en/developer-reference#block-headers
+    https://bitcoin.org/en/glossary/block
+    https://docs.python.org/3.6/library/collections.html#collections.namedtuple
+
+    Subclassing the NamedTuple gives every block a __dict__, which is where the id gets memoized.
+    Blocks are immutable, _replace returns a new block with an empty cache.
+    """
+
+    # the header ints are uint32 on the wire, see serialization.register_namedtuple
+    fixed_width_fields = {'version': 'I', 'timestamp': 'I', 'nbits': 'I', 'nonce': 'I'}
+
     @property
     def transaction_fees(self):
         """
@@ -45,23 +100,22 @@ class Block(NamedTuple):
         """
         fees_dict = {}
 
-        def utxo_from_block(txin, block=self):
-            tx = [t.txouts for t in block.txns if t.id == txin.outpoint.txid]
-            if tx:
-                return tx[0][txin.outpoint.txout_idx]
-            elif block.previous_block_hash:
+        txns_by_id = {txn.id: txn for txn in self.txns}
+
+        def utxo_from_chain(txin):
+            """
+            the spent output is either created earlier in this block or somewhere in the active chain
+            """
+            txid, txout_idx = txin.outpoint
+            txn = txns_by_id.get(txid)
+            if not txn:
                 from chainmanager import ChainManager
-                chain_mgr = ChainManager()
-                prev_block = chain_mgr.find_by_id(block.previous_block_hash)
-                if not prev_block:
-                    return None
+                txn, _, _ = ChainManager().locate_txn(txid)
 
-                return utxo_from_block(txin, prev_block)
-            else:
-                return None
+            return txn.txouts[txout_idx] if txn else None
 
         def find_utxo(txin):
-            return UTXOManager().utxo_set.get(txin.outpoint) or utxo_from_block(txin)
+            return UTXOManager().utxo_set.get(txin.outpoint) or utxo_from_chain(txin)
 
         for txn in self.txns:
             if txn.is_coinbase:
@@ -102,7 +156,7 @@ class Block(NamedTuple):
     def header_hash(self) -> bytes:
         return self._base_hash+internal_order(self.nonce)
 
-    @property
+    @cached_property
     def id(self):
         return sha256d(self.header_hash)
 
@@ -110,28 +164,37 @@ class Block(NamedTuple):
     def target(self):
         return uint256_from_compact(self.nbits)
 
-    def mine(self):
+    def mine(self, processes=1, hasher=None, template: 'BlockTemplate' = None):
         """
         Since NamedTuples are immutable, we need to return a new block as _replace really returns a new version of 
         the object
+
+        processes > 1 splits the nonce search across a process pool, None uses every core
+        hasher is the name of a backend in hashers.hasher_registry, None picks the fastest one available
+        template is the BlockTemplate self came out of, once the nonce space is exhausted it hands out a
+        new coinbase instead of the timestamp getting rolled
         """
 
         # clears the mine_interrupt Event, sets it
         from chainmanager import ChainManager
         ChainManager.mine_interrupt.clear()
 
+        if processes is None or processes > 1:
+            return self._mine_parallel(processes or multiprocessing.cpu_count(), hasher, template)
+
         start = time.time()
-        nonce = 0
-        target = self.target 
+        block = self
+        hasher = select_hasher(hasher)
+
+        while True:
+            nonce = hasher.scan(block._base_hash, block.target, 0, NONCE_SPACE)
+            if nonce is not None:
+                break
 
-        # if we've explored all possible uint32, we can change either timestamp or transactions (merkle hash)
-        template = self._base_hash
-        while int(sha256d_hexdigest(template+internal_order(nonce)), 16) >= target:
-            nonce += 1
-            if nonce % 1000000 == 0 and ChainManager.mine_interrupt.is_set():
-                logger.info(f'sanity check: {nonce}')
+            # if we've explored all possible uint32, we can change either timestamp or transactions (merkle hash)
+            block = block._roll(template)
 
-        new_block = self._replace(nonce=nonce)
+        new_block = block._replace(nonce=nonce)
 
         # In case we find the nonce right away
         duration = int(time.time() - start) or 0.001
@@ -140,27 +203,156 @@ class Block(NamedTuple):
 
         return new_block
 
+    def _roll(self, template: 'BlockTemplate' = None) -> 'Block':
+        """
+        a fresh header to search once the nonce space is exhausted, a new coinbase when mining a
+        template, the next timestamp otherwise
+        """
+        if template is not None:
+            logger.info(f'[mining] exhausted the nonce space, refreshing the coinbase')
+            return template.refresh_coinbase()._replace(timestamp=self.timestamp)
+
+        logger.info(f'[mining] exhausted the nonce space, rolling timestamp')
+        return self._replace(timestamp=self.timestamp + 1)
+
+    def _mine_parallel(self, processes, hasher=None, template: 'BlockTemplate' = None):
+        """
+        Splits the uint32 nonce space into one range per worker. As soon as a worker finds a solution or
+        ChainManager.mine_interrupt is set (a new block got accepted) all of the workers are stopped.
+        Returns None if the mining was interrupted.
+        """
+        from chainmanager import ChainManager
+
+        start = time.time()
+        hashes = 0
+        block = self
+        hasher = hasher or fastest_hasher()
+        step = -(-NONCE_SPACE // processes)
+
+        ctx = multiprocessing.get_context()
+        stop_event = ctx.Event()
+
+        with ctx.Pool(processes, initializer=_init_mine_worker, initargs=(stop_event,)) as pool:
+            while True:
+                stop_event.clear()
+                header_prefix = block._base_hash
+                tasks = [
+                    (hasher, header_prefix, block.target, lo, min(lo + step, NONCE_SPACE))
+                    for lo in range(0, NONCE_SPACE, step)
+                ]
+
+                found = None
+                results = pool.imap_unordered(_mine_nonce_range, tasks)
+                for _ in tasks:
+                    while True:
+                        try:
+                            nonce, done = results.next(timeout=MINE_POLL_INTERVAL)
+                            break
+                        except multiprocessing.TimeoutError:
+                            if ChainManager.mine_interrupt.is_set():
+                                stop_event.set()
+
+                    hashes += done
+                    if nonce is not None and (found is None or nonce < found):
+                        found = nonce
+
+                if ChainManager.mine_interrupt.is_set():
+                    logger.info(f'[mining] interrupted after {hashes} hashes')
+                    return None
+
+                if found is not None:
+                    break
+
+                # we've explored all possible uint32, roll the timestamp or the coinbase and start over
+                block = block._roll(template)
+
+        new_block = block._replace(nonce=found)
+
+        duration = int(time.time() - start) or 0.001
+        khs = (hashes // duration) // 1000
+        logger.info(
+            f'[mining] block found! {duration} s - {khs} KH/s over {processes} processes - {new_block.id}')
+
+        return new_block
+
+    def merkle_proofs(self, txids: Iterable[bytes]) -> List[MerkleProof]:
+        """
+        proofs for every txid of this block in one tree walk, None for the ones that aren't in it
+        """
+        positions = {txn.id: position for position, txn in enumerate(self.txns)}
+        txids = list(txids)
+        found = iter(MerkleAccumulator(self.txns).proofs(
+            (txid, positions[txid]) for txid in txids if txid in positions
+        ))
+        return [next(found) if txid in positions else None for txid in txids]
+
     @classmethod
-    def assemble_and_solve_block(cls, prev_block_hash, pay_coinbase_to_addr, txns=[]):
+    def stream_deserialize(cls, stream):
         """
-        Construct a Block by pulling transactions from the mempool, the mine it
+        Reads a binary serialized block off a file or socket (socket.makefile('rb')). Yields the header
+        first, as a Block without txns, then the transactions one by one, so validation can start before
+        the whole block is in memory.
+        """
+        return iter_deserialize_binary(cls, stream, 'txns')
+
+    @classmethod
+    def deserialize_header(cls, data):
+        """
+        the header of a binary serialized block, as a Block without txns, none of the txns are decoded
+        """
+        return deserialize_binary_head(cls, data, 'txns')
+
+    @classmethod
+    def assemble_and_solve_block(cls, prev_block_hash, pay_coinbase_to_addr, txns=None):
+        """
+        Construct a Block by pulling transactions from the mempool, the mine it. Passing txns skips the
+        mempool and uses those instead.
         """
         block = cls(
             version=0,
             previous_block_hash=prev_block_hash,
             merkle_tree_hash='',
             timestamp=int(time.time()),
-            nbits=504382016,
+            nbits=BLOCK_NBITS,
             nonce=0,
-            txns=txns
+            txns=txns or []
         )
-        fees = block.fees
-        logger.info(f'fees are {fees}')
-        coinbase_txn = Transaction.create_coinbase(pay_coinbase_to_addr, 500000 + fees)
+        if txns is None:
+            from mempool import Mempool
+            block = Mempool().select_from_mempool(block)
+
+        template = BlockTemplate(block, pay_coinbase_to_addr)
+        return template.block.mine(template=template)
+
 
-        block = block._replace(txns=[coinbase_txn, *block.txns])
-        block = block._replace(
-            merkle_tree_hash=MerkleNode.generate_root_from_transaction(block.txns).value)
+class BlockTemplate:
+    """
+    A block being mined: the merkle tree of its txns is built once, with the coinbase as its first leaf.
+    Refreshing the coinbase, for new fees or once the nonce space of the header is exhausted, only
+    swaps that leaf and rehashes its O(log n) path to the root.
+    """
+
+    def __init__(self, block: Block, pay_coinbase_to_addr):
+        """
+        block has the header fields and the txns to mine, without a coinbase
+        """
+        self.pay_coinbase_to_addr = pay_coinbase_to_addr
+        self.fees = block.fees
+        logger.info(f'fees are {self.fees}')
+
+        coinbase = Transaction.create_coinbase(pay_coinbase_to_addr, BLOCK_SUBSIDY + self.fees)
+        self.merkle = MerkleAccumulator([coinbase, *block.txns])
+        self.block = block._replace(txns=[coinbase, *block.txns], merkle_tree_hash=self.merkle.root)
+
+    def refresh_coinbase(self, fees: int = None) -> Block:
+        """
+        a new coinbase, paying fees if given, whose unlock_sig doubles as the extra nonce
+        """
+        if fees is not None:
+            self.fees = fees
 
-        return block.mine()
+        coinbase = Transaction.create_coinbase(self.pay_coinbase_to_addr, BLOCK_SUBSIDY + self.fees)
+        self.merkle.replace(0, coinbase)
+        self.block = self.block._replace(txns=[coinbase, *self.block.txns[1:]], merkle_tree_hash=self.merkle.root)
+        return self.block
 
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""
+Block storage component
+
+Blocks are appended to a single data file as length prefixed binary serialized blocks, a separate index file
+holds one fixed width record per block: (block hash, offset, length). Reads go through an mmap of the
+data file, so reopening the store only reads the index and never parses a block it isn't asked for.
+The undo records of connected blocks are kept the same way, in a data and index file of their own.
+"""
+
+import os
+import mmap
+import struct
+import logging
+
+from typing import Dict, Iterable, NamedTuple, Tuple
+from blockchain import Block
+from transaction import UnspentTxOut
+from serialization import register_namedtuple
+
+logger = logging.getLogger(__name__)
+
+LENGTH_PREFIX = struct.Struct('<I')
+
+# block hash, offset of the length prefix in the data file, length of the serialized block or undo record
+INDEX_RECORD = struct.Struct('<32sQI')
+
+
+@register_namedtuple
+class BlockUndo(NamedTuple):
+    """
+    the utxos a block spent when it got connected to the active chain, disconnecting the block puts
+    them back as they were. They're kept in the block store next to the block, so a restart can still
+    disconnect blocks connected before it
+    """
+    spent_utxos: Iterable[UnspentTxOut]
+
+
+class MemoryBlockStore:
+    """
+    BlockStore's interface over a dict, where ChainManager keeps block bodies unless it's given a
+    BlockStore
+    """
+
+    def __init__(self):
+        self.blocks: Dict[bytes, Block] = {}
+        self.undo: Dict[bytes, BlockUndo] = {}
+
+    def __contains__(self, block_hash) -> bool:
+        return block_hash in self.blocks
+
+    def __len__(self) -> int:
+        return len(self.blocks)
+
+    def hashes(self) -> Iterable[bytes]:
+        return iter(self.blocks)
+
+    def append(self, block: Block):
+        self.blocks.setdefault(block.id, block)
+
+    def get(self, block_hash) -> Block:
+        return self.blocks.get(block_hash)
+
+    def get_header(self, block_hash) -> Block:
+        block = self.blocks.get(block_hash)
+        return block and block._replace(txns=[])
+
+    def append_undo(self, block_hash, undo: BlockUndo):
+        self.undo[block_hash] = undo
+
+    def get_undo(self, block_hash) -> BlockUndo:
+        return self.undo.get(block_hash)
+
+    def close(self):
+        pass
+
+
+class RecordFile:
+    """
+    An append-only data file of length prefixed records with its index file of fixed width records:
+    (key, offset, length). Reads go through an mmap of the data file
+    """
+
+    def __init__(self, directory: str, name: str):
+        self.data_path = os.path.join(directory, f'{name}.dat')
+        self.index_path = os.path.join(directory, f'{name}.idx')
+
+        # key -> (offset, length), in the order the records got appended
+        self.index: Dict[bytes, Tuple[int, int]] = {}
+
+        with open(self.index_path, 'ab+') as index_file:
+            index_file.seek(0)
+            raw_index = index_file.read()
+
+        # a torn write can leave a partial record at the end, the data it pointed at is unreachable
+        usable = len(raw_index) - len(raw_index) % INDEX_RECORD.size
+        for key, offset, length in INDEX_RECORD.iter_unpack(raw_index[:usable]):
+            self.index[key] = (offset, length)
+
+        self.data_file = open(self.data_path, 'ab+')
+        self.index_file = open(self.index_path, 'ab')
+        if usable != len(raw_index):
+            logger.info(f'dropping a partial index record from {self.index_path}')
+            self.index_file.truncate(usable)
+
+        self._map = None
+
+    def __contains__(self, key) -> bool:
+        return key in self.index
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def keys(self) -> Iterable[bytes]:
+        return iter(self.index)
+
+    def append(self, key: bytes, payload: bytes):
+        """
+        the data is fsynced to disk before the index record that points at it is written, and the record
+        before append returns
+        """
+        if key in self.index:
+            return
+
+        offset = self.data_file.seek(0, os.SEEK_END)
+        self.data_file.write(LENGTH_PREFIX.pack(len(payload)) + payload)
+        self.data_file.flush()
+        os.fsync(self.data_file.fileno())
+
+        self.index_file.write(INDEX_RECORD.pack(key, offset, len(payload)))
+        self.index_file.flush()
+        os.fsync(self.index_file.fileno())
+        self.index[key] = (offset, len(payload))
+
+    def read(self, key) -> memoryview:
+        """
+        zero copy view of the record, remaps the file if it grew since the last read. The old map stays
+        alive for as long as views into it do.
+        """
+        offset, length = self.index[key]
+        end = offset + LENGTH_PREFIX.size + length
+
+        if self._map is None or len(self._map) < end:
+            self._map = mmap.mmap(self.data_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        return memoryview(self._map)[offset + LENGTH_PREFIX.size:end]
+
+    def close(self):
+        self._map = None
+        self.data_file.close()
+        self.index_file.close()
+
+
+class BlockStore:
+    """
+    the blocks, keyed by their hash, and next to them the undo records of the blocks that got connected
+    """
+
+    def __init__(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self.blocks = RecordFile(directory, 'blocks')
+        self.undo = RecordFile(directory, 'undo')
+
+    @property
+    def index_path(self) -> str:
+        return self.blocks.index_path
+
+    def __contains__(self, block_hash) -> bool:
+        return block_hash in self.blocks
+
+    def __len__(self) -> int:
+        return len(self.blocks)
+
+    def hashes(self) -> Iterable[bytes]:
+        return self.blocks.keys()
+
+    def append(self, block: Block):
+        self.blocks.append(block.id, block.serialize_binary())
+
+    def read_raw(self, block_hash) -> memoryview:
+        return self.blocks.read(block_hash)
+
+    def get(self, block_hash) -> Block:
+        if block_hash not in self.blocks:
+            return None
+
+        with self.read_raw(block_hash) as raw:
+            return Block.deserialize_binary(raw)
+
+    def get_header(self, block_hash) -> Block:
+        """
+        the block's header as a Block without txns, only the header bytes get decoded
+        """
+        if block_hash not in self.blocks:
+            return None
+
+        with self.read_raw(block_hash) as raw:
+            return Block.deserialize_header(raw)
+
+    def append_undo(self, block_hash, undo: BlockUndo):
+        """
+        a block's undo record only depends on the chain below it, so reconnecting the block after a
+        reorg finds the one it got the first time
+        """
+        self.undo.append(block_hash, undo.serialize_binary())
+
+    def get_undo(self, block_hash) -> BlockUndo:
+        if block_hash not in self.undo:
+            return None
+
+        with self.undo.read(block_hash) as raw:
+            return BlockUndo.deserialize_binary(raw)
+
+    def close(self):
+        self.blocks.close()
+        self.undo.close()
@@ -1,14 +1,50 @@
 import logging 
+import itertools
 
-from typing import Iterable, Union
+from heapq import heappush, heappop
+from concurrent.futures import ThreadPoolExecutor
+
+from typing import Iterable, List, Union, Dict, NamedTuple, Tuple
 from threading import RLock, Event
 from utils import Singleton, with_lock
-from transaction import UTXOManager
+from transaction import Transaction, UTXOManager, MerkleAccumulator, MerkleProof
 from blockchain import Block
 from mempool import Mempool
+from validation import ValidationError
+from headerchain import HeaderChain, HeaderRecord
+from blockstore import MemoryBlockStore, BlockUndo
 
 logger = logging.getLogger(__name__)
 
+# how many block bodies headers-first sync downloads at once
+BODY_FETCHERS = 8
+
+
+class BlockIndexEntry(NamedTuple):
+    """
+    where a block lives: its header record and chain_idx, 0 is the active chain and anything above is
+    side_branches[chain_idx-1]. The body is in the block store
+    """
+    record: HeaderRecord
+    chain_idx: int
+
+    @property
+    def height(self) -> int:
+        return self.record.height
+
+    @property
+    def chainwork(self) -> int:
+        return self.record.chainwork
+
+
+class TxIndexEntry(NamedTuple):
+    """
+    where a transaction of the active chain lives: the block, its height and the txn's position in it
+    """
+    block_hash: bytes
+    height: int
+    position: int
+
 
 class ChainManager(metaclass=Singleton):
     """
@@ -20,15 +56,117 @@ class ChainManager(metaclass=Singleton):
     ACTIVE_CHAIN_IDX = 0
 
     def __init__(self):
-        self.active_chain: Iterable[Block] = []
-        self.side_branches: Iterable[Iterable[Block]] = []
+        # the chains hold the header records of their blocks, the active chain's position is the height.
+        # Bodies are only loaded, through get_block, when their transactions are needed
+        self.active_chain: List[HeaderRecord] = []
+        self.side_branches: List[List[HeaderRecord]] = []
         self.orphan_blocks: Iterable[Block] = []
 
+        # block hash -> BlockIndexEntry for every block of the active chain and the side branches,
+        # only mutated while holding chain_lock
+        self.block_index: Dict[bytes, BlockIndexEntry] = {}
 
-    def find_by_id(self, hash_id, chain=None):
-        chain = chain or self.active_chain
-        result = [block for block in chain[::-1] if block.id == hash_id]
-        return result[0] if result else None
+        # txid -> TxIndexEntry for every transaction of the active chain
+        self.tx_index: Dict[bytes, TxIndexEntry] = {}
+
+        # where the body of every block in block_index is kept, along with the BlockUndo of every block
+        # that got connected. Set a blockstore.BlockStore to keep them on disk instead of in memory
+        self.block_store = MemoryBlockStore()
+
+        # validation.BlockValidator every block has to pass before it changes any state, if set
+        self.block_validator = None
+
+        # header records of every block we know of, with or without its body
+        self.header_chain = HeaderChain()
+
+        # (-chainwork, seq, block hash) of side branch blocks that could outweigh the active chain, the
+        # most work on top. Items of blocks that got connected or dropped since are pruned off the top
+        self.tip_candidates: List[Tuple[int, int, bytes]] = []
+        self._seq = itertools.count()
+
+        # hashes of blocks that failed to connect in a reorg and of every block built on them
+        self.invalid_blocks = set()
+
+    def chain_for_idx(self, chain_idx: int) -> List[HeaderRecord]:
+        return self.active_chain if chain_idx == self.ACTIVE_CHAIN_IDX else self.side_branches[chain_idx-1]
+
+    @property
+    def tip(self) -> Union[HeaderRecord, None]:
+        return self.active_chain[-1] if self.active_chain else None
+
+    def _index_chain(self, chain_idx: int):
+        for record in self.chain_for_idx(chain_idx):
+            self.block_index[record.hash] = BlockIndexEntry(record, chain_idx)
+
+    def _reindex_side_branches(self):
+        """
+        side branch indexes shift whenever a reorg pops or appends a branch
+        """
+        for chain_idx in range(1, len(self.side_branches) + 1):
+            self._index_chain(chain_idx)
+
+    @with_lock(chain_lock)
+    def load(self, block_store, index_txns=False):
+        """
+        Rebuilds the header chain, the active chain, the side branches and block_index from block_store
+        after a restart. Only the header of each block is decoded. The blocks come back in the order they
+        were accepted, parents first.
+
+        The active chain ends at the block the utxo set was last flushed at, when the utxo store records
+        one, otherwise at the most work. A side branch with more work gets reorged to on the next block.
+        Disconnecting a block reads its undo record from the store. txids are only in the bodies though,
+        index_txns reads the active chain's bodies to rebuild tx_index. Without it, locate_txn only finds
+        txns of blocks connected after the restart.
+        """
+        self.block_store = block_store
+        hashes = list(block_store.hashes())
+        for block_hash in hashes:
+            self.header_chain.add_header(block_store.get_header(block_hash), validate=False)
+
+        tip = self.header_chain.get(getattr(UTXOManager().utxo_set, 'best_block', None))
+        if tip is None:
+            logger.warning('the utxo set is not at a stored block, it has to be rebuilt')
+            tip = self.header_chain.best_tip
+        if tip is None:
+            return
+
+        self.active_chain = HeaderChain.path(tip)
+        self._index_chain(self.ACTIVE_CHAIN_IDX)
+
+        # same branching as add_block_to_chain, a block extends the branch it's the tip of or starts one
+        branch_by_tip = {}
+        for block_hash in hashes:
+            if block_hash in self.block_index:
+                continue
+
+            record = self.header_chain.get(block_hash)
+            branch = branch_by_tip.pop(record.previous_block_hash, None)
+            if branch is None:
+                branch = []
+                self.side_branches.append(branch)
+            branch.append(record)
+            branch_by_tip[record.hash] = branch
+
+        self._reindex_side_branches()
+        for branch in self.side_branches:
+            heappush(self.tip_candidates, (-branch[-1].chainwork, next(self._seq), branch[-1].hash))
+
+        if index_txns:
+            for record in self.active_chain:
+                for position, txn in enumerate(self.get_block(record.hash).txns):
+                    self.tx_index[txn.id] = TxIndexEntry(record.hash, record.height, position)
+
+        logger.info(f'loaded {len(hashes)} blocks, height={tip.height} side branches={len(self.side_branches)}')
+
+    def get_block(self, block_hash) -> Block:
+        """
+        the body of any block we've seen, from the block store
+        """
+        return self.block_store.get(block_hash)
+
+    def find_by_id(self, hash_id, chain=None) -> Union[Block, None]:
+        record = self.locate_block(hash_id, chain=chain or self.active_chain)[0]
+        return record and self.get_block(record.hash)
 
     @with_lock(chain_lock)
     def add_block_to_chain(self, block: Block, doing_reorg=False) -> Union[None, Block]:
@@ -46,174 +184,333 @@ class ChainManager(metaclass=Singleton):
         chain_idx = self.ACTIVE_CHAIN_IDX
 
         if block.previous_block_hash or self.active_chain:
-            prev_block, _, chain_idx = self.locate_block(block.previous_block_hash)
-
-            # if prev_block isn't the latest block, it's a new block
-            if prev_block != self.active_chain[-1]:
-                chain_idx += 1
-
-        # If validate_block returned a non-existent chain index, we're creating
-        # a new side branch
-        if chain_idx != self.ACTIVE_CHAIN_IDX and len(self.side_branches) < chain_idx:
+            prev_record, _, chain_idx = self.locate_block(block.previous_block_hash)
+
+            if not prev_record:
+                logger.info(f'orphan block {block.id}')
+                self.orphan_blocks.append(block)
+                return None
+
+            # if prev_record isn't the latest block of its chain, we're forking off a new side branch
+            if self.chain_for_idx(chain_idx)[-1] is not prev_record:
+                chain_idx = len(self.side_branches) + 1
+
+        if self.block_validator is not None:
+            prev_timestamps = self.header_chain.timestamps(self.header_chain.get(block.previous_block_hash))
+            try:
+                self.block_validator.validate(block, prev_timestamps, connect=chain_idx == self.ACTIVE_CHAIN_IDX)
+            except ValidationError as e:
+                logger.info(f'rejected block {block.id} at {e}')
+                return None
+
+        if chain_idx > len(self.side_branches):
             logger.info(
                 f'creating a new side branch (idx {chain_idx}) '
                 f'for block {block.id}')
             self.side_branches.append([])
 
+        record = self.header_chain.add_header(block, validate=False)
+
         logger.info(f'connecting block {block.id} to chain {chain_idx}')
-        chain = (self.active_chain if chain_idx ==
-                 self.ACTIVE_CHAIN_IDX else self.side_branches[chain_idx-1])
-        chain.append(block)
+        self.chain_for_idx(chain_idx).append(record)
+        self.block_index[block.id] = BlockIndexEntry(record, chain_idx)
+
+        if chain_idx != self.ACTIVE_CHAIN_IDX:
+            if block.previous_block_hash in self.invalid_blocks:
+                self.invalid_blocks.add(block.id)
+            else:
+                heappush(self.tip_candidates, (-record.chainwork, next(self._seq), block.id))
+
+        self.block_store.append(block)
 
         # If we added to the active chain, perform upkeep on utxo_set and mempool
         if chain_idx == self.ACTIVE_CHAIN_IDX:
+            # let's clear the mempool of the mined transactions and the ones they double spend
+            Mempool().remove_for_block(block)
+
             outpoints_to_remove = set()
-            for txn in block.txns:
-                # let's clear the mempool, as this transaction has been accepted and mined
-                Mempool().mempool_dict.pop(txn.id, None)
+            for position, txn in enumerate(block.txns):
+                self.tx_index[txn.id] = TxIndexEntry(block.id, record.height, position)
 
                 # let's also add the utxo to the current set
                 for i, txout in enumerate(txn.txouts):
-                    utxo_manager.add_to_utxo(txout, txn, i, txn.is_coinbase, len(chain))
+                    utxo_manager.add_to_utxo(txout, txn, i, txn.is_coinbase, record.height + 1)
 
                 # if the txn isn't coinbase let's remove the spent utxos
                 if not txn.is_coinbase:
                     for txin in txn.txins:
                         outpoints_to_remove.add(txin.outpoint)
 
-            for outpoint in outpoints_to_remove:                
-                utxo_manager.rm_from_utxo(*outpoint)
+            self.block_store.append_undo(block.id, BlockUndo(spent_utxos=[
+                utxo_manager.rm_from_utxo(*outpoint) for outpoint in outpoints_to_remove
+            ]))
+            utxo_manager.flush(block.id)
                 
         if (not doing_reorg and self.reorg_if_necessary()) or chain_idx == self.ACTIVE_CHAIN_IDX:
             ChainManager.mine_interrupt.set()
             logger.info(
                 f'block accepted '
-                f'height={len(self.active_chain) - 1} txns={len(block.txns)}'
+                f'height={self.tip.height} txns={len(block.txns)}'
             )
 
         return chain_idx
 
+    def sync_headers_first(self, peer, workers=BODY_FETCHERS) -> int:
+        """
+        Headers-first sync from peer, anything with a get_headers(locator) returning a list of headers
+        (Blocks without txns) and a get_block(block_hash) returning the whole block.
+
+        First the headers are pulled until the peer has no more, each checked for proof of work and
+        timestamp as it comes in, so an invalid chain is turned down before any body is downloaded. This
+        holds chain_lock, blocks connected meanwhile would race it for header_chain, and an invalid
+        header drops every header the peer sent this sync. Then the bodies of the best header chain we don't have yet are fetched workers at a time and
+        connected in order as they arrive. Returns the number of blocks connected.
+        """
+        with self.chain_lock:
+            added = []
+            while True:
+                headers = [header for header in peer.get_headers(self.header_chain.locator())
+                           if header.id not in self.header_chain]
+                if not headers:
+                    break
+
+                try:
+                    for header in headers:
+                        added.append(self.header_chain.add_header(header))
+                except ValidationError as e:
+                    # the headers before it lead up to an invalid one, none of them is worth a tip
+                    logger.info(f'[sync] peer sent an invalid header, {e}')
+                    self.header_chain.discard(added)
+                    return 0
+
+            wanted = [
+                record.hash for record in HeaderChain.path(self.header_chain.best_tip)
+                if record.hash not in self.block_index
+            ]
+        logger.info(f'[sync] headers synced to height {self.header_chain.best_tip.height}, '
+                    f'fetching {len(wanted)} blocks')
+
+        connected = 0
+        with ThreadPoolExecutor(workers) as pool:
+            fetches = [pool.submit(peer.get_block, block_hash) for block_hash in wanted]
+            for block_hash, fetch in zip(wanted, fetches):
+                block = fetch.result()
+                if block is None or block.id != block_hash:
+                    logger.info(f'[sync] peer sent the wrong body for {block_hash}')
+                    break
+                if self.add_block_to_chain(block) is None:
+                    break
+                connected += 1
+
+            # nothing after a body that got turned down can connect, drop the fetches that haven't started
+            pool.shutdown(cancel_futures=True)
+
+        return connected
+
     def get_current_height(self):
-        return len(self.active_chain)
+        return self.tip.height + 1 if self.tip else 0
 
-    def locate_block(self, block_hash: str, chain=None) -> (Block, int, int):
+    @with_lock(chain_lock)
+    def locate_block(self, block_hash: str, chain=None) -> (HeaderRecord, int, int):
         """
-        returns a tuple of block obj, height, chain id
+        returns a tuple of header record, height, chain id, if chain is passed the block has to be in that
+        chain
         """
-        chains = [chain] if chain else [self.active_chain, *self.side_branches]
-        for chain_idx, chain in enumerate(chains):
-            for height, block in enumerate(chain):
-                if block.id == block_hash:
-                    return (block, height, chain_idx)
-        return (None, None, None)
+        entry = self.block_index.get(block_hash)
+        if not entry or (chain and self.chain_for_idx(entry.chain_idx) is not chain):
+            return (None, None, None)
+        return entry.record, entry.height, entry.chain_idx
 
     @with_lock(chain_lock)
-    def remove_block_from_chain(self, block, chain=None):
+    def remove_block_from_chain(self, block, chain=None) -> HeaderRecord:
         """
-        removes block from the chain
+        removes block, a Block or its header record, from the tip of chain and returns its record
         """
         chain = chain or self.active_chain
-        assert block == chain[-1]
+        assert block.id == chain[-1].id
+        block = self.get_block(block.id)
 
         utxo_manager = UTXOManager()
+        undo = self.block_store.get_undo(block.id)
+
+        # put back the spent utxos before dropping the created ones, that way an output created and
+        # spent within this block ends up removed as well
+        if undo:
+            for utxo in undo.spent_utxos:
+                utxo_manager.add_utxo(utxo)
+        else:
+            for txn in block.txns:
+                for txin in txn.txins:
+                    # if it isn't a coinbase
+                    if not txin.outpoint:
+                        continue
+
+                    found = self.find_txout_for_txin(txin, chain)
+                    if found:
+                        utxo_manager.add_to_utxo(*found)
+                    else:
+                        logger.warning(f'block {block.id} spends {txin.outpoint} which is nowhere in the chain')
+
         for txn in block.txns:
             # let's re-add the transaction into the mempool
-            Mempool().add_txn_to_mempool(txn, force=True)
+            if not txn.is_coinbase:
+                Mempool().add_txn_to_mempool(txn, force=True)
 
-            for txin in txn.txins:
-                # if it isn't a coinbase
-                if txin.outpoint:
-                    utxo_manager.add_to_utxo(*find_txout_for_txin(txin, chain))
             for i in range(len(txn.txouts)):
                 utxo_manager.rm_from_utxo(txn.id, i)
 
+            if chain is self.active_chain:
+                self.tx_index.pop(txn.id, None)
+
+        utxo_manager.flush(block.previous_block_hash)
+
         logger.info(f'block {block.id} disconnected')
+        self.block_index.pop(block.id, None)
         return chain.pop()
 
     @with_lock(chain_lock)
     def reorg_if_necessary(self):
         """
-        Reorganization happens when the current active chain has diverged from the best longest chain.
-        This occurs when the side branch height is greater than the active chain
-
-        There are many ways to compare, including chainwork
+        Reorganization happens when a side branch has more cumulative work than the active chain,
         https://bitcoin.stackexchange.com/questions/5540/what-does-the-term-longest-chain-mean
-        """
 
-        # create a frozen, shallow copy of side_branches
+        Only the top of tip_candidates has to be looked at, if it doesn't beat the active tip nothing
+        does. Ties go to the chain seen first.
+        """
         reorged = False
-        frozen_side_branch = list(self.side_branches)
 
-        for chain_idx, chain in enumerate(frozen_side_branch, 1):
-            fork_block, fork_idx, _ = self.locate_block(chain[0].previous_block_hash, self.active_chain)
-            
-            active_height = len(self.active_chain)
-            branch_height = len(chain) + fork_idx
+        while self.tip_candidates and not reorged:
+            neg_chainwork, _, block_hash = self.tip_candidates[0]
+            entry = self.block_index.get(block_hash)
+            if entry is None or entry.chain_idx == self.ACTIVE_CHAIN_IDX:
+                heappop(self.tip_candidates)
+                continue
 
-            if branch_height > active_height:
-                logger.info(
-                    f'Attempting reorg of idx {branch_idx} to active_chain'
-                    f"new height of {branch_height} (vs. {active_height})"
-                )
-                reorged |= self.try_reorg(chain, branch_idx, fork_idx)
+            active_chainwork = self.tip.chainwork
+            if -neg_chainwork <= active_chainwork:
+                break
+
+            logger.info(
+                f'Attempting reorg to {block_hash}, '
+                f'chainwork {-neg_chainwork} (vs. {active_chainwork})'
+            )
+            reorged = self.try_reorg(block_hash)
+            if not reorged:
+                heappop(self.tip_candidates)
 
         return reorged
 
     @with_lock(chain_lock)
-    def try_reorg(self, chain, branch_idx, fork_idx) -> bool:
+    def try_reorg(self, block_hash) -> bool:
         """
-        tries to organize the active branch
+        tries to make the chain ending in the side branch block block_hash the active chain, the fork
+        point comes from the header records' parent pointers. The blocks to connect can run through
+        several side branches, each of which they're a prefix of
         """
-        fork_block = self.active_chain[fork_idx]
+        tip = self.header_chain.get(block_hash)
+        fork = HeaderChain.fork_point(self.tip, tip)
+        branch = HeaderChain.path(tip, fork.height + 1)
+
+        if any(record.hash in self.invalid_blocks for record in branch):
+            self.invalid_blocks.add(block_hash)
+            return False
 
         def disconnect_to_fork():
             """
             while the latest block on the active chain does not equal to the fork block remove
             """
-            while self.active_chain[-1].id != fork_block.id:
-                yield self.remove_block_from_chain(self.active_chain[-1])
+            while self.tip is not fork:
+                yield self.remove_block_from_chain(self.tip)
 
-        removed_from_active = list(disconnect_to_fork())[::-1]
-        assert chain[-1].previous_block_hash == self.active_chain[-1].id
+        old_active = list(disconnect_to_fork())[::-1]
+        assert branch[0].parent is self.tip
 
         def rollback_reorg():
-            logger.info(f'reorg of idx {branch_idx} to active_chain failed, rolling back')
+            logger.info(f'reorg to {block_hash} failed, rolling back')
             list(disconnect_to_fork()) # clear the self.active_chain
 
-            for block in old_active:
-                assert self.add_block_to_chain(block, doing_reorg=True) == self.ACTIVE_CHAIN_IDX
+            for record in old_active:
+                assert self.add_block_to_chain(self.get_block(record.hash), doing_reorg=True) == self.ACTIVE_CHAIN_IDX
+            self._reindex_side_branches()
 
-        for block in branch:
-            connected_idx = self.add_block_to_chain(block, doing_reorg=True)
+        for record in branch:
+            connected_idx = self.add_block_to_chain(self.get_block(record.hash), doing_reorg=True)
 
             # if we aren't adding to the active chain, then we need to abort
             if connected_idx != self.ACTIVE_CHAIN_IDX:
+                self.invalid_blocks.add(record.hash)
+                self.invalid_blocks.add(block_hash)
                 rollback_reorg()
                 return False
 
-        # now that branch_idx has been incorporated into the active_chain
-        # we can delete reference to branch_idx and put removed_from_active into sidechain
-        self.side_branches.pop(branch_idx - 1)
-        self.side_branches.append(old_active)
-
-        logger.info(f'chain reorg! New height: {len(self.active_chain)}, tip: {self.active_chain[-1].id}')
+        # the connected blocks are a prefix of every side branch they came from, what's left of those
+        # branches forks off the new active chain. The blocks removed from the active chain become a
+        # side branch of their own
+        connected = {record.hash for record in branch}
+        self.side_branches = [
+            remaining for remaining in (
+                [record for record in side_branch if record.hash not in connected] for side_branch in self.side_branches
+            ) if remaining
+        ]
+        if old_active:
+            self.side_branches.append(old_active)
+            heappush(self.tip_candidates, (-old_active[-1].chainwork, next(self._seq), old_active[-1].hash))
+        self._reindex_side_branches()
+
+        logger.info(f'chain reorg! New height: {self.get_current_height()}, tip: {self.tip.hash}')
         return True
 
-    @staticmethod
-    def txn_iterator(chain):
+    def txn_iterator(self, chain: Iterable[HeaderRecord]):
         return (
-            (txn, block, height)
-            for height, block in enumerate(chain) for txn in block.txns
+            (txn, block, record.height)
+            for record in chain for block in [self.get_block(record.hash)] for txn in block.txns
         )
 
-    @staticmethod
-    def find_txout_for_txin(txin, chain):
+    def locate_txn(self, txid) -> (Transaction, Block, int):
+        """
+        returns a tuple of txn obj, block obj, height for a transaction of the active chain
+        """
+        entry = self.tx_index.get(txid)
+        if not entry:
+            return (None, None, None)
+
+        block = self.get_block(entry.block_hash)
+        return (block.txns[entry.position], block, entry.height)
+
+    @with_lock(chain_lock)
+    def merkle_proofs(self, txids: Iterable[bytes]) -> Dict[bytes, Tuple[bytes, MerkleProof]]:
+        """
+        txid -> (block hash, MerkleProof) for every txid confirmed in the active chain, txids that aren't
+        are left out. The tree of each block is built once no matter how many of its txids are asked for.
+        """
+        by_block = {}
+        for txid in txids:
+            entry = self.tx_index.get(txid)
+            if entry:
+                by_block.setdefault(entry.block_hash, []).append((txid, entry.position))
+
+        proofs = {}
+        for block_hash, leaves in by_block.items():
+            tree = MerkleAccumulator(self.get_block(block_hash).txns)
+            for proof in tree.proofs(leaves):
+                proofs[proof.txid] = (block_hash, proof)
+
+        return proofs
+
+    def find_txout_for_txin(self, txin, chain=None):
         txid, txout_idx = txin.outpoint
 
-        for txn, block, height in txn_iterator(chain):
-            if txn.id == txid:
+        located = [self.locate_txn(txid)] if not chain or chain is self.active_chain else []
+
+        # tx_index only has the active chain's txns of blocks connected since the last load
+        if not located or not located[0][0]:
+            located = self.txn_iterator(chain or self.active_chain)
+
+        for txn, block, height in located:
+            if txn and txn.id == txid:
                 txout = txn.txouts[txout_idx]
-                return (txout, txn, txout_idx, txn.is_coinbase, height)
+                # utxos are at the height the chain had once their block got connected, see add_to_utxo
+                return (txout, txn, txout_idx, txn.is_coinbase, height + 1)
 
 
 
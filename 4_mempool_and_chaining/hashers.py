@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""
+Hasher backends for the mining loop
+
+Every backend answers the same question: which is the first nonce in [start, end) for which
+sha256d(template+nonce) is below the target. The pure python backend is the reference implementation,
+the numpy backend evaluates whole batches of nonces per call so the python overhead is paid per batch.
+"""
+
+import time
+import struct
+import hashlib
+import logging
+
+from functools import lru_cache
+from typing import Union
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger(__name__)
+
+# the nonce is appended to the header in internal (little endian) byte order
+NONCE_STRUCT = struct.Struct('<I')
+
+hasher_registry = {}
+
+
+def register_hasher(cls):
+    """
+    registry hook, the mining loop looks backends up by name
+    """
+    hasher_registry[cls.name] = cls
+    return cls
+
+
+def scan_nonces(template: bytes, target: int, start: int, end: int) -> Union[int, None]:
+    """
+    Returns the first nonce in [start, end) for which sha256d(template+nonce) is below target.
+
+    The template never changes, so it's hashed once and the sha256 midstate is copied for each nonce.
+    Digests are compared as raw big endian bytes against the target, which avoids the hex round trip.
+    """
+    midstate = hashlib.sha256(template)
+    target_bytes = target.to_bytes(32, byteorder='big')
+    pack_nonce = NONCE_STRUCT.pack
+    sha256 = hashlib.sha256
+
+    for nonce in range(start, end):
+        header = midstate.copy()
+        header.update(pack_nonce(nonce))
+        if sha256(header.digest()).digest() < target_bytes:
+            return nonce
+
+    return None
+
+
+class Hasher:
+    name = None
+
+    @classmethod
+    def available(cls) -> bool:
+        return True
+
+    def scan(self, template: bytes, target: int, start: int, end: int) -> Union[int, None]:
+        raise NotImplementedError
+
+
+@register_hasher
+class PythonHasher(Hasher):
+    """
+    one nonce at a time through hashlib, the reference implementation
+    """
+    name = 'python'
+
+    def scan(self, template, target, start, end):
+        return scan_nonces(template, target, start, end)
+
+
+SHA256_K = (
+    0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,
+    0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3, 0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174,
+    0xe49b69c1, 0xefbe4786, 0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+    0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147, 0x06ca6351, 0x14292967,
+    0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13, 0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85,
+    0xa2bfe8a1, 0xa81a664b, 0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+    0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a, 0x5b9cca4f, 0x682e6ff3,
+    0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208, 0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2,
+)
+
+SHA256_IV = (
+    0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a, 0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19,
+)
+
+
+@register_hasher
+class NumpyBatchHasher(Hasher):
+    """
+    SHA-256 written against uint32 arrays, every lane of the arrays is a different nonce.
+
+    The header blocks in front of the nonce are compressed once into a midstate, the remaining blocks
+    of batch_size headers live in one preallocated contiguous array where only the nonce bytes get
+    rewritten between batches. The target check runs over the whole batch at once.
+    """
+    name = 'numpy'
+
+    def __init__(self, batch_size=2 ** 14):
+        self.batch_size = batch_size
+        self._k = [np.array([k], dtype=np.uint32) for k in SHA256_K]
+
+    @classmethod
+    def available(cls):
+        return np is not None
+
+    @staticmethod
+    def _rotr(x, n):
+        return (x >> np.uint32(n)) | (x << np.uint32(32 - n))
+
+    def _compress(self, state, words):
+        """
+        one sha256 compression, words are the 16 message words, either per lane arrays or
+        single element arrays for the words that are the same for every lane
+        """
+        rotr = self._rotr
+        w = list(words)
+        for i in range(16, 64):
+            s0 = rotr(w[i-15], 7) ^ rotr(w[i-15], 18) ^ (w[i-15] >> np.uint32(3))
+            s1 = rotr(w[i-2], 17) ^ rotr(w[i-2], 19) ^ (w[i-2] >> np.uint32(10))
+            w.append(w[i-16] + s0 + w[i-7] + s1)
+
+        a, b, c, d, e, f, g, h = state
+        for i in range(64):
+            s1 = rotr(e, 6) ^ rotr(e, 11) ^ rotr(e, 25)
+            ch = (e & f) ^ (~e & g)
+            t1 = h + s1 + ch + self._k[i] + w[i]
+            s0 = rotr(a, 2) ^ rotr(a, 13) ^ rotr(a, 22)
+            maj = (a & b) ^ (a & c) ^ (b & c)
+            h, g, f, e, d, c, b, a = g, f, e, d + t1, c, b, a, t1 + s0 + maj
+
+        return [x + y for x, y in zip(state, (a, b, c, d, e, f, g, h))]
+
+    @staticmethod
+    def _padded(message_len):
+        """
+        sha256 padding for a message of message_len bytes
+        """
+        zeros = (55 - message_len) % 64
+        return b'\x80' + b'\x00' * zeros + (message_len * 8).to_bytes(8, byteorder='big')
+
+    def scan(self, template, target, start, end):
+        iv = [np.array([v], dtype=np.uint32) for v in SHA256_IV]
+
+        # compress every block that sits entirely in front of the nonce once
+        prefix_len = len(template) // 64 * 64
+        prefix_words = np.frombuffer(template[:prefix_len], dtype='>u4').astype(np.uint32)
+        midstate = iv
+        for block in prefix_words.reshape(-1, 16):
+            midstate = self._compress(midstate, [block[i:i+1] for i in range(16)])
+
+        tail = template[prefix_len:] + bytes(4) + self._padded(len(template) + 4)
+        nonce_offset = len(template) - prefix_len
+        buf = np.empty((self.batch_size, len(tail)), dtype=np.uint8)
+        buf[:] = np.frombuffer(tail, dtype=np.uint8)
+
+        # the word columns holding nonce bytes differ per lane, the other columns are shared
+        lane_columns = set(range(nonce_offset // 4, (nonce_offset + 3) // 4 + 1))
+
+        # the second round hashes the 32 byte digest
+        digest_padding = [
+            np.array([w], dtype=np.uint32) for w in struct.unpack('>8I', self._padded(32))
+        ]
+        target_words = struct.unpack('>8I', target.to_bytes(32, byteorder='big'))
+
+        for batch_start in range(start, end, self.batch_size):
+            count = min(self.batch_size, end - batch_start)
+            nonces = np.arange(batch_start, batch_start + count, dtype='<u4')
+            buf[:count, nonce_offset:nonce_offset+4] = nonces.view(np.uint8).reshape(-1, 4)
+
+            words = buf[:count].view('>u4')
+            state = midstate
+            for block_idx in range(words.shape[1] // 16):
+                state = self._compress(state, [
+                    words[:, col].astype(np.uint32) if col in lane_columns else words[:1, col].astype(np.uint32)
+                    for col in range(block_idx * 16, block_idx * 16 + 16)
+                ])
+            digest = self._compress(iv, state + digest_padding)
+
+            # lexicographic compare of the big endian digest words with the target words
+            below = np.zeros(count, dtype=bool)
+            equal = np.ones(count, dtype=bool)
+            for word, target_word in zip(digest, target_words):
+                below |= equal & (word < target_word)
+                equal &= word == target_word
+
+            hits = np.flatnonzero(below)
+            if hits.size:
+                return batch_start + int(hits[0])
+
+        return None
+
+
+@lru_cache(maxsize=None)
+def fastest_hasher(sample_size=2 ** 14) -> str:
+    """
+    times every available backend on the same run of nonces and returns the fastest one's name
+    """
+    template = bytes(76)
+    timings = {}
+    for name, cls in hasher_registry.items():
+        if not cls.available():
+            continue
+        start = time.perf_counter()
+        cls().scan(template, 0, 0, sample_size)
+        timings[name] = time.perf_counter() - start
+
+    name = min(timings, key=timings.get)
+    logger.info(f'[mining] using the {name} hasher {timings}')
+    return name
+
+
+def select_hasher(name: str = None) -> Hasher:
+    """
+    None picks the fastest backend available at runtime
+    """
+    name = name or fastest_hasher()
+    cls = hasher_registry[name]
+    if not cls.available():
+        raise ValueError(f'hasher {name} is not available')
+    return cls()
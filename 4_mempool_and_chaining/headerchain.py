@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+Header chain component
+
+Every block we know of gets a compact header record, linked to its parent's record, carrying its
+height and the cumulative work of the chain ending in it. Height, ancestry and fork questions are
+answered from the records alone, without touching block bodies, and a headers-first sync can check
+the proof of work of a whole chain before asking for any of its bodies.
+"""
+
+import logging
+
+from typing import Dict, Iterable, List, Union
+
+from blockchain import Block, BLOCK_NBITS
+from utils import uint256_from_compact
+from validation import BlockValidator, ValidationError, MEDIAN_TIME_SPAN
+
+logger = logging.getLogger(__name__)
+
+# most headers a peer hands out per get_headers call
+MAX_HEADERS_PER_REQUEST = 2000
+
+
+def block_work(nbits: int) -> int:
+    """
+    expected number of hashes to find a block at nbits, like bitcoin's GetBlockProof
+    """
+    target = uint256_from_compact(nbits)
+    return 2 ** 256 // (target + 1)
+
+
+class HeaderRecord:
+    """
+    the header fields of a block plus where it sits: its parent's record, height and chainwork
+    """
+    __slots__ = (
+        'hash', 'parent', 'height', 'chainwork',
+        'version', 'merkle_tree_hash', 'timestamp', 'nbits', 'nonce'
+    )
+
+    def __init__(self, header: Block, parent: Union['HeaderRecord', None]):
+        self.hash = header.id
+        self.parent = parent
+        self.height = parent.height + 1 if parent else 0
+        self.chainwork = (parent.chainwork if parent else 0) + block_work(header.nbits)
+
+        self.version = header.version
+        self.merkle_tree_hash = header.merkle_tree_hash
+        self.timestamp = header.timestamp
+        self.nbits = header.nbits
+        self.nonce = header.nonce
+
+    def __repr__(self):
+        return f'HeaderRecord(hash={self.hash}, height={self.height}, chainwork={self.chainwork})'
+
+    @property
+    def id(self) -> bytes:
+        """
+        same name as Block.id, so a record goes wherever only the block's hash is needed
+        """
+        return self.hash
+
+    @property
+    def previous_block_hash(self) -> Union[bytes, None]:
+        return self.parent.hash if self.parent else None
+
+    def to_block(self) -> Block:
+        """
+        the header as a Block without txns, what peers exchange during headers-first sync
+        """
+        return Block(
+            version=self.version,
+            previous_block_hash=self.previous_block_hash,
+            merkle_tree_hash=self.merkle_tree_hash,
+            timestamp=self.timestamp,
+            nbits=self.nbits,
+            nonce=self.nonce,
+            txns=[]
+        )
+
+
+class HeaderChain:
+    """
+    Header records of every known block by hash, whichever chain they're on, and the tip with the
+    most cumulative work among them.
+    """
+
+    def __init__(self, nbits: int = BLOCK_NBITS):
+        self.headers: Dict[bytes, HeaderRecord] = {}
+        self.best_tip: HeaderRecord = None
+        # the difficulty validated headers have to be at
+        self.nbits = nbits
+
+    def __contains__(self, block_hash) -> bool:
+        return block_hash in self.headers
+
+    def __len__(self) -> int:
+        return len(self.headers)
+
+    def get(self, block_hash) -> Union[HeaderRecord, None]:
+        return self.headers.get(block_hash)
+
+    def add_header(self, header: Block, validate=True) -> HeaderRecord:
+        """
+        Records header, which can be a whole block or a Block without txns. The parent has to be known
+        unless it's the first header. validate checks the proof of work and timestamp, raising
+        ValidationError, headers of blocks that went through BlockValidator already skip it.
+        """
+        record = self.headers.get(header.id)
+        if record:
+            return record
+
+        parent = self.headers.get(header.previous_block_hash)
+        if parent is None and (header.previous_block_hash or self.headers):
+            raise ValidationError('header', f'unknown parent {header.previous_block_hash}')
+
+        if validate:
+            BlockValidator.check_header(header, self.timestamps(parent), self.nbits)
+
+        record = self.headers[header.id] = HeaderRecord(header, parent)
+        if self.best_tip is None or record.chainwork > self.best_tip.chainwork:
+            self.best_tip = record
+        return record
+
+    def discard(self, records: Iterable[HeaderRecord]):
+        """
+        forgets records, which no other record may have as its parent, and picks the best tip among what's
+        left. Ties go to the record added first, like in add_header
+        """
+        for record in records:
+            self.headers.pop(record.hash, None)
+
+        if self.best_tip is not None and self.best_tip.hash not in self.headers:
+            self.best_tip = max(self.headers.values(), key=lambda record: record.chainwork, default=None)
+
+    def timestamps(self, record: HeaderRecord, count=MEDIAN_TIME_SPAN) -> List[int]:
+        """
+        timestamps of record and the (count - 1) records before it, oldest first
+        """
+        timestamps = []
+        while record and len(timestamps) < count:
+            timestamps.append(record.timestamp)
+            record = record.parent
+        return timestamps[::-1]
+
+    @staticmethod
+    def ancestor(record: HeaderRecord, height: int) -> Union[HeaderRecord, None]:
+        while record and record.height > height:
+            record = record.parent
+        return record
+
+    @staticmethod
+    def fork_point(a: HeaderRecord, b: HeaderRecord) -> HeaderRecord:
+        """
+        the last record a and b have in common, walking the parent pointers
+        """
+        a = HeaderChain.ancestor(a, b.height)
+        b = HeaderChain.ancestor(b, a.height)
+        while a is not b:
+            a, b = a.parent, b.parent
+        return a
+
+    @staticmethod
+    def path(record: HeaderRecord, from_height=0) -> List[HeaderRecord]:
+        """
+        the records from from_height up to record, lowest first
+        """
+        path = []
+        while record and record.height >= from_height:
+            path.append(record)
+            record = record.parent
+        return path[::-1]
+
+    def locator(self) -> List[bytes]:
+        """
+        hashes of the best chain for a peer to find where we diverge: the last ten, then exponentially
+        further apart, down to the first header
+        """
+        hashes = []
+        record, step = self.best_tip, 1
+        while record:
+            hashes.append(record.hash)
+            if record.parent is None:
+                break
+            if len(hashes) >= 10:
+                step *= 2
+            record = self.ancestor(record, max(record.height - step, 0))
+        return hashes
+
+    def headers_after(self, locator: Iterable[bytes], limit=MAX_HEADERS_PER_REQUEST) -> List[Block]:
+        """
+        the serving side of get_headers, the best chain's headers following the first locator hash on it
+        """
+        best_path = self.path(self.best_tip)
+        start = 0
+        for block_hash in locator:
+            record = self.headers.get(block_hash)
+            if record and self.ancestor(self.best_tip, record.height) is record:
+                start = record.height + 1
+                break
+
+        return [record.to_block() for record in best_path[start:start + limit]]
@@ -5,88 +5,576 @@ Mempool component
 will be the datastructure that downloads and receives each individual transactions?
 
 Now, the mempool is can be variable the data structure selection, we can choose to pack
-the highest fees first selection. 
+the highest fees first selection.
 """
 
+import sys
+import time
 import logging
+import itertools
 
-from typing import Dict, Iterable
-from heapq import heappush, heappop, heapreplace
+from typing import Dict, Iterable, List, NamedTuple, Set, Tuple, Union
+from heapq import heappush, heappop, heapify
 
 from blockchain import Block
-from transaction import Transaction, UnspentTxOut
+from transaction import Transaction, UnspentTxOut, UTXOManager, OutPoint
 
 from utils import Singleton
 
 logger = logging.getLogger(__name__)
 
+# bytes of canonically encoded transactions a block template holds
+MAX_BLOCK_SERIALIZED_SIZE = 1000000
+
+# once a template is this many txns in a row past fitting another one, it's considered full
+MAX_CONSECUTIVE_MISSES = 100
+
+# estimated memory the mempool may hold before it starts evicting
+DEFAULT_MAX_MEMPOOL_BYTES = 300 * 10 ** 6
+
+# what the mempool holds per txn besides the txn itself: its slots in mempool_dict, entries and
+# children, the MempoolEntry and its heap items
+ENTRY_OVERHEAD = 512
+
+# minis per byte the minimum fee rate ends up above the last evicted package's descendant fee rate
+INCREMENTAL_RELAY_FEE_RATE = 1.0
+
+# seconds it takes the minimum fee rate to halve once evictions stop
+ROLLING_FEE_HALFLIFE = 60 * 60 * 12
+
+# most txns a replacement may push out of the mempool, its conflicts and their descendants
+MAX_REPLACEMENT_EVICTIONS = 100
+
+
+def estimate_memory(obj) -> int:
+    """
+    bytes held by the object tree of a transaction, sys.getsizeof of every tuple, list, bytes, str and
+    int in it plus the memoized attributes
+    """
+    if obj is None:
+        return 0
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (tuple, list)):
+        size += sum(estimate_memory(item) for item in obj)
+
+    attributes = getattr(obj, '__dict__', None)
+    if attributes:
+        size += sys.getsizeof(attributes) + sum(estimate_memory(value) for value in attributes.values())
+
+    return size
+
+
+class MempoolEntry(NamedTuple):
+    """
+    what the mempool knows about a transaction besides the transaction itself. The ancestor fields
+    add up the txn and every mempool txn it depends on, the package a miner has to take to get it.
+    The descendant fields add up the txn and every mempool txn depending on it, what has to go when
+    it gets evicted
+    """
+    fee: int
+    size: int
+    memory: int
+
+    # insertion order, tells the current heap item of a txn apart from the stale ones before it
+    seq: int
+
+    ancestor_fee: int
+    ancestor_size: int
+    ancestor_count: int
+
+    descendant_fee: int
+    descendant_size: int
+    descendant_count: int
+
+    @property
+    def fee_rate(self) -> float:
+        return self.fee / self.size
+
+    @property
+    def ancestor_fee_rate(self) -> float:
+        return self.ancestor_fee / self.ancestor_size
+
+    @property
+    def descendant_fee_rate(self) -> float:
+        return self.descendant_fee / self.descendant_size
+
+    @property
+    def eviction_score(self) -> float:
+        """
+        like bitcoin core, a txn paying well on its own isn't evicted for the cheap txns hanging off it
+        """
+        return max(self.fee_rate, self.descendant_fee_rate)
+
 
 class Mempool(metaclass=Singleton):
-    def __init__(self):
-        self.mempool_dict: Dict[str, Transaction] = {}
+    def __init__(self, max_bytes=DEFAULT_MAX_MEMPOOL_BYTES):
+        self.max_bytes = max_bytes
+        self.total_memory = 0
+
+        self.mempool_dict: Dict[bytes, Transaction] = {}
+        self.entries: Dict[bytes, MempoolEntry] = {}
+
+        # spent txid -> txids of the mempool txns spending its outputs. Kept whether the spent txn is in
+        # the mempool or in the chain, so a parent coming back in a reorg finds its children
+        self.children: Dict[bytes, Set[bytes]] = {}
+
+        # outpoint -> txid of the mempool txn spending it, two txns spending the same outpoint conflict
+        self.spent_outpoints: Dict[OutPoint, bytes] = {}
+
+        # the heap elements are (-ancestor fee rate, seq, txid). Removing a txn or changing its ancestors
+        # only replaces its entry, the heap items left behind are skipped (and dropped) when popped
+        self.mempool_heap: List[Tuple[float, int, bytes]] = []
+
+        # (eviction score, seq, txid), the cheapest package to evict on top, pruned the same way
+        self.eviction_heap: List[Tuple[float, int, bytes]] = []
+        self._seq = itertools.count()
+
+        # validation.SignatureVerifier new txns are checked with, if set
+        self.signature_verifier = None
 
-        # the heap elements will be in the tuple format of -(fee, Transaction)
-        self.mempool_heap: Iterable[(int, Transaction)] = []
+        # raised past the fee rate of every evicted package, decays back once the evictions stop
+        self.rolling_min_fee_rate = 0.0
+        self.last_fee_update = time.time()
 
     def find_utxo_in_mempool(self, txin) -> UnspentTxOut:
         txid, idx = txin.outpoint
 
         try:
-            txout = self.mempool[txid].txouts[idx]
+            txout = self.mempool_dict[txid].txouts[idx]
         except Exception as e:
             logger.debug(f"Couldn't find utxo in mempool for {txin}")
             return None
 
         return UnspentTxOut(*txout, txid=txid, is_coinbase=False, height=-1, txout_idx=idx)
 
+    def parents(self, txid) -> Set[bytes]:
+        return {
+            txin.outpoint.txid for txin in self.mempool_dict[txid].txins
+            if txin.outpoint.txid in self.mempool_dict
+        }
+
+    def ancestors(self, txid, exclude: Set[bytes] = frozenset()) -> Set[bytes]:
+        """
+        every mempool txn txid depends on, directly or not, leaving out exclude and what only they lead to
+        """
+        found = set()
+        stack = [txid]
+        while stack:
+            for parent in self.parents(stack.pop()):
+                if parent not in found and parent not in exclude:
+                    found.add(parent)
+                    stack.append(parent)
+        return found
+
+    def descendants(self, txid) -> Set[bytes]:
+        """
+        every mempool txn that depends on txid, directly or not
+        """
+        found = set()
+        stack = [txid]
+        while stack:
+            for child in self.children.get(stack.pop(), ()):
+                if child not in found and child in self.mempool_dict:
+                    found.add(child)
+                    stack.append(child)
+        return found
+
+    def _set_entry(self, txid, entry: MempoolEntry):
+        """
+        stores entry under a fresh seq, which makes every earlier heap item of txid stale
+        """
+        entry = entry._replace(seq=next(self._seq))
+        self.entries[txid] = entry
+        heappush(self.mempool_heap, (-entry.ancestor_fee_rate, entry.seq, txid))
+        heappush(self.eviction_heap, (entry.eviction_score, entry.seq, txid))
+
+    def _shift_ancestor_state(self, txid, other: MempoolEntry, sign: int):
+        entry = self.entries[txid]
+        self._set_entry(txid, entry._replace(
+            ancestor_fee=entry.ancestor_fee + sign * other.fee,
+            ancestor_size=entry.ancestor_size + sign * other.size,
+            ancestor_count=entry.ancestor_count + sign
+        ))
+
+    def _shift_descendant_state(self, txid, other: MempoolEntry, sign: int):
+        entry = self.entries[txid]
+        self._set_entry(txid, entry._replace(
+            descendant_fee=entry.descendant_fee + sign * other.fee,
+            descendant_size=entry.descendant_size + sign * other.size,
+            descendant_count=entry.descendant_count + sign
+        ))
+
+    def _refresh_state(self, txids: Iterable[bytes]):
+        """
+        recomputes the ancestor and descendant aggregates of txids from scratch
+        """
+        for txid in txids:
+            entry = self.entries[txid]
+            ancestors = [self.entries[ancestor] for ancestor in self.ancestors(txid)]
+            descendants = [self.entries[descendant] for descendant in self.descendants(txid)]
+            self._set_entry(txid, entry._replace(
+                ancestor_fee=entry.fee + sum(ancestor.fee for ancestor in ancestors),
+                ancestor_size=entry.size + sum(ancestor.size for ancestor in ancestors),
+                ancestor_count=1 + len(ancestors),
+                descendant_fee=entry.fee + sum(descendant.fee for descendant in descendants),
+                descendant_size=entry.size + sum(descendant.size for descendant in descendants),
+                descendant_count=1 + len(descendants)
+            ))
+
+    def _is_live(self, item) -> bool:
+        _, seq, txid = item
+        entry = self.entries.get(txid)
+        return entry is not None and entry.seq == seq
+
+    def _compact_heap(self):
+        """
+        rebuilds the heap from the live entries once stale items make up most of it
+        """
+        if len(self.mempool_heap) + len(self.eviction_heap) <= 4 * len(self.entries) + 128:
+            return
+
+        self.mempool_heap = [
+            (-entry.ancestor_fee_rate, entry.seq, txid) for txid, entry in self.entries.items()
+        ]
+        self.eviction_heap = [
+            (entry.eviction_score, entry.seq, txid) for txid, entry in self.entries.items()
+        ]
+        heapify(self.mempool_heap)
+        heapify(self.eviction_heap)
+
+    def min_fee_rate(self) -> float:
+        """
+        Fee rate a new txn has to pay to get in, like bitcoin core's rolling minimum fee. Every eviction
+        raises it past the evicted package, then it halves every ROLLING_FEE_HALFLIFE, faster while the
+        mempool is well under its cap, and drops to 0 once it's under half the incremental fee rate.
+        """
+        if not self.rolling_min_fee_rate:
+            return 0.0
+
+        halflife = ROLLING_FEE_HALFLIFE
+        if self.total_memory < self.max_bytes / 4:
+            halflife /= 4
+        elif self.total_memory < self.max_bytes / 2:
+            halflife /= 2
+
+        now = time.time()
+        self.rolling_min_fee_rate /= 2 ** ((now - self.last_fee_update) / halflife)
+        self.last_fee_update = now
+
+        if self.rolling_min_fee_rate < INCREMENTAL_RELAY_FEE_RATE / 2:
+            self.rolling_min_fee_rate = 0.0
+        return self.rolling_min_fee_rate
+
+    def _trim(self):
+        """
+        evicts the package with the lowest eviction score, a txn along with everything depending on it,
+        until the mempool is back under max_bytes
+        """
+        while self.total_memory > self.max_bytes and self.eviction_heap:
+            item = heappop(self.eviction_heap)
+            if not self._is_live(item):
+                continue
+
+            fee_rate, _, txid = item
+            package = {txid, *self.descendants(txid)}
+            self._remove(package)
 
-    def select_from_mempool(self, block: Block) -> Block:
+            self.rolling_min_fee_rate = max(self.min_fee_rate(), fee_rate + INCREMENTAL_RELAY_FEE_RATE)
+            self.last_fee_update = time.time()
+            logger.info(f'mempool full, evicted {len(package)} txns paying {fee_rate:.2f} per byte')
+
+    def select_from_mempool(self, block: Block, max_bytes=MAX_BLOCK_SERIALIZED_SIZE) -> Block:
         """
-        Fills a block with transactions from the mempool
+        Fills a block with transactions from the mempool, best ancestor package first, like bitcoin
+        core's CreateNewBlock.
+
+        A txn always comes in with the ancestors the block doesn't have yet, and is scored by the fee
+        rate of that whole package, so a high fee child pays for its parents. Once a package is in,
+        its descendants get rescored without it in a local heap. Candidates are popped off the mempool
+        heap and pushed back afterwards, a block of k transactions costs O(k log n) plus the package
+        walks.
         """
-        added_to_block = set()
+        selected = []
+        selected_ids = set()
+        size = 0
+        misses = 0
+
+        popped = []
+
+        # txid -> (ancestor fee, ancestor size, seq) of txns with ancestors in the block already,
+        # those ancestors taken out
+        modified: Dict[bytes, Tuple[int, int, int]] = {}
+        modified_heap = []
 
-        def try_add_to_block(block, txid):
-            if txid in added_to_block:
-                return block
+        def next_candidate():
+            while modified_heap and (
+                    modified_heap[0][2] in selected_ids or modified[modified_heap[0][2]][2] != modified_heap[0][1]):
+                heappop(modified_heap)
 
-            txn = self.mempool[txid]
-            for txid in txn:
-                # we have two places to look for transactions, the first is in the chain
-                # the second is in the mempool itself, in case someone broadcasts two consecutive
-                # transactions which requires atomicity (one transaction in the mempool requires 
-                # txouts from another in the mempool) 
+            while self.mempool_heap:
+                item = self.mempool_heap[0]
+                if not self._is_live(item):
+                    heappop(self.mempool_heap)
+                elif item[2] in selected_ids or item[2] in modified:
+                    popped.append(heappop(self.mempool_heap))
+                else:
+                    break
 
-                if txin.outpoint in utxo_set:
-                    continue
+            if modified_heap and (not self.mempool_heap or modified_heap[0] < self.mempool_heap[0]):
+                return heappop(modified_heap)[2]
+            if self.mempool_heap:
+                popped.append(heappop(self.mempool_heap))
+                return popped[-1][2]
+            return None
+
+        while misses < MAX_CONSECUTIVE_MISSES:
+            txid = next_candidate()
+            if txid is None:
+                break
 
-                in_mempool = find_utxo_in_mempool(txin)
+            package = [txid, *self.ancestors(txid, exclude=selected_ids)]
+            package_size = sum(self.entries[member].size for member in package)
+            if size + package_size > max_bytes:
+                misses += 1
+                continue
 
-                if not in_mempool:
-                    logger.debug(f"Couldn't find UTXO in mempool")
-                    return None
+            # fewer ancestors first puts every parent in front of its children
+            package.sort(key=lambda member: self.entries[member].ancestor_count)
+            package_ids = set(package)
+            for member in package:
+                selected.append(self.mempool_dict[member])
+                selected_ids.add(member)
+                logger.debug(f"added {member} to block")
 
-                block = try_add_to_block(block, in_mempool.txid)
-                if not block:
-                    logger.debug(f"Couldn't add parent")
-                    return None
+            size += package_size
+            misses = 0
 
-            new_block = block.replace(txns=[*block.txns, txn])
-            added_to_block.add(new_block)
-            logger.debug(f"added {txid} to block")
-            return new_block
+            for member in package:
+                entry = self.entries[member]
+                for descendant in self.descendants(member) - package_ids - selected_ids:
+                    descendant_entry = self.entries[descendant]
+                    fee, size_left, _ = modified.get(
+                        descendant, (descendant_entry.ancestor_fee, descendant_entry.ancestor_size, None))
+                    seq = next(self._seq)
+                    modified[descendant] = (fee - entry.fee, size_left - entry.size, seq)
+                    heappush(modified_heap, (-(fee - entry.fee) / (size_left - entry.size), seq, descendant))
 
-        for txid in self.mempool:
-            new_block = try_add_to_block(block, txid)
-            block = new_block
+        for item in popped:
+            heappush(self.mempool_heap, item)
 
-        return block
+        return block._replace(txns=[*block.txns, *selected])
 
+    def conflicts(self, txn: Transaction) -> Set[bytes]:
+        """
+        txids of the mempool txns spending any of the outpoints txn spends, one lookup per input
+        """
+        return {
+            self.spent_outpoints[txin.outpoint] for txin in txn.txins if txin.outpoint in self.spent_outpoints
+        }
+
+    def replaced_by(self, txn: Transaction, fee: int) -> Union[Set[bytes], None]:
+        """
+        Replace by fee, along the lines of bip125 with every txn replaceable (like core's full rbf).
+        Returns the txids txn would push out, its conflicts with their descendants, or None if it
+        isn't allowed to replace them: it has to pay a higher fee rate than every conflict and pay
+        for the replaced fees plus its own relay on top.
+
+        The cached descendant counts rule out replacements evicting too much before anything gets
+        walked.
+        """
+        conflicts = self.conflicts(txn)
+        if not conflicts:
+            return set()
+
+        if sum(self.entries[conflict].descendant_count for conflict in conflicts) > MAX_REPLACEMENT_EVICTIONS:
+            logger.debug(f'txn {txn.id} would replace too many txns')
+            return None
+
+        fee_rate = fee / txn.size
+        if any(fee_rate <= self.entries[conflict].fee_rate for conflict in conflicts):
+            logger.debug(f'txn {txn.id} pays a lower fee rate than the txns it conflicts with')
+            return None
+
+        replaced = set(conflicts)
+        for conflict in conflicts:
+            replaced |= self.descendants(conflict)
+
+        # spending the outputs of a txn it replaces would leave the replacement without its inputs
+        if any(txin.outpoint.txid in replaced for txin in txn.txins):
+            return None
+
+        if fee < sum(self.entries[txid].fee for txid in replaced) + INCREMENTAL_RELAY_FEE_RATE * txn.size:
+            logger.debug(f'txn {txn.id} doesn\'t pay enough to replace {len(replaced)} txns')
+            return None
+
+        return replaced
 
     def add_txn_to_mempool(self, txn: Transaction, force=False):
-        if txn.id in mempool and not force:
-            logger.debug(f'txn {txn} has already been seen')
-            return 
+        """
+        force re-adds txns of disconnected blocks, they get in whatever the minimum fee rate and push
+        out the mempool txns they conflict with, but can still be evicted right away
+        """
+        if txn.id in self.mempool_dict:
+            if not force:
+                logger.debug(f'txn {txn} has already been seen')
+                return
+            self.remove_txn(txn.id)
+
+        utxo_set = UTXOManager().utxo_set
+        utxos = [utxo_set.get(txin.outpoint) or self.find_utxo_in_mempool(txin) for txin in txn.txins]
+        if None in utxos:
+            logger.debug(f'txn {txn.id} spends outputs that are neither in the utxo set nor the mempool')
+            return
+
+        if not force and self.signature_verifier is not None:
+            spent = dict(zip((txin.outpoint for txin in txn.txins), utxos))
+            if not self.signature_verifier.verify([txn], lambda txin: spent[txin.outpoint])[0]:
+                logger.info(f'txn {txn.id} has an invalid signature')
+                return
+
+        fee = sum(utxo.value for utxo in utxos) - sum(txout.value for txout in txn.txouts)
+        if not force and fee < self.min_fee_rate() * txn.size:
+            logger.debug(f'txn {txn.id} pays less than the mempool minimum fee rate')
+            return
+
+        if force:
+            replaced = self.conflicts(txn)
+            for conflict in list(replaced):
+                replaced |= self.descendants(conflict)
+        else:
+            replaced = self.replaced_by(txn, fee)
+            if replaced is None:
+                return
+
+        if replaced:
+            logger.info(f'txn {txn.id} replaces {len(replaced)} mempool txns')
+            self._remove(replaced)
 
-        self.mempool[txn.id] = txn
+        self.mempool_dict[txn.id] = txn
+        for txin in txn.txins:
+            self.children.setdefault(txin.outpoint.txid, set()).add(txn.id)
+            self.spent_outpoints[txin.outpoint] = txn.id
+
+        entry = self.entries[txn.id] = MempoolEntry(
+            fee=fee, size=txn.size, memory=estimate_memory(txn) + ENTRY_OVERHEAD, seq=None,
+            ancestor_fee=fee, ancestor_size=txn.size, ancestor_count=1,
+            descendant_fee=fee, descendant_size=txn.size, descendant_count=1
+        )
+        self.total_memory += entry.memory
+
+        descendants = self.descendants(txn.id)
+        if descendants:
+            # a parent coming back (say from a disconnected block) after its children, the aggregates of
+            # everything around them change
+            affected = {txn.id, *descendants}
+            for member in list(affected):
+                affected |= self.ancestors(member)
+            self._refresh_state(affected)
+        else:
+            self._refresh_state([txn.id])
+            for ancestor in self.ancestors(txn.id):
+                self._shift_descendant_state(ancestor, entry, 1)
+
+        self._trim()
+        self._compact_heap()
         logger.debug(f'txn {txn} added to the mempool')
+
+    def add_txns_to_mempool(self, txns: Iterable[Transaction]):
+        """
+        A batch of incoming txns, their signatures get verified in one go across the verifier's pool
+        before they're added one by one (where the checks are signature cache hits). Txns spending
+        each other are added parents first, whatever order they came in.
+        """
+        txns = list(txns)
+        batch = {txn.id: txn for txn in txns}
+
+        if self.signature_verifier is not None:
+            utxo_set = UTXOManager().utxo_set
+
+            def find_utxo(txin):
+                txid, idx = txin.outpoint
+                if txid in batch:
+                    txout = batch[txid].txouts[idx] if idx < len(batch[txid].txouts) else None
+                    return txout and UnspentTxOut(*txout, txid=txid, is_coinbase=False, height=-1, txout_idx=idx)
+                return utxo_set.get(txin.outpoint) or self.find_utxo_in_mempool(txin)
+
+            valid = self.signature_verifier.verify(txns, find_utxo)
+            txns = [txn for txn, ok in zip(txns, valid) if ok]
+
+        ordered = []
+        visited = set()
+
+        def visit(txn):
+            if txn.id in visited:
+                return
+            visited.add(txn.id)
+            for txin in txn.txins:
+                parent = batch.get(txin.outpoint.txid)
+                if parent is not None:
+                    visit(parent)
+            ordered.append(txn)
+
+        for txn in txns:
+            visit(txn)
+
+        for txn in ordered:
+            self.add_txn_to_mempool(txn)
+
+    def _remove(self, txids: Set[bytes]):
+        """
+        drops txids, the aggregates of the txns around them are updated without them
+        """
+        for txid in txids:
+            removed = self.entries[txid]
+            for descendant in self.descendants(txid) - txids:
+                self._shift_ancestor_state(descendant, removed, -1)
+            for ancestor in self.ancestors(txid) - txids:
+                self._shift_descendant_state(ancestor, removed, -1)
+
+        for txid in txids:
+            txn = self.mempool_dict.pop(txid)
+            self.total_memory -= self.entries.pop(txid).memory
+            for txin in txn.txins:
+                if self.spent_outpoints.get(txin.outpoint) == txid:
+                    del self.spent_outpoints[txin.outpoint]
+
+                spenders = self.children.get(txin.outpoint.txid)
+                if spenders is not None:
+                    spenders.discard(txid)
+                    if not spenders:
+                        del self.children[txin.outpoint.txid]
+
+    def remove_txn(self, txid) -> Transaction:
+        """
+        drops a txn, when it got mined for example. Its descendants stay, without it in their ancestor
+        aggregates. Heap items go stale and are skipped later on
+        """
+        txn = self.mempool_dict.get(txid)
+        if txn is None:
+            return None
+
+        self._remove({txid})
+        self._compact_heap()
+        return txn
+
+    def remove_for_block(self, block: Block):
+        """
+        Upkeep for a block connected to the active chain, in one pass: its txns leave the mempool as
+        mined, their descendants stay. The mempool txns spending an outpoint the block spent are
+        double spends now, they go along with everything depending on them.
+        """
+        mined = {txn.id for txn in block.txns if txn.id in self.mempool_dict}
+
+        conflicted = set()
+        for txn in block.txns:
+            for txin in txn.txins:
+                spender = self.spent_outpoints.get(txin.outpoint)
+                if spender is not None and spender != txn.id and spender not in conflicted:
+                    conflicted |= {spender, *self.descendants(spender)}
+
+        if conflicted:
+            logger.info(f'block {block.id} conflicts with {len(conflicted)} mempool txns')
+
+        self._remove(mined | conflicted)
+        self._compact_heap()
@@ -4,9 +4,10 @@ http://www.effectivepython.com/2015/02/02/register-class-existence-with-metaclas
 """
 
 import binascii
+import struct
 import json
 
-from typing import NamedTuple, get_type_hints, Iterable, Mapping, Union
+from typing import NamedTuple, get_type_hints, get_origin, get_args, Iterable, Mapping, Union
 
 
 namedtuple_cls_registry = {}
@@ -16,11 +17,21 @@ def register_namedtuple(cls):
     """
     Here's a registry hook, we can add the class name to the registry
     and set the dynamic methods
+
+    The type hints are only looked at here: they get reduced to field kinds once per class, and the
+    json decode plan and binary layout are compiled from those kinds. The binary layout also takes the
+    optional fixed_width_fields mapping of field name -> struct format.
     """
 
     namedtuple_cls_registry[cls.__name__] = cls
+    hints = get_type_hints(cls)
+    setattr(cls, 'field_kinds', [hint_kind(hints.get(field)) for field in cls._fields])
     setattr(cls, 'deserialize', classmethod(deserialize))
     setattr(cls, 'serialize', serialize)
+    setattr(cls, 'json_plan', compile_json_plan(cls))
+    setattr(cls, 'binary_layout', compile_binary_layout(cls))
+    setattr(cls, 'deserialize_binary', classmethod(deserialize_binary))
+    setattr(cls, 'serialize_binary', serialize_binary)
     return cls
 
 
@@ -55,29 +66,374 @@ def serialize(self) -> str:
     return json.dumps(as_primitive(self), sort_keys=True, separators=(',', ':'))
 
 
+def hint_kind(hint) -> tuple:
+    """
+    reduces a type hint to what the codecs care about, one of:
+    ('int',), ('bool',), ('bytes',), ('str',), ('nested', cls), ('list', element kind), ('any',)
+    """
+    origin, args = get_origin(hint), get_args(hint)
+
+    if origin is Union:
+        options = [arg for arg in args if arg is not type(None)]
+        return hint_kind(options[0]) if len(options) == 1 else ('any',)
+    if hint in (bool, int, bytes, str):
+        return (hint.__name__,)
+    if isinstance(hint, type) and hint.__name__ in namedtuple_cls_registry:
+        return ('nested', hint)
+    if origin is not None and args and issubclass(origin, Iterable) and not issubclass(origin, Mapping):
+        return ('list', hint_kind(args[0]))
+    return ('any',)
+
+
+def unhexlify_or_empty(value):
+    # an empty bytes field comes back as b'', not as the empty string it was written as
+    return None if value is None else binascii.unhexlify(value)
+
+
+def json_decoder_for_kind(kind):
+    """
+    function turning the json value of a field back into its python value, None when the json value
+    can be used as is
+    """
+    if kind[0] == 'bytes':
+        return unhexlify_or_empty
+    if kind[0] == 'nested':
+        cls = kind[1]
+        return lambda value: None if value is None else decode_json_object(cls, value)
+    if kind[0] == 'list':
+        decode_element = json_decoder_for_kind(kind[1])
+        if decode_element is None:
+            return None
+        return lambda value: None if value is None else [decode_element(element) for element in value]
+    if kind[0] == 'any':
+        return decode_json_any
+    return None
+
+
+def compile_json_plan(cls):
+    """
+    (field, decoder) pairs in the order of cls._fields
+    """
+    return [(field, json_decoder_for_kind(kind)) for field, kind in zip(cls._fields, cls.field_kinds)]
+
+
+def decode_json_object(cls, obj: Mapping) -> NamedTuple:
+    return cls._make([
+        obj[field] if decode is None else decode(obj[field]) for field, decode in cls.json_plan
+    ])
+
+
+def decode_json_any(value):
+    """
+    fields without a useful hint fall back on the _type tags
+    """
+    if isinstance(value, list):
+        return [decode_json_any(element) for element in value]
+    if isinstance(value, Mapping) and '_type' in value:
+        return decode_json_object(namedtuple_cls_registry[value['_type']], value)
+    return value
+
+
 def deserialize(cls, json_str: str) -> NamedTuple:
     """
-    This function will deserialize json_str into their NamedTuple instances
-    We will need to import all of the NamedTuple classes here
+    This function will deserialize json_str into their NamedTuple instances, following the decode plans
+    register_namedtuple compiled for every class
+    """
+    return decode_json_any(json.loads(json_str))
+
+
+"""
+Binary codec
+
+ints are zigzag varints, str and bytes are varint length prefixed raw bytes, lists are a varint count
+followed by the elements and nested NamedTuples are their fields back to back. Every varint is shifted
+up by one so that 0 can stand for None. Fields listed in a class's fixed_width_fields are packed with
+their struct format instead.
+"""
+
+
+class BufferReader:
+    """
+    reads out of a bytes-like object without copying it
+    """
+
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.pos = 0
+
+    def read(self, size: int) -> memoryview:
+        end = self.pos + size
+        if end > len(self.data):
+            raise EOFError(f'wanted {size} bytes at {self.pos}, only {len(self.data) - self.pos} left')
+        chunk = self.data[self.pos:end]
+        self.pos = end
+        return chunk
+
+    def read_varint(self) -> int:
+        data, pos = self.data, self.pos
+        result = shift = 0
+        while True:
+            if pos >= len(data):
+                raise EOFError('truncated varint')
+            byte = data[pos]
+            pos += 1
+            result |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                self.pos = pos
+                return result
+            shift += 7
+
+
+class StreamReader:
+    """
+    reads from anything with a read method, a file opened in binary mode or socket.makefile('rb').
+    Only ever asks the stream for the bytes it needs, so whatever follows in the stream is left alone.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def read(self, size: int) -> bytes:
+        data = self.stream.read(size)
+        while len(data) < size:
+            more = self.stream.read(size - len(data))
+            if not more:
+                raise EOFError(f'stream ended {size - len(data)} bytes short')
+            data += more
+        return data
+
+    def read_varint(self) -> int:
+        result = shift = 0
+        while True:
+            byte = self.read(1)[0]
+            result |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return result
+            shift += 7
+
+
+def write_varint(out: bytearray, value: int):
+    while value >= 0x80:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def encode_int(out, value):
+    if value is None:
+        out.append(0)
+    else:
+        write_varint(out, (value << 1 if value >= 0 else (-value << 1) - 1) + 1)
+
+
+def decode_int(reader):
+    value = reader.read_varint()
+    if not value:
+        return None
+    value -= 1
+    return value >> 1 if not value & 1 else -((value + 1) >> 1)
+
+
+def encode_blob(out, value):
+    """
+    str and bytes share an encoding, the low bit of the length says which one it was
     """
+    if value is None:
+        out.append(0)
+        return
 
-    def str_to_objs(obj):
-        if isinstance(obj, list):
-            return [str_to_objs(elem) for elem in obj]
-        elif not isinstance(obj, Mapping):
-            return obj
+    is_str = isinstance(value, str)
+    raw = value.encode() if is_str else value
+    write_varint(out, (len(raw) << 1 | is_str) + 1)
+    out += raw
 
-        _type = namedtuple_cls_registry[obj.pop('_type', None)]
-        bytes_key = {
-            key for key, value in get_type_hints(_type).items() if value == bytes
-        }
 
-        for key, value in obj.items():
-            obj[key] = str_to_objs(value)
+def decode_blob(reader):
+    header = reader.read_varint()
+    if not header:
+        return None
+    header -= 1
+    raw = reader.read(header >> 1)
+    return str(raw, 'utf-8') if header & 1 else bytes(raw)
 
-            if key in bytes_key:
-                obj[key] = binascii.unhexlify(obj[key]) if obj[key] else obj[key]
 
-        return _type(**obj)
+def encode_bool(out, value):
+    out.append(2 if value is None else int(bool(value)))
+
+
+def decode_bool(reader):
+    value = reader.read(1)[0]
+    return None if value == 2 else bool(value)
+
+
+def fixed_width_codec(fmt: str):
+    packer = struct.Struct('<' + fmt)
+
+    def encode(out, value):
+        out += packer.pack(value)
+
+    def decode(reader):
+        return packer.unpack(reader.read(packer.size))[0]
+
+    return encode, decode
+
+
+def nested_codec(cls):
+    """
+    a presence byte and then the fields of cls, cls.binary_layout is looked up late so that a class
+    can nest itself
+    """
+    def encode(out, value):
+        if value is None:
+            out.append(0)
+            return
+        out.append(1)
+        for encode_field, value in zip(cls.binary_layout[0], value):
+            encode_field(out, value)
+
+    def decode(reader):
+        if not reader.read(1)[0]:
+            return None
+        return cls._make([decode_field(reader) for decode_field in cls.binary_layout[1]])
+
+    return encode, decode
+
+
+def list_codec(element_codec):
+    encode_element, decode_element = element_codec
+
+    def encode(out, value):
+        if value is None:
+            out.append(0)
+            return
+        write_varint(out, len(value) + 1)
+        for element in value:
+            encode_element(out, element)
+
+    def decode(reader):
+        count = reader.read_varint()
+        if not count:
+            return None
+        return [decode_element(reader) for _ in range(count - 1)]
+
+    return encode, decode
+
+
+# tags for values whose type isn't known from the hints
+ANY_NONE, ANY_INT, ANY_BLOB, ANY_BOOL, ANY_LIST, ANY_NAMEDTUPLE = range(6)
+
+
+def encode_any(out, value):
+    if value is None:
+        out.append(ANY_NONE)
+    elif isinstance(value, bool):
+        out.append(ANY_BOOL)
+        encode_bool(out, value)
+    elif isinstance(value, int):
+        out.append(ANY_INT)
+        encode_int(out, value)
+    elif isinstance(value, (str, bytes)):
+        out.append(ANY_BLOB)
+        encode_blob(out, value)
+    elif hasattr(value, '_asdict') and type(value).__name__ in namedtuple_cls_registry:
+        out.append(ANY_NAMEDTUPLE)
+        encode_blob(out, type(value).__name__)
+        nested_codec(type(value))[0](out, value)
+    elif isinstance(value, (list, tuple)):
+        out.append(ANY_LIST)
+        list_codec(ANY_CODEC)[0](out, value)
+    else:
+        raise ValueError(f'{value} cannot be serialized')
+
+
+def decode_any(reader):
+    tag = reader.read(1)[0]
+    if tag == ANY_NONE:
+        return None
+    elif tag == ANY_BOOL:
+        return decode_bool(reader)
+    elif tag == ANY_INT:
+        return decode_int(reader)
+    elif tag == ANY_BLOB:
+        return decode_blob(reader)
+    elif tag == ANY_NAMEDTUPLE:
+        return nested_codec(namedtuple_cls_registry[decode_blob(reader)])[1](reader)
+    elif tag == ANY_LIST:
+        return list_codec(ANY_CODEC)[1](reader)
+    raise ValueError(f'unknown tag {tag}')
+
+
+ANY_CODEC = (encode_any, decode_any)
+
+
+def codec_for_kind(kind):
+    """
+    (encode, decode) pair for a field of the given kind
+    """
+    if kind[0] == 'bool':
+        return encode_bool, decode_bool
+    if kind[0] == 'int':
+        return encode_int, decode_int
+    if kind[0] in ('bytes', 'str'):
+        return encode_blob, decode_blob
+    if kind[0] == 'nested':
+        return nested_codec(kind[1])
+    if kind[0] == 'list':
+        return list_codec(codec_for_kind(kind[1]))
+    return ANY_CODEC
+
+
+def compile_binary_layout(cls):
+    """
+    returns (field encoders, field decoders) in the order of cls._fields
+    """
+    fixed_width = getattr(cls, 'fixed_width_fields', {})
+    codecs = [
+        fixed_width_codec(fixed_width[field]) if field in fixed_width else codec_for_kind(kind)
+        for field, kind in zip(cls._fields, cls.field_kinds)
+    ]
+    return [encode for encode, _ in codecs], [decode for _, decode in codecs]
+
+
+def serialize_binary(self) -> bytes:
+    out = bytearray()
+    for encode_field, value in zip(self.binary_layout[0], self):
+        encode_field(out, value)
+    return bytes(out)
+
+
+def deserialize_binary(cls, data) -> NamedTuple:
+    """
+    data can be any bytes-like object, memoryviews are read without copying
+    """
+    reader = BufferReader(data)
+    return cls._make([decode_field(reader) for decode_field in cls.binary_layout[1]])
+
+
+def _decode_head(cls, reader, list_field: str) -> NamedTuple:
+    if cls._fields[-1] != list_field or cls.field_kinds[-1][0] != 'list':
+        raise ValueError(f'{list_field} is not the trailing list field of {cls.__name__}')
+
+    return cls._make([decode_field(reader) for decode_field in cls.binary_layout[1][:-1]] + [[]])
+
+
+def deserialize_binary_head(cls, data, list_field: str) -> NamedTuple:
+    """
+    the fields of cls in front of its trailing list field, read off the start of data with list_field
+    left empty. None of the list is decoded
+    """
+    return _decode_head(cls, BufferReader(data), list_field)
+
+
+def iter_deserialize_binary(cls, stream, list_field: str) -> Iterable:
+    """
+    Streaming counterpart of deserialize_binary for classes whose last field is a list. Yields an
+    instance of cls with list_field left empty as soon as the fields in front of it are read, then the
+    elements of list_field one at a time, so only one element is ever held in memory.
+    """
+    reader = StreamReader(stream)
+    yield _decode_head(cls, reader, list_field)
 
-    return str_to_objs(json.loads(json_str))
+    decode_element = codec_for_kind(cls.field_kinds[-1][1])[1]
+    for _ in range(reader.read_varint() - 1):
+        yield decode_element(reader)
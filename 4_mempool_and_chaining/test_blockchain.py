@@ -2,6 +2,7 @@ import pytest
 
 from blockchain import Block 
 from transaction import *
+from utils import sha256d
 from wallet import build_transaction, pubkey_to_address, signing_key_from_bytes, TRANSACTION_FEE
 from chainmanager import ChainManager
 
@@ -49,15 +50,242 @@ def test_serialization():
 	assert deserialized_block.version == 0
 
 
+def test_binary_serialization():
+	blocks = [genesis_block, block_with_nonce._replace(txns=[*genesis_transactions, *genesis_transactions])]
+	for block in blocks:
+		data = block.serialize_binary()
+		assert len(data) < len(block.serialize())
+
+		deserialized_block = Block.deserialize_binary(memoryview(data))
+		assert deserialized_block == block
+		assert isinstance(deserialized_block.txns[0], Transaction)
+		assert deserialized_block.id == block.id
+
+	# types are kept exactly, unlike json where bytes come back as hex strings unless hinted
+	outpoint = OutPoint(txid=genesis_transactions[0].id, txout_idx=0)
+	assert OutPoint.deserialize_binary(outpoint.serialize_binary()).txid == outpoint.txid
+
+	with pytest.raises(EOFError):
+		Block.deserialize_binary(genesis_block.serialize_binary()[:-1])
+
+
+def test_stream_deserialize():
+	import io
+	block = block_with_nonce._replace(txns=[*genesis_transactions, *genesis_transactions])
+	stream = io.BytesIO(block.serialize_binary() + b'next message')
+
+	blocks = Block.stream_deserialize(stream)
+	header = next(blocks)
+	assert header.txns == [] and header.id == block.id
+
+	assert list(blocks) == block.txns
+	assert stream.read() == b'next message'
+
+	with pytest.raises(EOFError):
+		list(Block.stream_deserialize(io.BytesIO(block.serialize_binary()[:-1])))
+
+
 def test_merkle_tree():
 	# let's generate a merkle tree hash from a list of transactions
 	merkle_root = MerkleNode.generate_root_from_transaction(genesis_transactions)
-	assert merkle_root.value == b'u\x95\x8b\xab\x83?\xf7\x04!\xecc\x9d\xc6R$TF9I\x1b\xe0`\x85\xa8R4\xb3\xfa\x8f\xb8\xd0W'
+	# leaves are hashes of the canonical txids
+	assert merkle_root.value == b'\xfb\x17\n\x05T\xa7\xa0\xd2`FT\x85\xf0\xbc\xd1\x0e\xb9\xe7\x18\xc6\xb6\xd8X\xe8X\x12\rM\xa6q\x97*'
+
+
+
+def test_merkle_accumulator():
+	txns = [Transaction.create_coinbase('1MfsCiTUcbQiCR2UGFxL9GgzSmwQBZJWqV', value) for value in range(1, 10)]
+
+	accumulator = MerkleAccumulator()
+	assert accumulator.root is None
+	for count in range(1, len(txns) + 1):
+		accumulator.append(txns[count - 1])
+		assert accumulator.root == MerkleNode.generate_root_from_transaction(txns[:count]).value
+		assert MerkleAccumulator(txns[:count]).root == accumulator.root
+
+	# refreshing the coinbase only touches its path, the root has to match a full rebuild
+	coinbase = Transaction.create_coinbase('1MfsCiTUcbQiCR2UGFxL9GgzSmwQBZJWqV', 500000)
+	accumulator.replace(0, coinbase)
+	assert accumulator.root == MerkleNode.generate_root_from_transaction([coinbase, *txns[1:]]).value
+	assert MerkleAccumulator(genesis_transactions).root == MerkleNode.generate_root_from_transaction(genesis_transactions).value
+
+
+def test_merkle_proofs():
+	txns = [Transaction.create_coinbase('1MfsCiTUcbQiCR2UGFxL9GgzSmwQBZJWqV', value) for value in range(1, 8)]
+	root = MerkleNode.generate_root_from_transaction(txns).value
+
+	proofs = MerkleAccumulator(txns).proofs((txn.id, position) for position, txn in enumerate(txns))
+	for position, (txn, proof) in enumerate(zip(txns, proofs)):
+		assert proof == MerkleAccumulator(txns).proof(txn.id, position)
+		assert len(proof.branch) == 3
+		assert proof.verify(root)
+		assert MerkleProof.deserialize_binary(proof.serialize_binary()) == proof
+		assert MerkleProof.deserialize(proof.serialize()) == proof
+
+	# wrong position, wrong txid, tampered branch
+	assert not proofs[0]._replace(position=1).verify(root)
+	assert not proofs[0]._replace(position=8).verify(root)
+	assert not proofs[0]._replace(txid=txns[1].id).verify(root)
+	assert not proofs[0]._replace(branch=[bytes(32), *proofs[0].branch[1:]]).verify(root)
+
+	# the last leaf of an odd level doesn't also verify at the position after it, which its copy pads
+	odd = MerkleAccumulator(txns[:3])
+	last = odd.proof(txns[2].id, 2)
+	assert last.verify(odd.root)
+	assert not last._replace(position=3).verify(odd.root)
+	odd = MerkleAccumulator(txns[:5])
+	assert not odd.proof(txns[4].id, 4)._replace(position=5).verify(odd.root)
+
+	# a single txn block has the txid's leaf as its root
+	assert MerkleAccumulator(txns[:1]).proof(txns[0].id, 0).verify(sha256d(txns[0].id))
+
+	block_proofs = genesis_block.merkle_proofs([genesis_transactions[0].id, b'unknown'])
+	assert block_proofs[0].verify(MerkleNode.generate_root_from_transaction(genesis_transactions).value)
+	assert block_proofs[1] is None
+
+def test_parallel_mine():
+	block = genesis_block.mine(processes=2)
+	assert int.from_bytes(block.id, 'big') < block.target
+
+
+def test_parallel_mine_interrupt():
+	import threading
+
+	# diff1 target, two processes won't find this before the interrupt fires
+	hard_block = genesis_block._replace(nbits=0x1d00ffff)
+	threading.Timer(0.5, ChainManager.mine_interrupt.set).start()
+	assert hard_block.mine(processes=2) is None
+
+
+def test_parallel_mine_exhausted_nonce_space(monkeypatch):
+	import blockchain
+	from hashers import select_hasher
+
+	# a 1 in 16 target over a 4 nonce space, start from headers with no solution in it so every
+	# search has to roll at least once
+	monkeypatch.setattr(blockchain, 'NONCE_SPACE', 4)
+	hasher = select_hasher(None)
+
+	def exhausted(block):
+		return hasher.scan(block._base_hash, block.target, 0, blockchain.NONCE_SPACE) is None
+
+	block = genesis_block._replace(nbits=0x20100000)
+	while not exhausted(block):
+		block = block._replace(timestamp=block.timestamp + 1)
+
+	mined = block.mine(processes=2)
+	assert mined.timestamp > block.timestamp
+	assert int.from_bytes(mined.id, 'big') < mined.target
+
+	# with a template the coinbase gets refreshed instead, the timestamp stays put
+	txns = [Transaction.create_coinbase(address_2, value) for value in range(1, 4)]
+	template = blockchain.BlockTemplate(genesis_block._replace(nbits=0x20100000, txns=txns), address_1)
+	while not exhausted(template.block):
+		template.refresh_coinbase()
+	start = template.block
+
+	mined = start.mine(processes=2, template=template)
+	assert mined.timestamp == start.timestamp
+	assert mined.txns[0] != start.txns[0]
+	assert mined.txns[1:] == txns
+	assert mined.merkle_tree_hash == MerkleNode.generate_root_from_transaction(mined.txns).value
+	assert int.from_bytes(mined.id, 'big') < mined.target
+
+
+def test_block_template(monkeypatch):
+	import blockchain
+
+	txns = [Transaction.create_coinbase(address_2, value) for value in range(1, 10)]
+	header = genesis_block._replace(txns=txns)
+	template = blockchain.BlockTemplate(header, address_1)
+	assert template.block.txns[1:] == txns
+	assert template.block.merkle_tree_hash == MerkleNode.generate_root_from_transaction(template.block.txns).value
+
+	# a refresh swaps the coinbase leaf, the tree isn't built again
+	def rebuild(*args):
+		raise AssertionError('rebuilt the merkle tree')
+	monkeypatch.setattr(blockchain.MerkleAccumulator, '__init__', rebuild)
+	refreshed = template.refresh_coinbase(fees=1000)
+	assert refreshed.txns[0].txouts[0].value == blockchain.BLOCK_SUBSIDY + 1000
+	assert refreshed.txns[1:] == txns
+	assert refreshed.merkle_tree_hash == MerkleNode.generate_root_from_transaction(refreshed.txns).value
+
+	# mining it, an exhausted nonce space gets a new coinbase instead of a later timestamp
+	class ExhaustedOnce:
+		scans = 0
+
+		def scan(self, template, target, start, end):
+			self.scans += 1
+			return None if self.scans == 1 else 0
+
+	hasher = ExhaustedOnce()
+	monkeypatch.setattr(blockchain, 'select_hasher', lambda name: hasher)
+	mined = template.block.mine(template=template)
+	assert hasher.scans == 2
+	assert mined.timestamp == refreshed.timestamp
+	assert mined.txns[1:] == txns
+	assert mined.merkle_tree_hash == MerkleNode.generate_root_from_transaction(mined.txns).value
+
+
+def test_canonical_txid():
+	import transaction
+
+	txn = genesis_transactions[0]
+	assert txn.id != txn.legacy_id
+
+	# the txid survives a json round trip even though the outpoint txids come back as hex strings
+	spend = Transaction(
+		txins=[TxIn(outpoint=OutPoint(txn.id, 0), signature=SignatureScript(b'sig', b'pk'), sequence=0)],
+		txouts=[TxOut(value=1000, pubkey=address_2)]
+	)
+	assert Transaction.deserialize(spend.serialize()).id == spend.id
+
+	# cross check mode: every distinct legacy txid gets a distinct canonical txid
+	transaction.txid_crosscheck = transaction.TxidCrosscheck()
+	try:
+		txns = [
+			Transaction(txins=spend.txins, txouts=[TxOut(value=value, pubkey=address_2)], locktime=locktime)
+			for value in range(50) for locktime in (None, 1)
+		]
+		assert len({txn.id for txn in txns}) == len(transaction.txid_crosscheck.by_legacy) == 100
+
+		with pytest.raises(ValueError):
+			transaction.txid_crosscheck.check(txns[0], txns[1].id)
+
+		# None and 0 are different locktimes to the json as well, no false positive
+		assert Transaction(txins=spend.txins, txouts=spend.txouts, locktime=None).id != \
+			Transaction(txins=spend.txins, txouts=spend.txouts, locktime=0).id
+	finally:
+		transaction.txid_crosscheck = None
+
+
+def test_canonical_encoding_is_injective():
+	txin = TxIn(outpoint=OutPoint(bytes(32), 0), signature=None, sequence=None)
+	txout = TxOut(value=1000, pubkey=address_2)
+
+	def txid(txin=txin, txout=txout, locktime=None):
+		return Transaction(txins=[txin], txouts=[txout], locktime=locktime).id
+
+	variants = [
+		txid(), txid(locktime=0),
+		txid(txin._replace(sequence=0)),
+		txid(txin._replace(signature=SignatureScript(None, None))),
+		txid(txin._replace(signature=SignatureScript(b'', b''))),
+		txid(txout=txout._replace(pubkey=address_2.encode())),
+		# the txid isn't fixed width, its length is part of the encoding
+		txid(txin._replace(outpoint=OutPoint(bytes(31), 0))),
+		txid(txin._replace(outpoint=None)),
+	]
+	assert len(set(variants)) == len(variants)
+
+	# an empty signature comes back from json as bytes, the txid doesn't change
+	signed = Transaction(txins=[txin._replace(signature=SignatureScript(b'', b''))], txouts=[txout])
+	assert Transaction.deserialize(signed.serialize()).id == signed.id
 
 
 def test_block():
 	utxo_mgr = UTXOManager()
-	utxo_mgr.utxo_set.clear()
+	utxo_mgr.clear()
 
 	chain_mgr = ChainManager()
 	chain_mgr.add_block_to_chain(block_with_nonce)
@@ -0,0 +1,138 @@
+from blockchain import Block
+from blockstore import BlockStore, INDEX_RECORD
+from chainmanager import ChainManager
+from mempool import Mempool
+from transaction import UTXOManager, OutPoint
+from utxostore import SqliteUTXOSet
+from utils import Singleton
+from test_chainmanager import chain_mgr, make_block, make_chain, assert_index_consistent, ids, spend
+
+
+def test_block_store_reopen(tmp_path):
+	genesis = make_block()
+	blocks = [genesis, *make_chain(genesis, 3)]
+
+	store = BlockStore(str(tmp_path))
+	for block in blocks:
+		store.append(block)
+		assert store.get(block.id) == block
+
+	store.append(genesis)
+	assert len(store) == len(blocks)
+	store.close()
+
+	# a torn index write at the end gets dropped on reopen
+	with open(store.index_path, 'ab') as index_file:
+		index_file.write(b'\x00' * (INDEX_RECORD.size // 2))
+
+	reopened = BlockStore(str(tmp_path))
+	assert list(reopened.hashes()) == [block.id for block in blocks]
+	assert reopened.get(blocks[2].id) == blocks[2]
+	assert reopened.get(b'\x00' * 32) is None
+
+	reopened.append(make_block(blocks[-1]))
+	assert len(BlockStore(str(tmp_path))) == len(blocks) + 1
+
+
+def test_chain_manager_writes_through(chain_mgr, tmp_path):
+	chain_mgr.block_store = BlockStore(str(tmp_path))
+	genesis = make_block()
+	chain_mgr.add_block_to_chain(genesis)
+
+	assert genesis.id in chain_mgr.block_store
+	assert chain_mgr.get_block(genesis.id) == genesis
+
+
+def test_chain_manager_reorgs_off_the_store(chain_mgr, tmp_path):
+	chain_mgr.block_store = BlockStore(str(tmp_path))
+	genesis = make_block()
+	active = make_chain(genesis, 2)
+	fork = make_chain(genesis, 3, timestamp=1507593700)
+	for block in [genesis, *active, *fork]:
+		chain_mgr.add_block_to_chain(block)
+
+	# the chains only hold header records, the reorg loaded the fork's bodies back from the files
+	assert ids(chain_mgr.active_chain) == ids([genesis, *fork])
+	assert len(chain_mgr.block_store) == 6
+	assert chain_mgr.find_by_id(fork[-1].id) == fork[-1]
+	assert_index_consistent(chain_mgr)
+
+
+def test_chain_manager_load(chain_mgr, tmp_path, monkeypatch):
+	UTXOManager().use_store(SqliteUTXOSet(str(tmp_path / 'utxo.sqlite')))
+	chain_mgr.block_store = BlockStore(str(tmp_path / 'blocks'))
+	genesis = make_block()
+	active = make_chain(genesis, 3)
+	fork = make_chain(genesis, 2, timestamp=1507593700)
+	for block in [genesis, *active, *fork]:
+		chain_mgr.add_block_to_chain(block)
+	utxos = dict(UTXOManager().utxo_set)
+	chain_mgr.block_store.close()
+	UTXOManager().utxo_set.close()
+
+	for cls in (ChainManager, UTXOManager, Mempool):
+		Singleton._instances.pop(cls, None)
+	UTXOManager().use_store(SqliteUTXOSet(str(tmp_path / 'utxo.sqlite')))
+
+	# a restart only reads the headers, no block body gets decoded
+	def parse_body(data):
+		raise AssertionError('parsed a whole block')
+	monkeypatch.setattr(Block, 'deserialize_binary', parse_body)
+	chain_mgr = ChainManager()
+	chain_mgr.load(BlockStore(str(tmp_path / 'blocks')))
+	monkeypatch.undo()
+
+	assert ids(chain_mgr.active_chain) == ids([genesis, *active])
+	assert list(map(ids, chain_mgr.side_branches)) == [ids(fork)]
+	assert chain_mgr.header_chain.best_tip.id == active[-1].id
+	assert dict(UTXOManager().utxo_set) == utxos
+	assert not chain_mgr.tx_index
+
+	# the chain carries on from where it was, the fork still reorgs once it has more work
+	more_fork = make_chain(fork[-1], 3, timestamp=1507593800)
+	for block in more_fork:
+		chain_mgr.add_block_to_chain(block)
+	assert ids(chain_mgr.active_chain) == ids([genesis, *fork, *more_fork])
+
+
+def test_chain_manager_load_txns(chain_mgr, tmp_path):
+	genesis = make_block()
+	blocks = [genesis, *make_chain(genesis, 2)]
+	chain_mgr.block_store = BlockStore(str(tmp_path))
+	for block in blocks:
+		chain_mgr.add_block_to_chain(block)
+	chain_mgr.block_store.close()
+
+	Singleton._instances.pop(ChainManager, None)
+	chain_mgr = ChainManager()
+	chain_mgr.load(BlockStore(str(tmp_path)), index_txns=True)
+	assert_index_consistent(chain_mgr)
+
+
+def test_chain_manager_load_disconnects_spends(chain_mgr, tmp_path):
+	UTXOManager().use_store(SqliteUTXOSet(str(tmp_path / 'utxo.sqlite')))
+	chain_mgr.block_store = BlockStore(str(tmp_path / 'blocks'))
+	genesis = make_block()
+	chain_mgr.add_block_to_chain(genesis)
+	before = dict(UTXOManager().utxo_set)
+	active = make_block(genesis, txns=[spend(genesis.txns[0])])
+	chain_mgr.add_block_to_chain(active)
+	chain_mgr.block_store.close()
+	UTXOManager().utxo_set.close()
+
+	for cls in (ChainManager, UTXOManager, Mempool):
+		Singleton._instances.pop(cls, None)
+	UTXOManager().use_store(SqliteUTXOSet(str(tmp_path / 'utxo.sqlite')))
+	chain_mgr = ChainManager()
+	chain_mgr.load(BlockStore(str(tmp_path / 'blocks')))
+
+	# the undo record came back with the block, tx_index is empty but the spend still gets undone
+	assert chain_mgr.block_store.get_undo(active.id).spent_utxos == list(before.values())
+	fork = make_chain(genesis, 2, timestamp=1507593700)
+	for block in fork:
+		chain_mgr.add_block_to_chain(block)
+
+	utxo_set = UTXOManager().utxo_set
+	assert ids(chain_mgr.active_chain) == ids([genesis, *fork])
+	assert utxo_set[OutPoint(genesis.txns[0].id, 0)] == before[OutPoint(genesis.txns[0].id, 0)]
+	assert OutPoint(active.txns[1].id, 0) not in utxo_set
@@ -0,0 +1,222 @@
+import pytest
+
+from blockchain import Block, REGTEST_NBITS
+from transaction import Transaction, UnspentTxOut, TxIn, TxOut, OutPoint, SignatureScript, MerkleNode, UTXOManager
+from chainmanager import ChainManager
+from mempool import Mempool
+from utils import Singleton
+
+address = '1MfsCiTUcbQiCR2UGFxL9GgzSmwQBZJWqV'
+
+
+@pytest.fixture
+def chain_mgr():
+	# start every test from empty chain, utxo and mempool singletons
+	for cls in (ChainManager, UTXOManager, Mempool):
+		Singleton._instances.pop(cls, None)
+	return ChainManager()
+
+
+def make_block(prev_block=None, timestamp=1507593600, txns=()):
+	txns = [Transaction.create_coinbase(address, 500000), *txns]
+
+	# regtest difficulty, pretty much every nonce is a solution
+	return Block(
+		version=0,
+		previous_block_hash=prev_block.id if prev_block else None,
+		merkle_tree_hash=MerkleNode.generate_root_from_transaction(txns).value,
+		timestamp=timestamp,
+		nbits=REGTEST_NBITS,
+		nonce=0,
+		txns=txns
+	).mine()
+
+
+def make_chain(prev_block, length, timestamp=1507593600):
+	blocks = []
+	for i in range(length):
+		prev_block = make_block(prev_block, timestamp + i)
+		blocks.append(prev_block)
+	return blocks
+
+
+def ids(chain):
+	"""
+	the hashes of a list of blocks or of header records, to compare one with the other
+	"""
+	return [block.id for block in chain]
+
+
+def assert_index_consistent(chain_mgr):
+	chains = [chain_mgr.active_chain, *chain_mgr.side_branches]
+	assert len(chain_mgr.block_index) == sum(len(chain) for chain in chains)
+
+	for chain_idx, chain in enumerate(chains):
+		for record in chain:
+			assert chain_mgr.locate_block(record.id) == (record, record.height, chain_idx)
+			assert record.parent is chain_mgr.header_chain.get(record.previous_block_hash)
+
+	for height, record in enumerate(chain_mgr.active_chain):
+		assert record.height == height
+
+	# only the active chain's transactions are indexed, bodies come from the block store
+	blocks = [chain_mgr.get_block(record.id) for record in chain_mgr.active_chain]
+	assert len(chain_mgr.tx_index) == sum(len(block.txns) for block in blocks)
+	for height, block in enumerate(blocks):
+		for txn in block.txns:
+			assert chain_mgr.locate_txn(txn.id) == (txn, block, height)
+
+
+def test_block_index(chain_mgr):
+	genesis = make_block()
+	active = make_chain(genesis, 2)
+	for block in [genesis, *active]:
+		assert chain_mgr.add_block_to_chain(block) == ChainManager.ACTIVE_CHAIN_IDX
+
+	fork = make_chain(genesis, 2, timestamp=1507593700)
+	for block in fork:
+		assert chain_mgr.add_block_to_chain(block) == 1
+
+	assert chain_mgr.find_by_id(active[-1].id) == active[-1]
+	assert chain_mgr.find_by_id(fork[-1].id) is None
+	assert chain_mgr.locate_block(fork[-1].id, chain=chain_mgr.active_chain) == (None, None, None)
+	assert_index_consistent(chain_mgr)
+
+	# a block whose parent we haven't seen goes to the orphans
+	assert chain_mgr.add_block_to_chain(make_block(make_block())) is None
+	assert len(chain_mgr.orphan_blocks) == 1
+
+
+def test_block_index_reorg(chain_mgr):
+	genesis = make_block()
+	active = make_chain(genesis, 2)
+	for block in [genesis, *active]:
+		chain_mgr.add_block_to_chain(block)
+
+	fork = make_chain(genesis, 4, timestamp=1507593700)
+	for block in fork:
+		chain_mgr.add_block_to_chain(block)
+
+	assert ids(chain_mgr.active_chain) == ids([genesis, *fork])
+	assert list(map(ids, chain_mgr.side_branches)) == [ids(active)]
+	assert_index_consistent(chain_mgr)
+
+
+def test_chainwork_reorg(chain_mgr):
+	genesis = make_block()
+	active = make_chain(genesis, 2)
+	for block in [genesis, *active]:
+		chain_mgr.add_block_to_chain(block)
+	assert chain_mgr.block_index[active[-1].id].chainwork == 3 * 2
+
+	# one block more than the active chain is enough
+	fork = make_chain(active[0], 2, timestamp=1507593700)
+	for block in fork:
+		chain_mgr.add_block_to_chain(block)
+	assert ids(chain_mgr.active_chain) == ids([genesis, active[0], *fork])
+	assert list(map(ids, chain_mgr.side_branches)) == [ids(active[1:])]
+
+	# a single block of higher difficulty outweighs the longer chain
+	heavy = make_block(genesis, timestamp=1507593800)._replace(nbits=0x2000ffff).mine()
+	chain_mgr.add_block_to_chain(heavy)
+	assert ids(chain_mgr.active_chain) == ids([genesis, heavy])
+	assert chain_mgr.block_index[heavy.id].chainwork == 2 + 256
+	assert_index_consistent(chain_mgr)
+
+
+def test_nested_branch_reorg(chain_mgr):
+	genesis = make_block()
+	active = make_chain(genesis, 3)
+	for block in [genesis, *active]:
+		chain_mgr.add_block_to_chain(block)
+
+	# a branch off a side branch, the reorg connects the start of one and the whole of the other
+	branch = make_chain(genesis, 2, timestamp=1507593700)
+	nested = make_chain(branch[0], 3, timestamp=1507593800)
+	for block in [*branch, *nested]:
+		chain_mgr.add_block_to_chain(block)
+
+	assert ids(chain_mgr.active_chain) == ids([genesis, branch[0], *nested])
+	assert list(map(ids, chain_mgr.side_branches)) == [ids(branch[1:]), ids(active)]
+	assert_index_consistent(chain_mgr)
+
+
+def spend(txn, txout_idx=0, pubkey=address, fee=0):
+	return Transaction(
+		txins=[TxIn(outpoint=OutPoint(txn.id, txout_idx), signature=SignatureScript(b'', b''), sequence=0)],
+		txouts=[TxOut(value=txn.txouts[txout_idx].value - fee, pubkey=pubkey)]
+	)
+
+
+def test_undo_reorg(chain_mgr):
+	utxo_set = UTXOManager().utxo_set
+
+	genesis = make_block()
+	chain_mgr.add_block_to_chain(genesis)
+	before = dict(utxo_set)
+
+	spend_genesis = spend(genesis.txns[0])
+	spend_again = spend(spend_genesis)
+	active = make_block(genesis, txns=[spend_genesis, spend_again])
+	chain_mgr.add_block_to_chain(active)
+
+	assert genesis.txns[0].id not in {outpoint.txid for outpoint in utxo_set}
+
+	# the undo record holds the genesis output as well as the one created and spent within the block
+	spent_utxos = chain_mgr.block_store.get_undo(active.id).spent_utxos
+	assert len(spent_utxos) == 2
+	assert before[OutPoint(genesis.txns[0].id, 0)] in spent_utxos
+
+	fork = make_chain(genesis, 3, timestamp=1507593700)
+	for block in fork:
+		chain_mgr.add_block_to_chain(block)
+
+	assert ids(chain_mgr.active_chain) == ids([genesis, *fork])
+	assert utxo_set == {
+		**before,
+		**{OutPoint(block.txns[0].id, 0): UnspentTxOut(
+			value=500000, pubkey=address, txid=block.txns[0].id, txout_idx=0, is_coinbase=True, height=height
+		) for height, block in enumerate(fork, 2)}
+	}
+
+	# the address index followed every add and remove
+	utxo_mgr = UTXOManager()
+	assert set(utxo_mgr.get_utxos_for_addr(address)) == set(utxo_set.values())
+	assert utxo_mgr.get_current_balance_for_addr(address) == 500000 * 4
+	assert utxo_mgr.get_current_balance_for_addr('nobody') == 0
+
+
+def test_reorg_without_undo(chain_mgr):
+	utxo_set = UTXOManager().utxo_set
+
+	genesis = make_block()
+	chain_mgr.add_block_to_chain(genesis)
+	before = dict(utxo_set)
+	active = make_block(genesis, txns=[spend(genesis.txns[0])])
+	chain_mgr.add_block_to_chain(active)
+
+	# without its undo record, or the txn in tx_index, the spent txout is looked up in the chain's
+	# bodies, and restored at the height it got connected at
+	chain_mgr.block_store.undo.clear()
+	chain_mgr.tx_index.clear()
+	for block in make_chain(genesis, 2, timestamp=1507593700):
+		chain_mgr.add_block_to_chain(block)
+
+	assert utxo_set[OutPoint(genesis.txns[0].id, 0)] == before[OutPoint(genesis.txns[0].id, 0)]
+
+
+def test_merkle_proofs(chain_mgr):
+	genesis = make_block()
+	block = make_block(genesis, txns=[Transaction.create_coinbase(address, value) for value in range(1, 5)])
+	fork = make_block(genesis, timestamp=1507593700)
+	for b in (genesis, block, fork):
+		chain_mgr.add_block_to_chain(b)
+
+	txids = [txn.id for txn in block.txns] + [genesis.txns[0].id, fork.txns[0].id]
+	proofs = chain_mgr.merkle_proofs(txids)
+
+	# the side branch's coinbase isn't confirmed
+	assert set(proofs) == set(txids[:-1])
+	for txid, (block_hash, proof) in proofs.items():
+		assert proof.txid == txid
+		assert proof.verify(chain_mgr.find_by_id(block_hash).merkle_tree_hash)
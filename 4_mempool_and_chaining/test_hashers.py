@@ -0,0 +1,28 @@
+import pytest
+
+from hashers import PythonHasher, NumpyBatchHasher, select_hasher, hasher_registry
+
+
+def test_select_hasher():
+	assert select_hasher().name in hasher_registry
+	assert isinstance(select_hasher('python'), PythonHasher)
+
+
+@pytest.mark.parametrize('template_len', [10, 63, 64, 76, 130])
+def test_numpy_matches_reference(template_len):
+	pytest.importorskip('numpy')
+
+	template = bytes(range(template_len))
+	target = 2 ** 248
+	reference = PythonHasher().scan(template, target, 0, 5000)
+
+	assert reference is not None
+	assert NumpyBatchHasher(batch_size=1000).scan(template, target, 0, 5000) == reference
+	assert NumpyBatchHasher(batch_size=1000).scan(template, target, reference + 1, reference + 1) is None
+
+
+def test_mine_with_numpy_hasher():
+	pytest.importorskip('numpy')
+	from benchmark import sample_block
+
+	assert sample_block().mine(hasher='numpy').nonce == sample_block().mine(hasher='python').nonce
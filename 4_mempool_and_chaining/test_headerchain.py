@@ -0,0 +1,184 @@
+import pytest
+
+from blockchain import REGTEST_NBITS
+from headerchain import HeaderChain, block_work
+from validation import ValidationError
+from test_chainmanager import chain_mgr, make_block, make_chain, assert_index_consistent, ids
+
+
+class Peer:
+	"""
+	serves headers and bodies of the blocks it was given, counting the bodies asked for
+	"""
+
+	def __init__(self, blocks, limit=3):
+		self.header_chain = HeaderChain()
+		self.blocks = {}
+		self.limit = limit
+		self.bodies_fetched = 0
+		for block in blocks:
+			self.header_chain.add_header(block, validate=False)
+			self.blocks[block.id] = block
+
+	def get_headers(self, locator):
+		return self.header_chain.headers_after(locator, limit=self.limit)
+
+	def get_block(self, block_hash):
+		self.bodies_fetched += 1
+		return self.blocks.get(block_hash)
+
+
+@pytest.fixture
+def chains():
+	"""
+	a genesis block, the 4 blocks of the best chain after it and a fork of 2 off its second block
+	"""
+	genesis = make_block()
+	best = make_chain(genesis, 4, timestamp=1507593601)
+	fork = make_chain(best[1], 2, timestamp=1507593700)
+	return genesis, best, fork
+
+
+def test_block_work():
+	assert block_work(REGTEST_NBITS) == 2
+	assert block_work(0x1d00ffff) == 0x100010001
+
+
+def test_header_chain(chains):
+	genesis, best, fork = chains
+	header_chain = HeaderChain(REGTEST_NBITS)
+	for block in [genesis, *best, *fork]:
+		header_chain.add_header(block)
+
+	assert len(header_chain) == 7
+	assert header_chain.best_tip.hash == best[-1].id
+	assert header_chain.best_tip.height == 4
+	assert header_chain.best_tip.chainwork == 5 * block_work(genesis.nbits)
+	assert header_chain.get(fork[-1].id).height == 4
+
+	# same work, the fork doesn't take over the best tip until it has more
+	assert header_chain.get(fork[-1].id).chainwork == header_chain.best_tip.chainwork
+	longer = make_block(fork[-1], timestamp=1507593702)
+	header_chain.add_header(longer)
+	assert header_chain.best_tip.hash == longer.id
+
+	fork_point = HeaderChain.fork_point(header_chain.get(best[-1].id), header_chain.get(fork[0].id))
+	assert fork_point.hash == best[1].id
+	assert [record.hash for record in HeaderChain.path(header_chain.best_tip, 3)] == [
+		block.id for block in [*fork, longer]]
+
+	# records give back the header the block was built with
+	assert header_chain.get(best[0].id).to_block() == best[0]._replace(txns=[])
+	assert header_chain.get(best[0].id).to_block().id == best[0].id
+
+
+def test_locator(chains):
+	genesis, _, _ = chains
+	header_chain = HeaderChain(REGTEST_NBITS)
+	blocks = [genesis, *make_chain(genesis, 30, timestamp=1507593601)]
+	for block in blocks:
+		header_chain.add_header(block)
+
+	locator = header_chain.locator()
+	heights = [header_chain.get(block_hash).height for block_hash in locator]
+	assert heights == [30, 29, 28, 27, 26, 25, 24, 23, 22, 21, 19, 15, 7, 0]
+
+	assert header_chain.headers_after(locator) == []
+	assert header_chain.headers_after([blocks[27].id, blocks[5].id]) == [
+		block._replace(txns=[]) for block in blocks[28:]]
+	assert header_chain.headers_after([b'unknown'], limit=2) == [block._replace(txns=[]) for block in blocks[:2]]
+
+
+def test_invalid_headers(chains):
+	genesis, best, _ = chains
+	header_chain = HeaderChain(REGTEST_NBITS)
+	header_chain.add_header(genesis)
+
+	with pytest.raises(ValidationError, match='unknown parent'):
+		header_chain.add_header(best[1])
+
+	unsolved = best[0]
+	while int.from_bytes(unsolved.id, byteorder='big') < unsolved.target:
+		unsolved = unsolved._replace(nonce=unsolved.nonce + 1)
+	with pytest.raises(ValidationError, match='target'):
+		header_chain.add_header(unsolved)
+
+	# solved, but at a difficulty other than the chain's
+	off_difficulty = best[0]._replace(nbits=0x2000ffff).mine()
+	with pytest.raises(ValidationError, match='nbits'):
+		header_chain.add_header(off_difficulty)
+
+	assert len(header_chain) == 1
+
+
+def test_sync_headers_first(chain_mgr, chains):
+	genesis, best, fork = chains
+	chain_mgr.header_chain.nbits = REGTEST_NBITS
+	for block in [genesis, *best[:2]]:
+		chain_mgr.add_block_to_chain(block)
+
+	peer = Peer([genesis, *best, *fork])
+	assert chain_mgr.sync_headers_first(peer, workers=2) == 2
+
+	# the peer only sent the two bodies we didn't have, none of the fork's
+	assert peer.bodies_fetched == 2
+	assert ids(chain_mgr.active_chain) == ids([genesis, *best])
+	assert chain_mgr.header_chain.best_tip.hash == best[-1].id
+	assert_index_consistent(chain_mgr)
+
+	assert chain_mgr.sync_headers_first(peer) == 0
+	assert peer.bodies_fetched == 2
+
+
+def test_sync_invalid_header(chain_mgr, chains):
+	genesis, best, _ = chains
+	chain_mgr.header_chain.nbits = REGTEST_NBITS
+	chain_mgr.add_block_to_chain(genesis)
+
+	unsolved = best[2]
+	while int.from_bytes(unsolved.id, byteorder='big') < unsolved.target:
+		unsolved = unsolved._replace(nonce=unsolved.nonce + 1)
+	peer = Peer([genesis, *best[:2], unsolved])
+
+	# turned down on the headers alone, not a single body is downloaded. The valid headers that led up
+	# to it are dropped too, they don't get to be the best tip
+	assert chain_mgr.sync_headers_first(peer) == 0
+	assert peer.bodies_fetched == 0
+	assert unsolved.id not in chain_mgr.header_chain
+	assert best[0].id not in chain_mgr.header_chain
+	assert chain_mgr.header_chain.best_tip.hash == genesis.id
+	assert ids(chain_mgr.active_chain) == [genesis.id]
+
+	# nor for a chain of headers mined at a lower difficulty than the chain's
+	easy = [make_block(genesis, timestamp=1507593601)._replace(nbits=0x2000ffff).mine()]
+	peer = Peer([genesis, *easy])
+	chain_mgr.header_chain.nbits = 0x1f00ffff
+	assert chain_mgr.sync_headers_first(peer) == 0
+	assert peer.bodies_fetched == 0
+	assert easy[0].id not in chain_mgr.header_chain
+
+
+def test_sync_stops_at_a_bad_body(chain_mgr, chains):
+	import threading
+
+	genesis, best, _ = chains
+	chain_mgr.header_chain.nbits = REGTEST_NBITS
+	chain_mgr.add_block_to_chain(genesis)
+
+	class BadBodyPeer(Peer):
+		def get_headers(self, locator):
+			# nothing else gets to touch the chain while the headers come in
+			locked = []
+			thread = threading.Thread(target=lambda: locked.append(not chain_mgr.chain_lock.acquire(blocking=False)))
+			thread.start()
+			thread.join()
+			assert locked == [True]
+			return super().get_headers(locator)
+
+	peer = BadBodyPeer([genesis, *best], limit=10)
+	peer.blocks[best[0].id] = best[1]
+
+	# the fetches queued behind the wrong body are cancelled, only the one running alongside it is sent
+	assert chain_mgr.sync_headers_first(peer, workers=1) == 0
+	assert peer.bodies_fetched <= 2
+	assert ids(chain_mgr.active_chain) == [genesis.id]
@@ -0,0 +1,239 @@
+import pytest
+
+import mempool as mempool_module
+
+from mempool import Mempool, estimate_memory, ENTRY_OVERHEAD, INCREMENTAL_RELAY_FEE_RATE
+from test_chainmanager import chain_mgr, make_block, spend
+
+
+@pytest.fixture
+def funded(chain_mgr):
+	"""
+	a chain of 5 blocks, their coinbases are there to be spent
+	"""
+	blocks = [make_block()]
+	for i in range(4):
+		blocks.append(make_block(blocks[-1], timestamp=1507593601 + i))
+	for block in blocks:
+		chain_mgr.add_block_to_chain(block)
+	return [block.txns[0] for block in blocks]
+
+
+def template(mempool, **kwargs):
+	return mempool.select_from_mempool(make_block(), **kwargs).txns[1:]
+
+
+def test_fee_rate_order(funded):
+	mempool = Mempool()
+	txns = [spend(coinbase, fee=fee) for coinbase, fee in zip(funded, (100, 500, 300, 200))]
+	for txn in txns:
+		mempool.add_txn_to_mempool(txn)
+
+	assert [mempool.entries[txn.id].fee for txn in txns] == [100, 500, 300, 200]
+	assert template(mempool) == [txns[1], txns[2], txns[3], txns[0]]
+
+	# selecting doesn't take anything out of the mempool
+	assert template(mempool) == [txns[1], txns[2], txns[3], txns[0]]
+
+	# only what fits
+	assert template(mempool, max_bytes=2 * txns[0].size) == [txns[1], txns[2]]
+
+	# unknown inputs are refused
+	mempool.add_txn_to_mempool(spend(spend(funded[4])))
+	assert len(mempool.mempool_dict) == 4
+
+
+def test_parent_before_child(funded):
+	mempool = Mempool()
+	parent = spend(funded[0], fee=10)
+	child = spend(parent, fee=1000)
+	other = spend(funded[1], fee=100)
+
+	for txn in (child, parent, other):
+		mempool.add_txn_to_mempool(txn)
+	assert child.id not in mempool.mempool_dict
+
+	mempool.add_txn_to_mempool(child)
+	assert template(mempool) == [parent, child, other]
+
+	# the child's package doesn't fit, on its own the parent doesn't beat other
+	assert template(mempool, max_bytes=other.size) == [other]
+
+
+def test_lazy_deletion(chain_mgr, funded):
+	mempool = Mempool()
+	txns = [spend(coinbase, fee=100 * (i + 1)) for i, coinbase in enumerate(funded)]
+	for txn in txns:
+		mempool.add_txn_to_mempool(txn)
+
+	# connecting a block takes its txns out of the mempool, their heap items go stale
+	block = make_block(chain_mgr.active_chain[-1], txns=txns[3:])
+	chain_mgr.add_block_to_chain(block)
+	assert set(mempool.mempool_dict) == {txn.id for txn in txns[:3]}
+	assert len(mempool.mempool_heap) == 5
+
+	assert template(mempool) == [txns[2], txns[1], txns[0]]
+	assert len(mempool.mempool_heap) == 3
+
+	# a disconnected block's txns come back with fresh heap items
+	chain_mgr.remove_block_from_chain(block)
+	assert template(mempool) == txns[::-1]
+
+
+def test_ancestor_packages(chain_mgr, funded):
+	mempool = Mempool()
+	parent = spend(funded[0], fee=100)
+	child = spend(parent, fee=100)
+	grandchild = spend(child, fee=8000)
+	rich = spend(funded[1], fee=2000)
+	poor = spend(funded[2], fee=50)
+
+	for txn in (parent, child, grandchild, rich, poor):
+		mempool.add_txn_to_mempool(txn)
+
+	entry = mempool.entries[grandchild.id]
+	assert (entry.ancestor_fee, entry.ancestor_count) == (8200, 3)
+	assert entry.ancestor_size == parent.size + child.size + grandchild.size
+	assert mempool.descendants(parent.id) == {child.id, grandchild.id}
+	assert mempool.ancestors(grandchild.id) == {parent.id, child.id}
+
+	# 8200 over three txns beats rich's 2000, poor goes last
+	assert template(mempool) == [parent, child, grandchild, rich, poor]
+
+	# mining the parent takes it out of its descendants' aggregates
+	block = make_block(chain_mgr.active_chain[-1], txns=[parent])
+	chain_mgr.add_block_to_chain(block)
+	entry = mempool.entries[grandchild.id]
+	assert (entry.ancestor_fee, entry.ancestor_count) == (8100, 2)
+	assert template(mempool) == [child, grandchild, rich, poor]
+
+	# and it's back in them once the block is disconnected again, though it's re-added after its children
+	chain_mgr.remove_block_from_chain(block)
+	entry = mempool.entries[grandchild.id]
+	assert (entry.ancestor_fee, entry.ancestor_count) == (8200, 3)
+	assert template(mempool) == [parent, child, grandchild, rich, poor]
+
+
+def test_descendant_state(funded):
+	mempool = Mempool()
+	parent = spend(funded[0], fee=100)
+	child = spend(parent, fee=300)
+	for txn in (parent, child):
+		mempool.add_txn_to_mempool(txn)
+
+	entry = mempool.entries[parent.id]
+	assert (entry.descendant_fee, entry.descendant_count) == (400, 2)
+	assert entry.descendant_size == parent.size + child.size
+
+	assert mempool.entries[child.id].memory == estimate_memory(child) + ENTRY_OVERHEAD > child.size
+	assert mempool.total_memory == sum(entry.memory for entry in mempool.entries.values())
+
+	mempool.remove_txn(child.id)
+	entry = mempool.entries[parent.id]
+	assert (entry.descendant_fee, entry.descendant_count) == (100, 1)
+	assert mempool.total_memory == entry.memory
+
+
+def test_eviction(funded, monkeypatch):
+	mempool = Mempool()
+	parent = spend(funded[0], fee=100)
+	child = spend(parent, fee=400)
+	rich = spend(funded[1], fee=1000)
+	middle = spend(funded[2], fee=300)
+	for txn in (parent, child, rich, middle):
+		mempool.add_txn_to_mempool(txn)
+
+	assert mempool.min_fee_rate() == 0
+
+	# one txn over the cap, the parent's package pays the least per byte (500 over two txns) so it
+	# goes as a whole
+	mempool.max_bytes = mempool.total_memory - 1
+	mempool._trim()
+	assert set(mempool.mempool_dict) == {rich.id, middle.id}
+	assert mempool.children == {funded[1].id: {rich.id}, funded[2].id: {middle.id}}
+	assert mempool.min_fee_rate() == pytest.approx(250 / parent.size + INCREMENTAL_RELAY_FEE_RATE)
+
+	# a txn under the minimum fee rate doesn't get in, unless it's coming back from a disconnected block
+	cheap = spend(funded[3], fee=200)
+	mempool.add_txn_to_mempool(cheap)
+	assert cheap.id not in mempool.mempool_dict
+
+	mempool.max_bytes = mempool.total_memory
+	mempool.add_txn_to_mempool(cheap, force=True)
+	assert set(mempool.mempool_dict) == {rich.id, middle.id}
+
+	mempool.max_bytes = mempool.entries[rich.id].memory
+	mempool._trim()
+	assert set(mempool.mempool_dict) == {rich.id}
+	assert mempool.min_fee_rate() == pytest.approx(300 / middle.size + INCREMENTAL_RELAY_FEE_RATE)
+
+	# a cheap child goes on its own, its parent stays
+	mempool.max_bytes *= 10
+	rate, mempool.rolling_min_fee_rate = mempool.rolling_min_fee_rate, 0.0
+	generous = spend(funded[3], fee=1500)
+	for txn in (generous, spend(generous, fee=100)):
+		mempool.add_txn_to_mempool(txn)
+	mempool.max_bytes = mempool.total_memory - 1
+	mempool._trim()
+	assert set(mempool.mempool_dict) == {rich.id, generous.id}
+	assert mempool.entries[generous.id].descendant_count == 1
+
+	# the minimum fee rate decays once evictions stop, faster with the mempool far from full
+	mempool.rolling_min_fee_rate, mempool.last_fee_update = rate, mempool_module.time.time()
+	mempool.max_bytes = mempool.total_memory * 10
+	now = mempool_module.time.time()
+	monkeypatch.setattr(mempool_module.time, 'time', lambda: now + mempool_module.ROLLING_FEE_HALFLIFE / 4)
+	assert mempool.min_fee_rate() == pytest.approx(rate / 2, rel=1e-3)
+
+	monkeypatch.setattr(mempool_module.time, 'time', lambda: now + mempool_module.ROLLING_FEE_HALFLIFE * 4)
+	assert mempool.min_fee_rate() == 0
+
+
+def assert_spent_outpoints(mempool):
+	assert mempool.spent_outpoints == {
+		txin.outpoint: txid for txid, txn in mempool.mempool_dict.items() for txin in txn.txins
+	}
+
+
+def test_replace_by_fee(funded):
+	mempool = Mempool()
+	original = spend(funded[0], fee=1000)
+	child = spend(original, fee=1000)
+	for txn in (original, child):
+		mempool.add_txn_to_mempool(txn)
+	assert_spent_outpoints(mempool)
+
+	double_spend = spend(funded[0], fee=1500, pubkey='1Q3DzrqjyK54rGxqan9aiEWgRN5RrQ4Whb')
+	assert mempool.conflicts(double_spend) == {original.id}
+
+	# a higher fee rate isn't enough, it has to pay for the child it evicts too
+	assert mempool.replaced_by(double_spend, 1500) is None
+	mempool.add_txn_to_mempool(double_spend)
+	assert set(mempool.mempool_dict) == {original.id, child.id}
+
+	# both fees plus its own relay
+	fee = 2000 + int(INCREMENTAL_RELAY_FEE_RATE * original.size) + 1
+	replacement = spend(funded[0], fee=fee, pubkey='1Q3DzrqjyK54rGxqan9aiEWgRN5RrQ4Whb')
+	assert mempool.replaced_by(replacement, fee) == {original.id, child.id}
+	mempool.add_txn_to_mempool(replacement)
+	assert set(mempool.mempool_dict) == {replacement.id}
+	assert mempool.children == {funded[0].id: {replacement.id}}
+	assert_spent_outpoints(mempool)
+
+
+def test_block_conflicts(chain_mgr, funded):
+	mempool = Mempool()
+	in_mempool = spend(funded[0], fee=100)
+	child = spend(in_mempool, fee=100)
+	unrelated = spend(funded[1], fee=100)
+	for txn in (in_mempool, child, unrelated):
+		mempool.add_txn_to_mempool(txn)
+
+	# the block spends the same coinbase differently, the mempool version and its child are double spends
+	double_spend = spend(funded[0], fee=10, pubkey='1Q3DzrqjyK54rGxqan9aiEWgRN5RrQ4Whb')
+	chain_mgr.add_block_to_chain(make_block(chain_mgr.active_chain[-1], txns=[double_spend]))
+
+	assert set(mempool.mempool_dict) == {unrelated.id}
+	assert set(mempool.entries) == {unrelated.id}
+	assert_spent_outpoints(mempool)
+	assert mempool.total_memory == mempool.entries[unrelated.id].memory
@@ -0,0 +1,134 @@
+import random
+import pytest
+
+from transaction import OutPoint, UnspentTxOut, UTXOManager
+from utxostore import CompactUTXOSet, SqliteUTXOSet
+from utils import Singleton
+
+
+@pytest.fixture(autouse=True)
+def utxo_manager():
+	# every test starts from a fresh singleton, and doesn't leave its store behind for the others
+	Singleton._instances.pop(UTXOManager, None)
+	yield
+	Singleton._instances.pop(UTXOManager, None)
+
+
+@pytest.fixture(params=['compact', 'sqlite'])
+def utxo_store(request, tmp_path):
+	if request.param == 'compact':
+		return CompactUTXOSet()
+
+	# a tiny cache so that eviction, and the pinning of dirty entries past it, get exercised
+	return SqliteUTXOSet(str(tmp_path / 'utxo.sqlite'), cache_size=16)
+
+
+def make_utxo(txid, txout_idx, value=1000, pubkey='1MfsCiTUcbQiCR2UGFxL9GgzSmwQBZJWqV', height=1):
+	return UnspentTxOut(
+		value=value, pubkey=pubkey, txid=txid, txout_idx=txout_idx, is_coinbase=txout_idx == 0, height=height)
+
+
+def test_utxo_store_matches_dict(utxo_store):
+	rng = random.Random(0)
+	reference, compact = {}, utxo_store
+
+	for i in range(2000):
+		txid = bytes([rng.randrange(20)]) * 32
+		utxo = make_utxo(txid, rng.randrange(3), value=rng.randrange(10 ** 9), pubkey=str(rng.randrange(5)), height=i)
+
+		if utxo.outpoint in reference and rng.random() < 0.5:
+			assert compact.pop(utxo.outpoint) == reference.pop(utxo.outpoint)
+		else:
+			reference[utxo.outpoint] = compact[utxo.outpoint] = utxo
+
+		assert len(compact) == len(reference)
+
+	assert dict(compact) == reference
+	for pubkey in map(str, range(6)):
+		utxos = [utxo for utxo in reference.values() if utxo.pubkey == pubkey]
+		assert sorted(compact.utxos_for_pubkey(pubkey)) == sorted(utxos)
+		assert compact.balance_for_pubkey(pubkey) == sum(utxo.value for utxo in utxos)
+	assert OutPoint(b'missing', 0) not in compact
+	assert None not in compact
+	with pytest.raises(KeyError):
+		del compact[OutPoint(b'missing', 0)]
+
+	for outpoint in list(compact):
+		del compact[outpoint]
+	assert len(compact) == 0 and not list(compact)
+
+
+def test_compact_utxo_set_releases_interned_values():
+	compact = CompactUTXOSet()
+	compact[OutPoint(b'a', 0)] = make_utxo(b'a', 0)
+	compact[OutPoint(b'a', 1)] = make_utxo(b'a', 1)
+	del compact[OutPoint(b'a', 1)]
+	assert compact._txids.ids
+
+	del compact[OutPoint(b'a', 0)]
+	assert not compact._txids.ids and not compact._pubkeys.ids
+
+
+def test_sqlite_utxo_set_persists_on_flush(tmp_path):
+	path = str(tmp_path / 'utxo.sqlite')
+	utxo_set = SqliteUTXOSet(path)
+	utxo_set[OutPoint(b'a', 0)] = make_utxo(b'a', 0)
+	utxo_set.flush()
+	utxo_set[OutPoint(b'b', 0)] = make_utxo(b'b', 0)
+
+	# nothing reaches the file before a flush
+	reopened = SqliteUTXOSet(path)
+	assert dict(reopened) == {OutPoint(b'a', 0): make_utxo(b'a', 0)}
+
+	utxo_set.close()
+	assert len(SqliteUTXOSet(path)) == 2
+
+	# a persisted store answers the address queries off its own index, nothing gets loaded at startup
+	utxo_mgr = UTXOManager()
+	utxo_mgr.use_store(SqliteUTXOSet(path))
+	assert utxo_mgr.get_current_balance_for_addr(make_utxo(b'', 0).pubkey) == 2000
+	assert not utxo_mgr.addr_index
+
+
+def test_sqlite_utxo_set_flushes_whole_blocks(tmp_path):
+	path = str(tmp_path / 'utxo.sqlite')
+	utxo_set = SqliteUTXOSet(path, cache_size=2)
+	utxos = [make_utxo(bytes([i]) * 32, 0) for i in range(10)]
+	for utxo in utxos:
+		utxo_set[utxo.outpoint] = utxo
+	del utxo_set[utxos[0].outpoint]
+
+	# a block's worth of changes well past the cache size stays pending, none of it is evicted
+	assert len(SqliteUTXOSet(path)) == 0
+	assert sorted(utxo_set.values()) == sorted(utxos[1:])
+
+	utxo_set.flush(b'tip')
+	reopened = SqliteUTXOSet(path)
+	assert reopened.best_block == b'tip'
+	assert sorted(reopened.values()) == sorted(utxos[1:])
+	assert len(utxo_set._cache) == 2
+
+	# a flush without pending changes still records the new tip
+	utxo_set.flush(b'parent')
+	assert SqliteUTXOSet(path).best_block == b'parent'
+
+
+def test_utxo_manager_with_compact_store():
+	utxo_mgr = UTXOManager()
+	utxo_mgr.add_utxo(make_utxo(b'b' * 32, 0))
+
+	# the singleton exists already, the store replaces its dict along with whatever was indexed
+	utxo_mgr.use_store(CompactUTXOSet())
+	assert UTXOManager() is utxo_mgr
+	assert isinstance(utxo_mgr.utxo_set, CompactUTXOSet)
+	assert utxo_mgr.get_current_balance_for_addr(make_utxo(b'', 0).pubkey) == 0
+
+	utxo_mgr.add_utxo(make_utxo(b'a' * 32, 0))
+	utxo_mgr.add_utxo(make_utxo(b'a' * 32, 1))
+	assert utxo_mgr.get_current_balance_for_addr(make_utxo(b'', 0).pubkey) == 2000
+	assert utxo_mgr.rm_from_utxo(b'a' * 32, 0) == make_utxo(b'a' * 32, 0)
+	assert len(utxo_mgr.utxo_set) == 1
+	assert utxo_mgr.get_utxos_for_addr(make_utxo(b'', 0).pubkey) == [make_utxo(b'a' * 32, 1)]
+
+	# the store indexes its rows by address, the manager doesn't keep an outpoint per utxo on top
+	assert not utxo_mgr.addr_index and not utxo_mgr.addr_balance
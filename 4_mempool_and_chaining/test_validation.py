@@ -0,0 +1,166 @@
+import pytest
+
+from transaction import Transaction, TxOut, OutPoint, SignatureScript, UTXOManager, MerkleNode
+from blockchain import REGTEST_NBITS
+from mempool import Mempool
+from validation import SignatureVerifier, SignatureCache, BlockValidator
+from wallet import make_txin, signing_key_from_bytes
+from test_chainmanager import chain_mgr, make_block, make_chain, assert_index_consistent, address
+
+signing_key = signing_key_from_bytes(
+	b'\x9d\x95N\xc4%\xf6W\xa0\x98\xd6X\xf2\x881w\xd6\x11y\xf2\xe7^[\xf2e\x80\xb6\xe1\xdcC\xe7;t')
+other_key = signing_key_from_bytes(
+	b' O\x98\xe2\xac\xf0\n1\xc5\xc0\x99\xc8\xbf\xccC1\x96\xc2\xe3\x91*#\xb9&\xbd\xc5\xd6\xbas\xafF\n')
+
+
+@pytest.fixture
+def verifier():
+	verifier = SignatureVerifier(processes=2, cache=SignatureCache(), min_parallel=0)
+	yield verifier
+	verifier.close()
+
+
+@pytest.fixture
+def coinbases(chain_mgr):
+	blocks = [make_block()]
+	for i in range(3):
+		blocks.append(make_block(blocks[-1], timestamp=1507593601 + i))
+	for block in blocks:
+		chain_mgr.add_block_to_chain(block)
+	return [block.txns[0] for block in blocks]
+
+
+def signed_spend(txn, key=signing_key, fee=1000):
+	"""
+	spends the first output of txn, paying back to address with a second change-like output
+	"""
+	value = txn.txouts[0].value - fee
+	txouts = [TxOut(value=value // 2, pubkey=address), TxOut(value=value - value // 2, pubkey=address)]
+	txin = make_txin(key, OutPoint(txn.id, 0), txouts[1])
+	return Transaction(txins=[txin], txouts=txouts)
+
+
+def spend_child(parent):
+	txout = parent.txouts[0]._replace(value=parent.txouts[0].value - 1000)
+	return Transaction(txins=[make_txin(signing_key, OutPoint(parent.id, 0), txout)], txouts=[txout])
+
+
+def find_utxo(txin):
+	return UTXOManager().utxo_set.get(txin.outpoint)
+
+
+def test_verify(coinbases, verifier):
+	txns = [signed_spend(coinbase) for coinbase in coinbases]
+
+	# signed by a key that isn't the address's, with a signature over the wrong message
+	forged = signed_spend(coinbases[0], key=other_key)
+	txin = txns[1].txins[0]
+	tampered = txns[1]._replace(txins=[txin._replace(
+		signature=SignatureScript(unlock_sig=txns[2].txins[0].signature.unlock_sig, unlock_pk=txin.signature.unlock_pk))])
+
+	assert verifier.verify([*txns, forged, tampered], find_utxo) == [True] * len(txns) + [False, False]
+	assert len(verifier.cache) == len(txns)
+
+	# the second time around every check is a cache hit
+	assert verifier.verify(txns, find_utxo) == [True] * len(txns)
+	assert verifier.cache.hits == len(txns)
+	assert len(verifier.cache) == len(txns)
+
+	# unknown utxo
+	assert verifier.verify([signed_spend(txns[0])], find_utxo) == [False]
+
+
+def test_verify_block(chain_mgr, coinbases, verifier):
+	parent = signed_spend(coinbases[0])
+	child = spend_child(parent)
+
+	assert verifier.verify_block(make_block(chain_mgr.active_chain[-1], txns=[parent, child]))
+	assert not verifier.verify_block(make_block(chain_mgr.active_chain[-1], txns=[
+		parent, signed_spend(coinbases[1], key=other_key)]))
+
+
+def test_mempool_admission(coinbases, verifier):
+	mempool = Mempool()
+	mempool.signature_verifier = verifier
+
+	valid = [signed_spend(coinbase) for coinbase in coinbases[:3]]
+	child = spend_child(valid[0])
+	forged = signed_spend(coinbases[3], key=other_key)
+
+	mempool.add_txn_to_mempool(forged)
+	assert not mempool.mempool_dict
+
+	# the batch is verified up front, a child can come along with (even ahead of) its parent
+	mempool.add_txns_to_mempool([child, *valid, forged])
+	assert set(mempool.mempool_dict) == {txn.id for txn in [*valid, child]}
+	assert verifier.cache.hits >= 4
+
+
+def test_block_validation(chain_mgr, coinbases, verifier):
+	validator = chain_mgr.block_validator = BlockValidator(verifier, nbits=REGTEST_NBITS)
+	tip = chain_mgr.active_chain[-1]
+	utxo_set = UTXOManager().utxo_set
+
+	def rejected_at(block):
+		before = (dict(utxo_set), dict(chain_mgr.block_index), len(chain_mgr.side_branches))
+		rejections = dict(validator.rejections)
+
+		assert chain_mgr.add_block_to_chain(block) is None
+		assert (dict(utxo_set), dict(chain_mgr.block_index), len(chain_mgr.side_branches)) == before
+		return [stage for stage in validator.STAGES if validator.rejections[stage] != rejections[stage]]
+
+	parent = signed_spend(coinbases[0])
+	valid = make_block(tip, timestamp=1507593700, txns=[parent, spend_child(parent)])
+
+	unsolved = valid
+	while int.from_bytes(unsolved.id, byteorder='big') < unsolved.target:
+		unsolved = unsolved._replace(nonce=unsolved.nonce + 1)
+	assert rejected_at(unsolved) == ['header']
+	# not past the median of the timestamps before it
+	assert rejected_at(make_block(tip, timestamp=1507593601)) == ['header']
+
+	assert rejected_at(valid._replace(merkle_tree_hash=bytes(32)).mine()) == ['merkle']
+	assert rejected_at(make_block(tip, timestamp=1507593700, txns=[parent, parent])) == ['merkle']
+
+	double_spend = signed_spend(coinbases[0], fee=2000)
+	assert rejected_at(make_block(tip, timestamp=1507593700, txns=[parent, double_spend])) == ['utxos']
+	greedy = make_block(tip, timestamp=1507593700, txns=[parent])
+	greedy_coinbase = Transaction.create_coinbase(address, 500000 + 1001)
+	greedy = greedy._replace(txns=[greedy_coinbase, parent])
+	greedy = greedy._replace(merkle_tree_hash=MerkleNode.generate_root_from_transaction(greedy.txns).value).mine()
+	assert rejected_at(greedy) == ['utxos']
+
+	assert rejected_at(make_block(tip, timestamp=1507593700, txns=[signed_spend(coinbases[1], key=other_key)])) == ['signatures']
+
+	# txns checked at mempool admission aren't verified again when their block comes in
+	mempool = Mempool()
+	mempool.signature_verifier = verifier
+	mempool.add_txns_to_mempool(valid.txns[1:])
+	hits = verifier.cache.hits
+	assert chain_mgr.add_block_to_chain(valid) == chain_mgr.ACTIVE_CHAIN_IDX
+	assert verifier.cache.hits == hits + 2
+	assert not mempool.mempool_dict
+	assert_index_consistent(chain_mgr)
+
+	assert all(validator.timings[stage] > 0 for stage in validator.STAGES)
+	assert validator.blocks_validated == 1
+
+
+def test_reorg_validation(chain_mgr, coinbases, verifier):
+	validator = chain_mgr.block_validator = BlockValidator(verifier, nbits=REGTEST_NBITS)
+	fork_point = chain_mgr.active_chain[-2]
+	tip = chain_mgr.active_chain[-1]
+
+	# a side branch only gets its header and merkle root checked, its bad signature shows once the
+	# branch outweighs the active chain and the reorg connects it
+	forged = make_block(fork_point, timestamp=1507593700, txns=[signed_spend(coinbases[0], key=other_key)])
+	assert chain_mgr.add_block_to_chain(forged) == 1
+	for block in make_chain(forged, 2, timestamp=1507593701):
+		chain_mgr.add_block_to_chain(block)
+
+	# the reorg was tried once, the blocks built on the forged one aren't candidates anymore
+	assert validator.rejections['signatures'] == 1
+	assert forged.id in chain_mgr.invalid_blocks
+	assert chain_mgr.active_chain[-1] == tip
+	assert len(chain_mgr.side_branches[0]) == 3
+	assert_index_consistent(chain_mgr)
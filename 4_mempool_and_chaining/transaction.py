@@ -6,13 +6,129 @@ Will include data structures to allow for the addition of transactions
 """
 import logging
 import time
+import struct
+import binascii
+import threading
 
+from functools import cached_property
 from utils import sha256d, Singleton
-from typing import Mapping, NamedTuple, Union, Iterable
-from serialization import register_namedtuple
+from typing import Mapping, MutableMapping, NamedTuple, Union, Iterable, Set
+from serialization import register_namedtuple, write_varint
 
 logger = logging.getLogger(__name__)
 
+UINT32 = struct.Struct('<I')
+INT64 = struct.Struct('<q')
+
+# canonical encodings are written into a per thread buffer that gets reused
+_hash_buffers = threading.local()
+
+# the tag in front of a value that can be missing, or be either bytes or str, so that no two different
+# transactions share an encoding
+ABSENT, PRESENT = b'\x00', b'\x01'
+BYTES_TAG, STR_TAG = b'\x01', b'\x02'
+
+
+def hash_buffer() -> bytearray:
+    buf = getattr(_hash_buffers, 'buf', None)
+    if buf is None:
+        buf = _hash_buffers.buf = bytearray()
+    del buf[:]
+    return buf
+
+
+def write_bytes(buf: bytearray, value: Union[str, bytes, None]):
+    """
+    tagged as missing, bytes or str, then length prefixed raw bytes
+    """
+    if value is None:
+        buf += ABSENT
+        return
+
+    buf += STR_TAG if isinstance(value, str) else BYTES_TAG
+    raw = value.encode() if isinstance(value, str) else value
+    write_varint(buf, len(raw))
+    buf += raw
+
+
+def write_uint32(buf: bytearray, value: Union[int, None]):
+    """
+    a uint32 that can be None, like locktime and sequence
+    """
+    if value is None:
+        buf += ABSENT
+    else:
+        buf += PRESENT
+        buf += UINT32.pack(value)
+
+
+def write_outpoint(buf: bytearray, outpoint):
+    """
+    a coinbase's missing outpoint is written as a single tag, any other one as its length prefixed
+    txid and output index
+    """
+    if outpoint is None:
+        buf += ABSENT
+        return
+
+    # a txid that went through json comes back as a hex string, it hashes like the original bytes
+    txid = binascii.unhexlify(outpoint.txid) if isinstance(outpoint.txid, str) else outpoint.txid
+    buf += PRESENT
+    write_varint(buf, len(txid))
+    buf += txid
+    buf += UINT32.pack(outpoint.txout_idx)
+
+
+def write_txouts(buf: bytearray, txouts):
+    write_varint(buf, len(txouts))
+    for txout in txouts:
+        buf += INT64.pack(txout.value)
+        write_bytes(buf, txout.pubkey)
+
+
+def write_transaction(buf: bytearray, txn):
+    """
+    Canonical byte encoding of a transaction, what its txid is the hash of. Independent of the json
+    serialization: fixed field order, fixed width ints and raw bytes, like bitcoin's consensus encoding.
+    Whatever can be None or of more than one type is tagged, different transactions never encode the same.
+    """
+    write_varint(buf, len(txn.txins))
+    for txin in txn.txins:
+        write_outpoint(buf, txin.outpoint)
+        if txin.signature is None:
+            buf += ABSENT
+        else:
+            buf += PRESENT
+            write_bytes(buf, txin.signature.unlock_sig)
+            write_bytes(buf, txin.signature.unlock_pk)
+        write_uint32(buf, txin.sequence)
+
+    write_txouts(buf, txn.txouts)
+    write_uint32(buf, txn.locktime)
+
+
+class TxidCrosscheck:
+    """
+    Migration aid for the move from json txids to canonical ones. Records the legacy txid next to the
+    canonical one for every transaction and raises if either maps to two different ids, which would mean
+    the canonical encoding drops something the json covered or the other way around.
+    """
+
+    def __init__(self):
+        self.by_legacy = {}
+        self.by_canonical = {}
+
+    def check(self, txn, txid: bytes):
+        legacy_id = txn.legacy_id
+        if self.by_legacy.setdefault(legacy_id, txid) != txid:
+            raise ValueError(f'legacy txid {legacy_id} maps to two canonical txids')
+        if self.by_canonical.setdefault(txid, legacy_id) != legacy_id:
+            raise ValueError(f'canonical txid {txid} maps to two legacy txids')
+
+
+# set to a TxidCrosscheck to compare every txid computed against its legacy json txid
+txid_crosscheck = None
+
 
 @register_namedtuple
 class OutPoint(NamedTuple):
@@ -92,12 +208,7 @@ class UnspentTxOut(NamedTuple):
         return OutPoint(self.txid, self.txout_idx)
 
 
-@register_namedtuple
-class Transaction(NamedTuple):
-    """
-    A NamedTuple to represent a transaction
-    """
-
+class TransactionFields(NamedTuple):
     txins: Iterable[TxIn]
     txouts: Iterable[TxOut]
 
@@ -106,6 +217,16 @@ class Transaction(NamedTuple):
     # >= 500000000: UNIX timestamp at which this transaction is unlocked.
     locktime: int = None
 
+
+@register_namedtuple
+class Transaction(TransactionFields):
+    """
+    A NamedTuple to represent a transaction
+
+    Like Block, the subclass gets a __dict__ to memoize the id in, a transaction is never mutated
+    after it is built.
+    """
+
     @property
     def is_coinbase(self) -> bool:
         """
@@ -130,13 +251,39 @@ class Transaction(NamedTuple):
 
         return cls(txins=[first_txin], txouts=[first_txout])
     
-    @property
+    @cached_property
     def id(self) -> str:
+        buf = hash_buffer()
+        write_transaction(buf, self)
+        txid = sha256d(buf)
+
+        if txid_crosscheck is not None:
+            txid_crosscheck.check(self, txid)
+        return txid
+
+    @cached_property
+    def size(self) -> int:
+        """
+        length of the canonical encoding, what fee rates are measured against
+        """
+        buf = hash_buffer()
+        write_transaction(buf, self)
+        return len(buf)
+
+    @property
+    def legacy_id(self) -> str:
+        """
+        the txid as it was computed before the canonical encoding, over the json serialization
+        """
         return sha256d(self.serialize())
 
 
 @register_namedtuple
 class MerkleNode(NamedTuple):
+    """
+    Legacy, MerkleAccumulator builds the same tree for blocks. Kept as the straightforward reference
+    the accumulator is tested and benchmarked against.
+    """
     value: str
     children: Iterable = None
 
@@ -160,23 +307,215 @@ class MerkleNode(NamedTuple):
         return txn_hashes[0]
 
 
+class MerkleAccumulator:
+    """
+    Incremental version of MerkleNode.generate_root_from_transaction, same tree and same root.
+
+    Every level of the tree is kept as one flat bytearray of 32 byte hashes, levels[0] being the leaves.
+    Appending or replacing a transaction (say the coinbase, whenever the template gets refreshed) only
+    rehashes the O(log n) nodes on its path to the root.
+    """
+    HASH_SIZE = 32
+
+    def __init__(self, txns: Iterable[Transaction] = ()):
+        self.levels = [bytearray(b''.join(sha256d(txn.id) for txn in txns))]
+
+        level = self.levels[0]
+        while len(level) > self.HASH_SIZE:
+            level = bytearray(b''.join(
+                self._parent(level, idx) for idx in range(self._count(level) // 2 + self._count(level) % 2)
+            ))
+            self.levels.append(level)
+
+    def __len__(self) -> int:
+        return self._count(self.levels[0])
+
+    def _count(self, level: bytearray) -> int:
+        return len(level) // self.HASH_SIZE
+
+    def _node(self, level: bytearray, idx: int) -> bytes:
+        return bytes(level[idx * self.HASH_SIZE:(idx + 1) * self.HASH_SIZE])
+
+    def _parent(self, level: bytearray, parent_idx: int) -> bytes:
+        """
+        hash of the pair under parent_idx, an odd node out is paired with itself
+        """
+        left_idx = parent_idx * 2
+        right_idx = left_idx + 1 if left_idx + 1 < self._count(level) else left_idx
+        return sha256d(self._node(level, left_idx) + self._node(level, right_idx))
+
+    def _set(self, level_idx: int, idx: int, node: bytes):
+        level = self.levels[level_idx]
+        if idx == self._count(level):
+            level += node
+        else:
+            level[idx * self.HASH_SIZE:(idx + 1) * self.HASH_SIZE] = node
+
+    def _rehash_path(self, idx: int):
+        level_idx = 0
+        while self._count(self.levels[level_idx]) > 1:
+            if level_idx + 1 == len(self.levels):
+                self.levels.append(bytearray())
+
+            parent_idx = idx // 2
+            self._set(level_idx + 1, parent_idx, self._parent(self.levels[level_idx], parent_idx))
+            idx, level_idx = parent_idx, level_idx + 1
+
+    def append(self, txn: Transaction):
+        self._set(0, len(self), sha256d(txn.id))
+        self._rehash_path(len(self) - 1)
+
+    def replace(self, idx: int, txn: Transaction):
+        self._set(0, idx, sha256d(txn.id))
+        self._rehash_path(idx)
+
+    @property
+    def root(self) -> bytes:
+        return self._node(self.levels[-1], 0) if len(self) else None
+
+    def proofs(self, leaves: Iterable[tuple]) -> Iterable['MerkleProof']:
+        """
+        MerkleProof for every (txid, position) in leaves, collected in a single walk up the levels.
+        Proofs of neighbouring leaves share their upper siblings, each of those is sliced out once.
+        """
+        leaves = list(leaves)
+        branches = [[] for _ in leaves]
+
+        for depth, level in enumerate(self.levels[:-1]):
+            count = self._count(level)
+            siblings = {}
+            for (_, position), branch in zip(leaves, branches):
+                idx = position >> depth
+                sibling_idx = idx ^ 1 if idx ^ 1 < count else idx
+                if sibling_idx not in siblings:
+                    siblings[sibling_idx] = self._node(level, sibling_idx)
+                branch.append(siblings[sibling_idx])
+
+        return [
+            MerkleProof(txid=txid, position=position, branch=branch)
+            for (txid, position), branch in zip(leaves, branches)
+        ]
+
+    def proof(self, txid: bytes, position: int) -> 'MerkleProof':
+        return self.proofs([(txid, position)])[0]
+
+
+@register_namedtuple
+class MerkleProof(NamedTuple):
+    """
+    Merkle branch of a txid: the sibling hashes on the path from its leaf to the root, lowest first.
+    The bits of position tell on which side each sibling goes.
+    """
+    txid: bytes
+    position: int
+    branch: Iterable[bytes]
+
+    @property
+    def root(self) -> bytes:
+        node = sha256d(self.txid)
+        for depth, sibling in enumerate(self.branch):
+            node = sha256d(sibling + node) if self.position >> depth & 1 else sha256d(node + sibling)
+        return node
+
+    def verify(self, merkle_root: bytes) -> bool:
+        # a position beyond the branch depth would still hash to a root, it just isn't a valid leaf
+        if self.position >> len(self.branch):
+            return False
+
+        node = sha256d(self.txid)
+        for depth, sibling in enumerate(self.branch):
+            if self.position >> depth & 1:
+                # the last node of an odd level is paired with a copy of itself, the pair hashes the same
+                # from the position right after it, which isn't a leaf. A real right node never equals its
+                # left sibling
+                if sibling == node:
+                    return False
+                node = sha256d(sibling + node)
+            else:
+                node = sha256d(node + sibling)
+        return node == merkle_root
+
+
 class UTXOManager(metaclass=Singleton):
     def __init__(self):
-        self.utxo_set: Mapping[OutPoint, UnspentTxOut] = {}
+        self.utxo_set: MutableMapping[OutPoint, UnspentTxOut] = {}
+
+        # pubkey -> outpoints of its utxos and pubkey -> sum of their values, kept in step with utxo_set
+        # by add_utxo and rm_from_utxo. Left empty when utxo_set indexes its utxos by address itself
+        self.addr_index: Mapping[str, Set[OutPoint]] = {}
+        self.addr_balance: Mapping[str, int] = {}
+        self.store_indexes_addrs = False
+
+    def use_store(self, utxo_set: MutableMapping):
+        """
+        Swaps the plain dict for utxo_set, any mutable mapping of OutPoint -> UnspentTxOut (see utxostore
+        for the alternatives). The singleton is built before anyone gets to pass it a store, this is the
+        way to install one. A store with utxos_for_pubkey and balance_for_pubkey answers the address
+        queries itself, for any other mapping the address index is rebuilt from the utxos it holds.
+        """
+        self.utxo_set = utxo_set
+        self.addr_index.clear()
+        self.addr_balance.clear()
+        self.store_indexes_addrs = hasattr(utxo_set, 'utxos_for_pubkey')
+        if not self.store_indexes_addrs:
+            for utxo in utxo_set.values():
+                self._index_utxo(utxo)
 
     def get_utxos_for_addr(self, pubkey: str) -> UnspentTxOut:
-        return [utxo for utxo in self.utxo_set.values() if utxo.pubkey == pubkey]
+        if self.store_indexes_addrs:
+            return list(self.utxo_set.utxos_for_pubkey(pubkey))
+        return [self.utxo_set[outpoint] for outpoint in self.addr_index.get(pubkey, ())]
 
     def get_current_balance_for_addr(self, pubkey: str) -> int:
-        logger.info(f'my utxos {self.get_utxos_for_addr(pubkey)}')
-        return sum(utxo.value for utxo in self.get_utxos_for_addr(pubkey))
+        if self.store_indexes_addrs:
+            return self.utxo_set.balance_for_pubkey(pubkey)
+        return self.addr_balance.get(pubkey, 0)
 
     def add_to_utxo(self, txout, tx, idx, is_coinbase, height):
-        utxo = UnspentTxOut(*txout, txid=tx.id, txout_idx=idx, is_coinbase=is_coinbase, height=height)
+        self.add_utxo(UnspentTxOut(*txout, txid=tx.id, txout_idx=idx, is_coinbase=is_coinbase, height=height))
+
+    def add_utxo(self, utxo: UnspentTxOut):
+        if utxo.outpoint in self.utxo_set:
+            self.rm_from_utxo(*utxo.outpoint)
+
         self.utxo_set[utxo.outpoint] = utxo
+        self._index_utxo(utxo)
+
+    def _index_utxo(self, utxo: UnspentTxOut):
+        if self.store_indexes_addrs:
+            return
+
+        self.addr_index.setdefault(utxo.pubkey, set()).add(utxo.outpoint)
+        self.addr_balance[utxo.pubkey] = self.addr_balance.get(utxo.pubkey, 0) + utxo.value
 
-    def rm_from_utxo(self, txid, txout_idx):
-        del self.utxo_set[OutPoint(txid, txout_idx)]
+    def rm_from_utxo(self, txid, txout_idx) -> UnspentTxOut:
+        utxo = self.utxo_set.pop(OutPoint(txid, txout_idx))
+        if self.store_indexes_addrs:
+            return utxo
+
+        outpoints = self.addr_index[utxo.pubkey]
+        outpoints.discard(utxo.outpoint)
+        if outpoints:
+            self.addr_balance[utxo.pubkey] -= utxo.value
+        else:
+            del self.addr_index[utxo.pubkey]
+            del self.addr_balance[utxo.pubkey]
+
+        return utxo
+
+    def clear(self):
+        self.utxo_set.clear()
+        self.addr_index.clear()
+        self.addr_balance.clear()
+
+    def flush(self, best_block: bytes = None):
+        """
+        called at block boundaries with the hash of the block the utxo set is now at, write-back stores
+        persist their pending changes here
+        """
+        flush = getattr(self.utxo_set, 'flush', None)
+        if flush:
+            flush(best_block)
 
     def find_utxo_in_list(self, txin, txns) -> UnspentTxOut:
         txid, txout_idx = txin.outpoint
@@ -1,5 +1,4 @@
 import hashlib
-import binascii
 
 from typing import Union
 from functools import wraps
@@ -9,18 +8,21 @@ def sha256d_hexdigest(data: Union[str, bytes]) -> bytes:
     """
     A double sha256: sha256(sha256(data)) will add additional rounds to the encryption
     """
-    if not isinstance(data, bytes):
+    if isinstance(data, str):
         data = data.encode()
 
     round_one = hashlib.sha256(data).digest()
     return hashlib.sha256(round_one).hexdigest()
 
 
-def sha256d(data: Union[str, bytes]) -> bytes:
+def sha256d(data: Union[str, bytes, bytearray]) -> bytes:
     """
     A double sha256: sha256(sha256(data)) will add additional rounds to the encryption
     """
-    return binascii.unhexlify(sha256d_hexdigest(data))
+    if isinstance(data, str):
+        data = data.encode()
+
+    return hashlib.sha256(hashlib.sha256(data).digest()).digest()
 
 
 def internal_order(data: Union[int, bytes], byte_size=4) -> bytes:
@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+"""
+UTXO storage backends
+
+UTXOManager only needs a mutable mapping of OutPoint -> UnspentTxOut, the stores here implement that
+mapping in ways that are cheaper to hold than a dict of NamedTuples. They index their utxos by address
+as well (utxos_for_pubkey, balance_for_pubkey), UTXOManager asks them instead of holding an outpoint per
+utxo in an address index of its own.
+"""
+
+import sqlite3
+import logging
+
+from array import array
+from collections import OrderedDict
+from typing import MutableMapping, Iterator
+
+from transaction import OutPoint, UnspentTxOut
+
+logger = logging.getLogger(__name__)
+
+
+class Interner:
+    """
+    hands out a small int per distinct value and reference counts it, so every txid and address is
+    held once no matter how many utxos point at it
+    """
+
+    def __init__(self):
+        self.values = []
+        self.refs = array('I')
+        self.ids = {}
+        self.free = []
+
+    def acquire(self, value) -> int:
+        ref = self.ids.get(value)
+        if ref is None:
+            if self.free:
+                ref = self.free.pop()
+                self.values[ref] = value
+                self.refs[ref] = 0
+            else:
+                ref = len(self.values)
+                self.values.append(value)
+                self.refs.append(0)
+            self.ids[value] = ref
+
+        self.refs[ref] += 1
+        return ref
+
+    def release(self, ref: int):
+        self.refs[ref] -= 1
+        if not self.refs[ref]:
+            del self.ids[self.values[ref]]
+            self.values[ref] = None
+            self.free.append(ref)
+
+
+class CompactUTXOSet(MutableMapping):
+    """
+    Column store for the utxo set. txids and addresses are interned, values, heights, output indexes and
+    coinbase flags live in packed arrays, one row per utxo. The rows of a txid form a linked list
+    (through the next column) starting at the txid's head row, so there are no per utxo python objects
+    at all, only per txid ones. The rows of an address form a doubly linked list of their own, through
+    the addr_next and addr_prev columns, and every address keeps the sum of its values.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self._txids = Interner()
+        self._pubkeys = Interner()
+        self._heads = array('i')
+        self._addr_heads = array('i')
+        self._balances = array('q')
+        self._free_rows = []
+        self._count = 0
+
+        self._values = array('q')
+        self._heights = array('q')
+        self._txid_refs = array('I')
+        self._txout_idxs = array('I')
+        self._pubkey_refs = array('I')
+        self._coinbase = bytearray()
+        self._next = array('i')
+        self._addr_next = array('i')
+        self._addr_prev = array('i')
+
+    def _row(self, outpoint) -> int:
+        """
+        returns the row of outpoint, -1 if it isn't in the set
+        """
+        try:
+            txid, txout_idx = outpoint
+            txid_ref = self._txids.ids.get(txid)
+        except (TypeError, ValueError):
+            return -1
+
+        row = -1 if txid_ref is None else self._heads[txid_ref]
+        while row != -1 and self._txout_idxs[row] != txout_idx:
+            row = self._next[row]
+        return row
+
+    def _utxo(self, row) -> UnspentTxOut:
+        return UnspentTxOut(
+            value=self._values[row],
+            pubkey=self._pubkeys.values[self._pubkey_refs[row]],
+            txid=self._txids.values[self._txid_refs[row]],
+            txout_idx=self._txout_idxs[row],
+            is_coinbase=bool(self._coinbase[row]),
+            height=self._heights[row]
+        )
+
+    def __getitem__(self, outpoint) -> UnspentTxOut:
+        row = self._row(outpoint)
+        if row == -1:
+            raise KeyError(outpoint)
+
+        return self._utxo(row)
+
+    def __setitem__(self, outpoint, utxo: UnspentTxOut):
+        if outpoint in self:
+            del self[outpoint]
+
+        txid_ref = self._txids.acquire(outpoint[0])
+        if txid_ref == len(self._heads):
+            self._heads.append(-1)
+
+        pubkey_ref = self._pubkeys.acquire(utxo.pubkey)
+        if pubkey_ref == len(self._addr_heads):
+            self._addr_heads.append(-1)
+            self._balances.append(0)
+
+        columns = (
+            (self._values, utxo.value),
+            (self._heights, utxo.height),
+            (self._txid_refs, txid_ref),
+            (self._txout_idxs, outpoint[1]),
+            (self._pubkey_refs, pubkey_ref),
+            (self._coinbase, int(bool(utxo.is_coinbase))),
+            (self._next, self._heads[txid_ref]),
+            (self._addr_next, self._addr_heads[pubkey_ref]),
+            (self._addr_prev, -1),
+        )
+
+        if self._free_rows:
+            row = self._free_rows.pop()
+            for column, value in columns:
+                column[row] = value
+        else:
+            row = len(self._values)
+            for column, value in columns:
+                column.append(value)
+
+        self._heads[txid_ref] = row
+        if self._addr_heads[pubkey_ref] != -1:
+            self._addr_prev[self._addr_heads[pubkey_ref]] = row
+        self._addr_heads[pubkey_ref] = row
+        self._balances[pubkey_ref] += utxo.value
+        self._count += 1
+
+    def __delitem__(self, outpoint):
+        row = self._row(outpoint)
+        if row == -1:
+            raise KeyError(outpoint)
+
+        # unlink the row from its txid's list
+        txid_ref = self._txid_refs[row]
+        if self._heads[txid_ref] == row:
+            self._heads[txid_ref] = self._next[row]
+        else:
+            prev = self._heads[txid_ref]
+            while self._next[prev] != row:
+                prev = self._next[prev]
+            self._next[prev] = self._next[row]
+
+        # and from its address' list
+        pubkey_ref = self._pubkey_refs[row]
+        addr_prev, addr_next = self._addr_prev[row], self._addr_next[row]
+        if addr_prev == -1:
+            self._addr_heads[pubkey_ref] = addr_next
+        else:
+            self._addr_next[addr_prev] = addr_next
+        if addr_next != -1:
+            self._addr_prev[addr_next] = addr_prev
+        self._balances[pubkey_ref] -= self._values[row]
+
+        self._txids.release(txid_ref)
+        self._pubkeys.release(pubkey_ref)
+        self._free_rows.append(row)
+        self._count -= 1
+
+    def __contains__(self, outpoint) -> bool:
+        return self._row(outpoint) != -1
+
+    def __iter__(self) -> Iterator[OutPoint]:
+        for txid_ref, txid in enumerate(list(self._txids.values)):
+            if txid is None:
+                continue
+
+            row = self._heads[txid_ref]
+            while row != -1:
+                yield OutPoint(txid, self._txout_idxs[row])
+                row = self._next[row]
+
+    def __len__(self) -> int:
+        return self._count
+
+    def utxos_for_pubkey(self, pubkey: str) -> Iterator[UnspentTxOut]:
+        pubkey_ref = self._pubkeys.ids.get(pubkey)
+        row = -1 if pubkey_ref is None else self._addr_heads[pubkey_ref]
+        while row != -1:
+            yield self._utxo(row)
+            row = self._addr_next[row]
+
+    def balance_for_pubkey(self, pubkey: str) -> int:
+        pubkey_ref = self._pubkeys.ids.get(pubkey)
+        return 0 if pubkey_ref is None else self._balances[pubkey_ref]
+
+
+class SqliteUTXOSet(MutableMapping):
+    """
+    Persistent utxo set in a sqlite file behind an LRU write-back cache.
+
+    Writes only touch memory, deleted outpoints are kept as None tombstones until flush() writes every
+    change in one transaction along with the hash of the block they bring the set to. ChainManager
+    flushes at block boundaries, so the file always holds the utxo set as of a whole block and
+    best_block says which. Dirty entries are pinned until then, only clean ones are evicted from the
+    cache, so a block with more changes than cache_size grows it for as long as the block lasts.
+    Misses are cached too, looking up an outpoint that isn't there only hits the database once.
+    """
+
+    def __init__(self, path: str, cache_size: int = 100000):
+        self.cache_size = cache_size
+        # clean entries, least recently used first
+        self._cache = OrderedDict()
+        # outpoint -> utxo or None of the changes since the last flush
+        self._dirty = {}
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS utxo ('
+            'txid BLOB, txout_idx INTEGER, value INTEGER, pubkey TEXT, is_coinbase INTEGER, height INTEGER, '
+            'PRIMARY KEY (txid, txout_idx)) WITHOUT ROWID'
+        )
+        self.db.execute('CREATE INDEX IF NOT EXISTS utxo_pubkey ON utxo (pubkey)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value BLOB)')
+        self._count = self.db.execute('SELECT COUNT(*) FROM utxo').fetchone()[0]
+
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'best_block'").fetchone()
+        self.best_block: bytes = row and row[0]
+
+    def _lookup(self, outpoint) -> UnspentTxOut:
+        """
+        returns the utxo at outpoint or None, through the pending changes and the cache
+        """
+        if outpoint in self._dirty:
+            return self._dirty[outpoint]
+
+        if outpoint in self._cache:
+            self._cache.move_to_end(outpoint)
+            return self._cache[outpoint]
+
+        try:
+            txid, txout_idx = outpoint
+        except (TypeError, ValueError):
+            return None
+
+        row = self.db.execute(
+            'SELECT value, pubkey, is_coinbase, height FROM utxo WHERE txid = ? AND txout_idx = ?',
+            (txid, txout_idx)
+        ).fetchone()
+
+        utxo = row and UnspentTxOut(
+            value=row[0], pubkey=row[1], txid=txid, txout_idx=txout_idx, is_coinbase=bool(row[2]), height=row[3])
+        self._cache_put(outpoint, utxo)
+        return utxo
+
+    def _cache_put(self, outpoint, utxo):
+        self._cache[outpoint] = utxo
+        self._cache.move_to_end(outpoint)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _set(self, outpoint, utxo):
+        self._cache.pop(outpoint, None)
+        self._dirty[outpoint] = utxo
+
+    def __getitem__(self, outpoint) -> UnspentTxOut:
+        utxo = self._lookup(outpoint)
+        if utxo is None:
+            raise KeyError(outpoint)
+        return utxo
+
+    def __setitem__(self, outpoint, utxo: UnspentTxOut):
+        if self._lookup(outpoint) is None:
+            self._count += 1
+        self._set(outpoint, utxo)
+
+    def __delitem__(self, outpoint):
+        if self._lookup(outpoint) is None:
+            raise KeyError(outpoint)
+
+        self._count -= 1
+        self._set(outpoint, None)
+
+    def __contains__(self, outpoint) -> bool:
+        return self._lookup(outpoint) is not None
+
+    def _rows(self, pubkey: str = None) -> Iterator[UnspentTxOut]:
+        """
+        every utxo, or every one of pubkey, the database's in a single query with the pending changes laid
+        over them
+        """
+        where, args = ('', ()) if pubkey is None else (' WHERE pubkey = ?', (pubkey,))
+        rows = self.db.execute(
+            'SELECT txid, txout_idx, value, pubkey, is_coinbase, height FROM utxo' + where, args).fetchall()
+        for txid, txout_idx, value, row_pubkey, is_coinbase, height in rows:
+            if OutPoint(txid, txout_idx) not in self._dirty:
+                yield UnspentTxOut(
+                    value=value, pubkey=row_pubkey, txid=txid, txout_idx=txout_idx, is_coinbase=bool(is_coinbase),
+                    height=height)
+
+        yield from (
+            utxo for utxo in list(self._dirty.values())
+            if utxo is not None and pubkey in (None, utxo.pubkey)
+        )
+
+    def __iter__(self) -> Iterator[OutPoint]:
+        return (utxo.outpoint for utxo in self._rows())
+
+    def values(self) -> Iterator[UnspentTxOut]:
+        return self._rows()
+
+    def items(self) -> Iterator[tuple]:
+        return ((utxo.outpoint, utxo) for utxo in self._rows())
+
+    def __len__(self) -> int:
+        return self._count
+
+    def utxos_for_pubkey(self, pubkey: str) -> Iterator[UnspentTxOut]:
+        return self._rows(pubkey)
+
+    def balance_for_pubkey(self, pubkey: str) -> int:
+        return sum(utxo.value for utxo in self._rows(pubkey))
+
+    def flush(self, best_block: bytes = None):
+        """
+        writes every pending change to the database in a single transaction, together with
+        best_block, the hash of the block the utxo set is now at
+        """
+        if not self._dirty and best_block in (None, self.best_block):
+            return
+
+        changes = list(self._dirty.items())
+        with self.db:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO utxo VALUES (?, ?, ?, ?, ?, ?)',
+                [(u.txid, u.txout_idx, u.value, u.pubkey, int(bool(u.is_coinbase)), u.height) for _, u in changes if u]
+            )
+            self.db.executemany(
+                'DELETE FROM utxo WHERE txid = ? AND txout_idx = ?',
+                [tuple(outpoint) for outpoint, utxo in changes if utxo is None]
+            )
+            if best_block is not None:
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES ('best_block', ?)", (best_block,))
+
+        if best_block is not None:
+            self.best_block = best_block
+
+        logger.debug(f'flushed {len(changes)} utxo changes')
+        self._dirty.clear()
+        for outpoint, utxo in changes:
+            self._cache_put(outpoint, utxo)
+
+    def clear(self):
+        with self.db:
+            self.db.execute('DELETE FROM utxo')
+            self.db.execute('DELETE FROM meta')
+        self._cache.clear()
+        self._dirty.clear()
+        self._count = 0
+        self.best_block = None
+
+    def close(self):
+        self.flush()
+        self.db.close()
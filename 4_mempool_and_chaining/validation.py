@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+"""
+Validation component
+
+Signature checks are the expensive part of accepting transactions and blocks, they run across a
+process pool and every signature that verified is remembered in a cache shared between mempool
+admission and block connection, so a txn is only ever verified once.
+
+Blocks go through BlockValidator's stages from cheapest to costliest, the header, the merkle root,
+the utxos the block spends and its signatures last, so most invalid blocks are turned down before
+any real work is done and every one of them before the chain state is touched.
+"""
+
+import os
+import time
+import logging
+import statistics
+import multiprocessing
+
+import ecdsa
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Tuple, Union
+
+from blockchain import Block, BLOCK_SUBSIDY, BLOCK_NBITS
+from transaction import Transaction, TxIn, UnspentTxOut, OutPoint, UTXOManager, MerkleAccumulator
+from wallet import build_spend_message, pubkey_to_address
+
+logger = logging.getLogger(__name__)
+
+# below this many signatures to check the pool isn't worth the pickling
+MIN_PARALLEL_SIGNATURES = 16
+
+# how far (seconds) a block's timestamp may be ahead of our clock
+MAX_FUTURE_BLOCK_TIME = 60 * 60 * 2
+
+# a block's timestamp has to be past the median of this many blocks before it
+MEDIAN_TIME_SPAN = 11
+
+# (spend message, pubkey, sig)
+SignatureCheck = Tuple[bytes, bytes, bytes]
+
+
+def _verify_candidates(candidates: List[SignatureCheck]) -> int:
+    """
+    Worker side of the signature checks. A txin signs the spend message of one of its txn's txouts
+    without saying which, so every candidate is tried. Returns the index of the one that verifies,
+    -1 if none does.
+    """
+    for idx, (message, pubkey, sig) in enumerate(candidates):
+        try:
+            verifying_key = ecdsa.VerifyingKey.from_string(pubkey, curve=ecdsa.SECP256k1)
+            if verifying_key.verify(sig, message):
+                return idx
+        # a malformed pubkey fails an assertion in ecdsa
+        except (ecdsa.BadSignatureError, ValueError, AssertionError):
+            continue
+
+    return -1
+
+
+def normalize_address(address: Union[str, bytes]) -> str:
+    """
+    pubkey_to_address gives bytes under base58 2.x and str before, addresses are compared as str
+    """
+    return address.decode() if isinstance(address, bytes) else address
+
+
+def address_of(pubkey: bytes) -> str:
+    return normalize_address(pubkey_to_address(pubkey))
+
+
+class SignatureCache:
+    """
+    LRU set of the (spend message, pubkey, sig) triples that verified
+    """
+
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self.hits = 0
+
+    def __contains__(self, check: SignatureCheck) -> bool:
+        if check not in self._entries:
+            return False
+
+        self._entries.move_to_end(check)
+        self.hits += 1
+        return True
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def add(self, check: SignatureCheck):
+        self._entries[check] = None
+        self._entries.move_to_end(check)
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+
+
+# shared by every SignatureVerifier that isn't given its own cache
+signature_cache = SignatureCache()
+
+
+class SignatureVerifier:
+    """
+    Checks the signatures of a batch of transactions, all inputs of a block or a batch of incoming
+    mempool txns, over a process pool that's started on first use and kept around.
+    """
+
+    def __init__(self, processes=None, cache: SignatureCache = None, min_parallel=MIN_PARALLEL_SIGNATURES):
+        self.processes = processes or os.cpu_count()
+        self.cache = signature_cache if cache is None else cache
+        self.min_parallel = min_parallel
+        self._pool = None
+
+    def _map(self, jobs: List[List[SignatureCheck]]) -> List[int]:
+        if self.processes <= 1 or len(jobs) < self.min_parallel:
+            return [_verify_candidates(candidates) for candidates in jobs]
+
+        if self._pool is None:
+            self._pool = multiprocessing.get_context().Pool(self.processes)
+
+        chunksize = max(1, len(jobs) // (self.processes * 4))
+        return self._pool.map(_verify_candidates, jobs, chunksize=chunksize)
+
+    def candidates(self, txn: Transaction, txin: TxIn) -> List[SignatureCheck]:
+        pubkey, sig = txin.signature.unlock_pk, txin.signature.unlock_sig
+        return [
+            (build_spend_message(txin.outpoint, pubkey, txin.sequence, [txout]), pubkey, sig)
+            for txout in txn.txouts
+        ]
+
+    def verify(self, txns: Iterable[Transaction],
+               find_utxo: Callable[[TxIn], Union[UnspentTxOut, None]]) -> List[bool]:
+        """
+        Whether every input of each txn unlocks the utxo it spends, find_utxo returns that utxo or None.
+        The pubkey has to hash to the utxo's address and the signature has to verify, checks found in
+        the cache are skipped, the ones that verify are added to it.
+        """
+        txns = list(txns)
+        valid = [True] * len(txns)
+
+        # (txn idx, candidates) of every input the cache doesn't vouch for
+        jobs = []
+        for txn_idx, txn in enumerate(txns):
+            if txn.is_coinbase:
+                continue
+
+            for txin in txn.txins:
+                utxo = find_utxo(txin)
+                if not utxo or not txin.signature or not txin.signature.unlock_pk \
+                        or address_of(txin.signature.unlock_pk) != normalize_address(utxo.pubkey):
+                    valid[txn_idx] = False
+                    break
+
+                candidates = self.candidates(txn, txin)
+                if not any(candidate in self.cache for candidate in candidates):
+                    jobs.append((txn_idx, candidates))
+
+        jobs = [(txn_idx, candidates) for txn_idx, candidates in jobs if valid[txn_idx]]
+        results = self._map([candidates for _, candidates in jobs])
+
+        for (txn_idx, candidates), idx in zip(jobs, results):
+            if idx == -1:
+                valid[txn_idx] = False
+            else:
+                self.cache.add(candidates[idx])
+
+        logger.debug(f'verified {len(jobs)} signatures, {valid.count(False)} invalid txns')
+        return valid
+
+    def verify_block(self, block) -> bool:
+        """
+        the signatures of every input of block, against the utxo set it's about to be connected onto
+        and the outputs of the block's own txns
+        """
+        utxo_set = UTXOManager().utxo_set
+        created = {
+            OutPoint(txn.id, idx): UnspentTxOut(*txout, txid=txn.id, txout_idx=idx, is_coinbase=False, height=-1)
+            for txn in block.txns for idx, txout in enumerate(txn.txouts)
+        }
+        return all(self.verify(block.txns, lambda txin: utxo_set.get(txin.outpoint) or created.get(txin.outpoint)))
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+
+class ValidationError(ValueError):
+    def __init__(self, stage: str, reason: str):
+        super().__init__(f'{stage}: {reason}')
+        self.stage = stage
+        self.reason = reason
+
+
+class BlockValidator:
+    """
+    Runs the validation stages of a block in order and times each of them. timings holds the seconds
+    spent per stage over every block validated so far, rejections the number of blocks each stage
+    turned down.
+    """
+    STAGES = ('header', 'merkle', 'utxos', 'signatures')
+
+    def __init__(self, signature_verifier: SignatureVerifier = None, nbits: int = BLOCK_NBITS):
+        self.signature_verifier = signature_verifier or SignatureVerifier()
+        # the difficulty the chain expects every block at
+        self.nbits = nbits
+        self.timings = {stage: 0.0 for stage in self.STAGES}
+        self.rejections = {stage: 0 for stage in self.STAGES}
+        self.blocks_validated = 0
+
+    @contextmanager
+    def _stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        except ValidationError:
+            self.rejections[name] += 1
+            raise
+        finally:
+            self.timings[name] += time.perf_counter() - start
+
+    def validate(self, block: Block, prev_timestamps: Iterable[int] = (), connect: bool = True):
+        """
+        Raises a ValidationError naming the stage block failed. prev_timestamps are the timestamps of
+        the blocks before it, most recent last. The utxo and signature stages only make sense against
+        the utxo set of the block's parent, they're skipped unless the block is about to be connected
+        onto the active chain's tip.
+        """
+        with self._stage('header'):
+            self.check_header(block, list(prev_timestamps)[-MEDIAN_TIME_SPAN:], self.nbits)
+
+        with self._stage('merkle'):
+            self.check_merkle(block)
+
+        if connect:
+            with self._stage('utxos'):
+                spent = self.check_utxos(block)
+
+            with self._stage('signatures'):
+                self.check_signatures(block, spent)
+
+        self.blocks_validated += 1
+
+    @staticmethod
+    def check_header(block: Block, prev_timestamps: List[int], nbits: int = BLOCK_NBITS):
+        """
+        only looks at the header fields, headers-first sync checks headers with it before the bodies
+        are there. The proof of work only counts at the difficulty the chain expects, nbits
+        """
+        if block.nbits != nbits:
+            raise ValidationError('header', f'block {block.id} nbits {block.nbits:#x}, expected {nbits:#x}')
+
+        if int.from_bytes(block.id, byteorder='big') >= block.target:
+            raise ValidationError('header', f'block {block.id} hash is above its target')
+
+        if prev_timestamps and block.timestamp <= statistics.median(prev_timestamps):
+            raise ValidationError('header', f'timestamp {block.timestamp} is before the median time past')
+
+        if block.timestamp > time.time() + MAX_FUTURE_BLOCK_TIME:
+            raise ValidationError('header', f'timestamp {block.timestamp} is too far in the future')
+
+    def check_merkle(self, block: Block):
+        if not block.txns or not block.txns[0].is_coinbase:
+            raise ValidationError('merkle', 'the first txn has to be the coinbase')
+
+        if any(txn.is_coinbase for txn in block.txns[1:]):
+            raise ValidationError('merkle', 'more than one coinbase')
+
+        # duplicated txids can give a block the merkle root of a different (valid) one
+        if len({txn.id for txn in block.txns}) != len(block.txns):
+            raise ValidationError('merkle', 'duplicate txns')
+
+        if MerkleAccumulator(block.txns).root != block.merkle_tree_hash:
+            raise ValidationError('merkle', 'merkle root mismatch')
+
+    def check_utxos(self, block: Block) -> Dict[OutPoint, UnspentTxOut]:
+        """
+        every input spends an unspent output of the chain or of an earlier txn of the block, once, and
+        no txn creates more than it spends. Returns the spent utxos by outpoint
+        """
+        utxo_set = UTXOManager().utxo_set
+        created = {}
+        spent = {}
+        fees = 0
+
+        for txn in block.txns[1:]:
+            for txin in txn.txins:
+                if txin.outpoint in spent:
+                    raise ValidationError('utxos', f'{txin.outpoint} is spent twice')
+
+                utxo = created.get(txin.outpoint) or utxo_set.get(txin.outpoint)
+                if utxo is None:
+                    raise ValidationError('utxos', f'{txin.outpoint} is not an unspent output')
+                spent[txin.outpoint] = utxo
+
+            if any(txout.value < 0 for txout in txn.txouts):
+                raise ValidationError('utxos', f'txn {txn.id} has a negative output')
+
+            fee = sum(spent[txin.outpoint].value for txin in txn.txins) - sum(txout.value for txout in txn.txouts)
+            if fee < 0:
+                raise ValidationError('utxos', f'txn {txn.id} spends more than its inputs')
+            fees += fee
+
+            for idx, txout in enumerate(txn.txouts):
+                created[OutPoint(txn.id, idx)] = UnspentTxOut(
+                    *txout, txid=txn.id, txout_idx=idx, is_coinbase=False, height=-1)
+
+        if sum(txout.value for txout in block.txns[0].txouts) > BLOCK_SUBSIDY + fees:
+            raise ValidationError('utxos', 'the coinbase pays more than the subsidy and the fees')
+
+        return spent
+
+    def check_signatures(self, block: Block, spent: Dict[OutPoint, UnspentTxOut]):
+        valid = self.signature_verifier.verify(block.txns[1:], lambda txin: spent.get(txin.outpoint))
+        if not all(valid):
+            invalid = [txn.id for txn, ok in zip(block.txns[1:], valid) if not ok]
+            raise ValidationError('signatures', f'invalid signatures in {invalid}')
@@ -1,13 +1,14 @@
 import ecdsa
 import hashlib
-import binascii
 import logging
 
 from base58 import b58encode_check
 from functools import lru_cache
-from transaction import UTXOManager, OutPoint, TxOut, TxIn, Transaction, SignatureScript
+from transaction import (
+    UTXOManager, OutPoint, TxOut, TxIn, Transaction, SignatureScript, UINT32,
+    hash_buffer, write_outpoint, write_bytes, write_txouts
+)
 from utils import sha256d_hexdigest
-from serialization import serialize
 from typing import Iterable
 
 logger = logging.getLogger(__name__)
@@ -39,11 +40,15 @@ def build_spend_message(outpoint: OutPoint, pk: str, sequence: int, txouts: TxOu
     """
     https://bitcoin.org/en/developer-guide#term-sighash-all
     similar to: SIGHASH_ALL
+
+    hashes the same canonical encodings the txids are computed from
     """
-    return sha256d_hexdigest(
-        outpoint.serialize() + str(sequence) +
-        binascii.hexlify(pk).decode() + serialize(txouts)
-    ).encode()
+    buf = hash_buffer()
+    write_outpoint(buf, outpoint)
+    buf += UINT32.pack(sequence)
+    write_bytes(buf, pk)
+    write_txouts(buf, txouts)
+    return sha256d_hexdigest(buf).encode()
 
 
 def make_txin(signing_key, outpoint: OutPoint, txout: TxOut) -> TxIn: